@@ -0,0 +1,12 @@
+from NB_lib import NBCLI
+
+if __name__ == '__main__':
+
+    # parse command line arguments and read config files
+    config = NBCLI.NBCLI()
+
+    # open database with its archive, the master data opened by the config is shared
+    stations_db = config.open_stations_db(archive=True)
+
+    # derive the events of the whole stored history, events which are already stored are kept
+    stations_db.backfill_events()
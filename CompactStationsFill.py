@@ -0,0 +1,17 @@
+from NB_lib import NBCLI
+import time
+
+if __name__ == '__main__':
+
+    # parse command line arguments and read config files
+    config = NBCLI.NBCLI()
+
+    # open database with its archive, the master data opened by the config is shared
+    stations_db = config.open_stations_db(archive=True)
+
+    # move all closed months older than the kept window into the archive
+    before = int(time.time()) - config.stations_transactions_keep_days * 24 * 3600
+    stations_db.archive.compact(stations_db, before)
+
+    # remove everything beyond the retention periods
+    stations_db.prune()
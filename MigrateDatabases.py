@@ -0,0 +1,14 @@
+from NB_lib import NBCLI
+
+if __name__ == '__main__':
+
+    # parse command line arguments and read config files
+    config = NBCLI.NBCLI()
+
+    # the master data is small, its migrations are applied at once
+    config.master_data.migrate()
+
+    # transactions are copied in batches, so the crawler can keep running while they are migrated
+    stations_db = config.open_stations_db()
+    stations_db.migrate(batch_size=config.migration_batch_size, pause=config.migration_pause)
+    stations_db.close()
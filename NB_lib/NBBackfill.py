@@ -0,0 +1,98 @@
+import multiprocessing
+import os
+import time
+
+from NB_lib import NBMetrics
+
+
+class _ReadJob:
+    """Picklable wrapper around the per-file parse function, which returns the job together with its result and the
+    time it took"""
+
+    def __init__(self, parse_file):
+        self.parse_file = parse_file
+
+    def __call__(self, job):
+        start = time.perf_counter()
+        result = self.parse_file(job[0])
+        return job, result, time.perf_counter() - start
+
+
+class NBBackfill:
+    """Bulk backfill of legacy status files: files are parsed in a pool of processes, a single writer adds the parsed
+    rows to the stations database and commits them in large batches. Finished files are kept in a manifest, so an
+    interrupted backfill picks up where it stopped"""
+
+    def __init__(self, stations_db, parse_file, workers=None, commit_rows=500000, report_interval=10):
+        """"Takes the NBStationsDataDB to write to and the per-file parse function, which has to return a tuple of
+        status_time and a list of (place_uid, bikes, free_racks) rows, or None if the file could not be read"""
+        self.stations_db = stations_db
+        self.parse_file = parse_file
+        self.workers = workers or os.cpu_count()
+        self.commit_rows = commit_rows
+        self.report_interval = report_interval
+
+        c = self.stations_db.conn.cursor()
+        # plain identifiers and a double mtime (REAL is single precision in duckdb), so every storage backend keeps it
+        c.execute("CREATE TABLE IF NOT EXISTS backfill_manifest ( path TEXT NOT NULL, size INTEGER NOT NULL, "
+                  "mtime DOUBLE NOT NULL, num_rows INTEGER NOT NULL, PRIMARY KEY(path) )")
+        self.stations_db.conn.commit()
+
+    def _pending_files(self, paths):
+        """Returns (path, size, mtime) for all files which are not in the manifest or have changed since"""
+        c = self.stations_db.conn.cursor()
+        c.execute("SELECT path, size, mtime FROM backfill_manifest")
+        finished = {path: (size, mtime) for path, size, mtime in c.fetchall()}
+
+        pending = list()
+        for path in paths:
+            stat = os.stat(path)
+            if finished.get(path) != (stat.st_size, stat.st_mtime):
+                pending.append((path, stat.st_size, stat.st_mtime))
+        return pending
+
+    def run(self, paths):
+        """Parses and writes all files from paths which have not been finished before, returns the number of files and
+        rows written"""
+        pending = self._pending_files(paths)
+        print(len(paths) - len(pending), "files already in manifest,", len(pending), "files to parse")
+
+        c = self.stations_db.conn.cursor()
+        num_files = num_rows = uncommitted_rows = 0
+        start = last_report = time.monotonic()
+
+        # results are written in the order of paths, so change-only storage sees the states in chronological order
+        with multiprocessing.Pool(self.workers) as pool:
+            for (path, size, mtime), result, duration in pool.imap(_ReadJob(self.parse_file), pending, chunksize=4):
+                NBMetrics.metrics.add_time("parse", duration)
+                if result is None:
+                    # file could not be parsed, it is left out of the manifest and will be tried again next time
+                    NBMetrics.metrics.count("files_failed")
+                    continue
+                NBMetrics.metrics.count("files_parsed")
+                status_time, rows = result
+                self.stations_db.add_fill_rows(rows, status_time, commit=False)
+                c.execute("INSERT OR REPLACE INTO backfill_manifest VALUES (?, ?, ?, ?)",
+                          (path, size, mtime, len(rows)))
+                num_files += 1
+                num_rows += len(rows)
+                uncommitted_rows += len(rows)
+
+                # rows and manifest entries are committed together, so the manifest never lists unsaved files
+                if uncommitted_rows >= self.commit_rows:
+                    self.stations_db.conn.commit()
+                    uncommitted_rows = 0
+
+                if time.monotonic() - last_report >= self.report_interval:
+                    last_report = time.monotonic()
+                    self._report(num_files, num_rows, last_report - start)
+
+        self.stations_db.conn.commit()
+        self._report(num_files, num_rows, time.monotonic() - start)
+        return num_files, num_rows
+
+    @staticmethod
+    def _report(num_files, num_rows, elapsed):
+        elapsed = max(elapsed, 1e-9)
+        print("{} files, {} rows saved in DB - {:.1f} files/s, {:.0f} rows/s".format(
+            num_files, num_rows, num_files / elapsed, num_rows / elapsed))
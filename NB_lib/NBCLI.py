@@ -1,7 +1,13 @@
 import argparse
 import configparser
+import hashlib
+import json
+import os
+import smtplib
+from email.mime.text import MIMEText
+import datetime
 
-from NB_lib import NBMasterDataDB
+from NB_lib import NBFeedFetcher, NBMasterDataDB, NBMetrics, NBPlaceFilter, NBStationsDataDB
 
 
 class NBCLI:
@@ -18,6 +24,16 @@ class NBCLI:
 
         parser.add_argument("-f", "--datadir", type=str, default="..\\data\\nb_data195\\NB_DATA",
                             help="path to dir with legacy xml files")
+        parser.add_argument("-w", "--workers", type=int, default=None,
+                            help="number of processes parsing legacy xml files, defaults to the number of CPUs")
+        parser.add_argument("-s", "--streaming", action="store_true",
+                            help="write stations data while the status file is still being downloaded")
+        parser.add_argument("-a", "--update-master", action="store_true",
+                            help="update the master data from the same download as the stations data")
+        parser.add_argument("-i", "--interval", type=float, default=60,
+                            help="seconds between two crawls of the daemon")
+        parser.add_argument("-u", "--master-interval", type=float, default=86400,
+                            help="seconds between two master data updates of the daemon")
 
         self.cmdl_args = parser.parse_args()
 
@@ -79,44 +95,229 @@ class NBCLI:
             self.stations_master_migration = config.get("stations_master", "latest_db_migration_name")
         else:
             self.stations_master_db_file = "def_stations_master.db"
+            self.stations_master_migration = "0001_PALACE_FIRST_SEEN_LAST_SEEN"
+
+        # resolved places are cached, by default next to the places config
+        self.places_cache_file = config.get("places_cache", "file",
+                                            fallback=os.path.splitext(self.cmdl_args.places)[0] + "_cache.json")
 
         if config.has_option("station_transactions", "file"):
             self.stations_transactions_db_file = config.get("station_transactions", "file")
         else:
             self.stations_transactions_db_file = "def_stations_transactions.db"
 
-    def _parse_place_config(self):
-        """"Takes the location/name.ini of a config file and returns a list of uids of all places mentioned, no matter
-        if they are in domains, cities or single places in the file"""
+        # raw downloads are only archived if a directory is configured
+        self.snapshot_archive_dir = config.get("snapshot_archive", "dir", fallback=None)
+
+        # tuning of the transactions database, WAL keeps readers of the database from blocking the crawler
+        self.stations_transactions_journal_mode = config.get("station_transactions", "journal_mode", fallback="WAL")
+        self.stations_transactions_synchronous = config.get("station_transactions", "synchronous", fallback="NORMAL")
+        self.stations_transactions_cache_size = config.getint("station_transactions", "cache_size", fallback=None)
+        self.stations_transactions_batch_size = config.getint("station_transactions", "batch_size", fallback=5000)
+        # 'full' stores every place on every crawl, 'changes' only stores places whose values changed and has no
+        # rollup reads, as rollups of the changes alone do not describe the states over time
+        self.stations_transactions_storage_mode = config.get("station_transactions", "storage_mode", fallback="full")
+        # history older than keep_days is compacted into the columnar archive
+        self.stations_transactions_archive_dir = config.get("station_transactions", "archive_dir", fallback="archive")
+        self.stations_transactions_keep_days = config.getint("station_transactions", "keep_days", fallback=90)
+        # retention of raw rows and hourly rollups in days, nothing is pruned if not set; daily rollups are kept
+        self.stations_transactions_retention_days = config.getfloat("station_transactions", "retention_days",
+                                                                    fallback=None)
+        self.stations_transactions_hourly_retention_days = config.getfloat("station_transactions",
+                                                                           "hourly_retention_days", fallback=None)
+        self.stations_transactions_prune_batch_size = config.getint("station_transactions", "prune_batch_size",
+                                                                    fallback=10000)
+        # rows are written into a shard file per period if a shard directory is configured
+        self.stations_transactions_shard_dir = config.get("station_transactions", "shard_dir", fallback=None)
+        self.stations_transactions_shard_period = config.get("station_transactions", "shard_period", fallback="month")
+        # storage engine of the transactions database, 'sqlite' or 'duckdb'
+        self.stations_transactions_backend = config.get("station_transactions", "backend", fallback="sqlite")
+        # bikes taken and returned are derived from every added state into stations_events if enabled
+        self.stations_transactions_events = config.getboolean("station_transactions", "events", fallback=False)
+
+        # states are spooled to disk and written by a writer thread if a spool directory is configured
+        self.spool_dir = config.get("spool", "dir", fallback=None)
+        self.spool_queue_size = config.getint("spool", "queue_size", fallback=16)
+        self.spool_retry_delay = config.getfloat("spool", "retry_delay", fallback=1.0)
+        self.spool_drain_timeout = config.getfloat("spool", "drain_timeout", fallback=30.0)
+        # if the writer falls behind, the oldest states beyond max_files are dropped, a week of crawls every minute
+        self.spool_max_files = config.getint("spool", "max_files", fallback=10080)
+
+        # with feed names, the crawls fetch these feeds of the login database at the same time instead of the world-wide
+        # status, at most per_host requests go to the same host at once
+        self.feed_names = [name.strip() for name in config.get("feeds", "names", fallback="").split(",")
+                           if name.strip()]
+        self.feed_workers = config.getint("feeds", "workers", fallback=8)
+        self.feed_per_host = config.getint("feeds", "per_host", fallback=2)
+
+        # the daemon answers current state lookups over HTTP if a port is configured
+        self.current_status_host = config.get("current_status", "host", fallback="127.0.0.1")
+        self.current_status_port = config.getint("current_status", "port", fallback=None)
+
+        # large tables are migrated in batches, with a pause after every batch in which the crawler can write
+        self.migration_batch_size = config.getint("migrations", "batch_size", fallback=50000)
+        self.migration_pause = config.getfloat("migrations", "pause", fallback=0.0)
+
+        # stage timings and counters of every run are only exported to the outputs configured
+        self.metrics_prometheus_dir = config.get("metrics", "prometheus_dir", fallback=None)
+        self.metrics_jsonl_file = config.get("metrics", "jsonl_file", fallback=None)
+        self.metrics_slow_stage_ms = config.getfloat("metrics", "slow_stage_ms", fallback=None)
+        NBMetrics.metrics.configure(self.metrics_prometheus_dir, self.metrics_jsonl_file, self.metrics_slow_stage_ms)
 
-        # make parser and open places config file
+    @staticmethod
+    def _uids(values):
+        """Returns the integer uids of config values, values which are no uids are left out"""
+        uids = set()
+        for value in values:
+            try:
+                uids.add(int(value))
+            except ValueError:
+                pass
+        return uids
+
+    def _area_places(self, values):
+        """Returns the uids of the places in the areas of config values: 'lat, lng, radius' selects a circle, the
+        radius is in metres or ends with 'km'; 'south, west, north, east' selects a bounding box. A value which is no
+        area fails loading the place configuration, instead of silently selecting fewer places"""
+        places = set()
+        for value in values:
+            parts = [part.strip().lower() for part in value.split(",")]
+            try:
+                if len(parts) == 3:
+                    radius = float(parts[2][:-2]) * 1000 if parts[2].endswith("km") else float(parts[2].rstrip("m"))
+                    places.update(self.master_data.get_places_within(float(parts[0]), float(parts[1]), radius))
+                elif len(parts) == 4:
+                    places.update(self.master_data.get_places_in_bbox(*(float(part) for part in parts)))
+                else:
+                    raise ValueError
+            except ValueError:
+                raise AssertionError("Malformed area '{}' in the place configuration. Use 'lat, lng, radius' or "
+                                     "'south, west, north, east'".format(value))
+        return places
+
+    def _parse_place_config(self, config_data):
+        """"Takes the content of the location/name.ini config file and sets the list of uids of all places mentioned,
+        no matter if they are in domains, cities, areas or single places in the file, together with the place filter.
+        All places are resolved against a single joined query of the master data, areas against its spatial index"""
+
+        # make parser and read places config
         config = configparser.ConfigParser()
-        try:
-            assert self.cmdl_args.places.endswith('.ini')
-            assert config.read(self.cmdl_args.places)
-        except AssertionError:
-            raise AssertionError("Wrong type of Place configuration file. File should exist and end with .ini")
+        config.read_string(config_data.decode())
 
-        # get a list of all stations
+        domains, cities, places = set(), set(), set()
         for section in config.sections():
-
             if section == "domain":
-                for domain in config["domain"].values():
-                    if self.master_data.check_domain(domain):
-                        self.places_list.extend(self.master_data.get_places_from_domain(domain))
-
+                domains.update(config["domain"].values())
             elif section == "city_uid":
-                for city in config["city_uid"].values():
-                    if self.master_data.check_city(city):
-                        self.places_list.extend(self.master_data.get_places_from_city(city))
-
+                cities.update(self._uids(config["city_uid"].values()))
             elif section == "place_uid":
-                for place in config["place_uid"].values():
-                    if self.master_data.check_place(place):
-                        self.places_list.append(place)
+                places.update(self._uids(config["place_uid"].values()))
+            elif section == "area":
+                places.update(self._area_places(config["area"].values()))
+
+        assignments = self.master_data.get_place_assignments()
+        selected = set(place_uid for place_uid, city_uid, domain in assignments
+                       if place_uid in places or city_uid in cities or domain in domains)
+        self.places_list = list(selected)
+        self.place_filter = NBPlaceFilter.NBPlaceFilter.from_sets(
+            selected,
+            (city_uid for place_uid, city_uid, domain in assignments if place_uid in selected and city_uid is not None),
+            (domain for place_uid, city_uid, domain in assignments if place_uid in selected and domain is not None))
+
+    def _read_places_cache(self, key):
+        """Sets places list and filter from the cache file, returns False if there is no cache for key"""
+        try:
+            with open(self.places_cache_file) as file:
+                cache = json.load(file)
+        except (OSError, ValueError):
+            return False
+        if cache.get("key") != key:
+            return False
+        self.places_list = cache["places"]
+        self.place_filter = NBPlaceFilter.NBPlaceFilter.from_sets(cache["places"], cache["cities"], cache["domains"])
+        return True
+
+    def _write_places_cache(self, key):
+        cache = {"key": key, "places": sorted(self.place_filter.places), "cities": sorted(self.place_filter.cities),
+                 "domains": sorted(self.place_filter.domains)}
+        try:
+            # written under a temporary name, so a crawl starting at the same time never reads a partial file
+            with open(self.places_cache_file + ".tmp", "w") as file:
+                json.dump(cache, file)
+            os.replace(self.places_cache_file + ".tmp", self.places_cache_file)
+        except OSError:
+            # without cache the places are resolved again on the next start
+            pass
+
+    def resolve_places(self):
+        """"Resolves the places config against the current master data and compiles it into a place filter. The result
+        is cached under a hash of the places config and the version of the master data, so it is only resolved again
+        when either of them changed"""
+        with NBMetrics.metrics.stage("places_resolution"):
+            try:
+                assert self.cmdl_args.places.endswith('.ini')
+                with open(self.cmdl_args.places, "rb") as file:
+                    config_data = file.read()
+            except (AssertionError, OSError):
+                raise AssertionError("Wrong type of Place configuration file. File should exist and end with .ini")
+
+            key = hashlib.sha256(config_data).hexdigest() + ":" + self.master_data.get_data_version()
+            if not self._read_places_cache(key):
+                self._parse_place_config(config_data)
+                self._write_places_cache(key)
+
+    def reload(self):
+        """"Reads the config files again and resolves the places list against the current master data. The database
+        files are not reopened, changing them requires a restart"""
+        self._parse_database_config()
+        self.resolve_places()
+        self._parse_email_config()
+
+    def open_stations_db(self, archive=False, spooled=False):
+        """"Opens the transactions database with the configured settings on the shared master data, with archive the
+        columnar archive is opened as well. With spooled, states are written by a writer thread through the
+        configured spool, if there is one"""
+        stations_db = NBStationsDataDB.NBStationsDataDB(
+            transactions_db_name=self.stations_transactions_db_file,
+            journal_mode=self.stations_transactions_journal_mode,
+            synchronous=self.stations_transactions_synchronous,
+            cache_size=self.stations_transactions_cache_size,
+            batch_size=self.stations_transactions_batch_size,
+            storage_mode=self.stations_transactions_storage_mode,
+            master_db=self.master_data,
+            archive_dir=self.stations_transactions_archive_dir if archive else None,
+            retention_days=self.stations_transactions_retention_days,
+            hourly_retention_days=self.stations_transactions_hourly_retention_days,
+            prune_batch_size=self.stations_transactions_prune_batch_size,
+            shard_dir=self.stations_transactions_shard_dir,
+            shard_period=self.stations_transactions_shard_period,
+            backend=self.stations_transactions_backend,
+            events=self.stations_transactions_events)
+        if spooled and self.spool_dir:
+            stations_db.start_writer(self.spool_dir, self.spool_queue_size, self.spool_retry_delay,
+                                     max_files=self.spool_max_files)
+        return stations_db
+
+    def open_feed_fetcher(self):
+        """"Returns an NBFeedFetcher for the configured feeds of the login database, or None if no feeds are
+        configured"""
+        if not self.feed_names:
+            return None
+        return NBFeedFetcher.NBFeedFetcher(self.master_data.login_db.get_feeds(self.feed_names),
+                                           max_workers=self.feed_workers, per_host=self.feed_per_host)
+
+    def send_log_email(self, text):
+        """"Sends text as log-mail, if a log-mail is configured"""
+        if not self.log_email_status:
+            return
+        msg = MIMEText(text)
+        msg['Subject'] = "[{}] {}".format(self.log_email_prefix, datetime.datetime.now().strftime("%Y-%m-%d %H:%Mh"))
+        msg['From'] = self.log_email_from
+        msg['To'] = self.log_email_to
 
-        # make place list unique
-        self.places_list = list(set(self.places_list))
+        s = smtplib.SMTP(self.log_email_smtp)
+        s.send_message(msg)
+        s.quit()
 
     def __init__(self):
         """" Parses the command line and the config files, if they are provided, will set up all important Information
@@ -124,11 +325,13 @@ class NBCLI:
         self.cmdl_args = None
         self._parse_cl()
         self._parse_database_config()
+        # the scripts share this master data, so it is only opened once
         self.master_data = NBMasterDataDB.NBMasterDataDB(master_data_db_name=self.stations_master_db_file,
                                                          login_data_db_name=self.login_db_file,
-                                                         log_file=self.cmdl_args.logfile)
+                                                         log_file=self.cmdl_args.logfile,
+                                                         stations_master_migration=self.stations_master_migration,
+                                                         snapshot_archive_dir=self.snapshot_archive_dir)
         # master data base needs to be filled in order to resolve the places list
         self.master_data.fill_if_empty()
-        self.places_list = list()
-        self._parse_place_config()
+        self.resolve_places()
         self._parse_email_config()
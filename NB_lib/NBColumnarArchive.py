@@ -0,0 +1,203 @@
+import datetime
+import os
+import shutil
+
+try:
+    import numpy
+except ImportError:  # numpy is only needed for the archive, crawling works without it
+    numpy = None
+
+from NB_lib import NBTimeSeries
+
+# columns of a partition and the fixed width type they are stored with
+COLUMNS = (("timestamp", "<i8"), ("place_uid", "<u4"), ("bikes", "<u2"), ("free_racks", "<u2"))
+
+
+def month_partitions(start, end):
+    """Yields (name, start, end) of the calendar months (UTC) between the unix timestamps start and end, the end of a
+    partition is the start of the next one"""
+    month = datetime.datetime.fromtimestamp(start, datetime.timezone.utc).replace(day=1, hour=0, minute=0, second=0,
+                                                                                   microsecond=0)
+    while month.timestamp() <= end:
+        next_month = (month + datetime.timedelta(days=32)).replace(day=1)
+        yield month.strftime("%Y-%m"), int(month.timestamp()), int(next_month.timestamp())
+        month = next_month
+
+
+def partition_range(name):
+    """Returns the unix timestamps of start and end of the month partition name"""
+    month = datetime.datetime.strptime(name, "%Y-%m").replace(tzinfo=datetime.timezone.utc)
+    next_month = (month + datetime.timedelta(days=32)).replace(day=1)
+    return int(month.timestamp()), int(next_month.timestamp())
+
+
+class NBColumnarArchive:
+    """Archive of historical fill data as one directory per month, holding every column as a fixed width numpy file
+    sorted by place_uid and timestamp, plus an index of the places and their row offsets. The files are memory mapped,
+    so slices by place and time are located without reading anything else; only the selected rows are copied"""
+
+    def __init__(self, directory):
+        NBTimeSeries.require_numpy()
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._partitions = dict()
+
+    def partition_names(self):
+        """Returns the names of all partitions in chronological order"""
+        return sorted(name for name in os.listdir(self.directory)
+                      if os.path.isfile(os.path.join(self.directory, name, "offsets.npy")))
+
+    def place_uids(self):
+        """Returns the sorted uids of all places in any partition"""
+        places = [self._open(name)["places"] for name in self.partition_names()]
+        return numpy.unique(numpy.concatenate(places)) if places else numpy.array([], dtype=numpy.int64)
+
+    def _open(self, name):
+        """Returns the memory mapped columns, places and offsets of a partition"""
+        if name not in self._partitions:
+            path = os.path.join(self.directory, name)
+            partition = {column: numpy.load(os.path.join(path, column + ".npy"), mmap_mode="r")
+                         for column, _ in COLUMNS}
+            partition["places"] = numpy.load(os.path.join(path, "places.npy"), mmap_mode="r")
+            partition["offsets"] = numpy.load(os.path.join(path, "offsets.npy"), mmap_mode="r")
+            self._partitions[name] = partition
+        return self._partitions[name]
+
+    def write_partition(self, name, series):
+        """Writes a FillSeries as partition name. Rows of an existing partition of that name are kept, so rows added
+        to a month after it was archived can be compacted into it later. The partition is replaced atomically"""
+        if name in self.partition_names():
+            old = self._open(name)
+            series = NBTimeSeries.FillSeries(*(numpy.concatenate((old[column], getattr(series, column)))
+                                               for column, _ in COLUMNS))
+            self._partitions.pop(name)
+
+        # sort by place and time and drop duplicate rows
+        order = numpy.lexsort((series.timestamp, series.place_uid))
+        columns = {column: numpy.asarray(getattr(series, column))[order].astype(dtype) for column, dtype in COLUMNS}
+        if len(order) > 0:
+            keep = numpy.ones(len(order), dtype=bool)
+            keep[1:] = (numpy.diff(columns["place_uid"].astype("<i8")) != 0) | (numpy.diff(columns["timestamp"]) != 0)
+            columns = {column: values[keep] for column, values in columns.items()}
+
+        places, starts = numpy.unique(columns["place_uid"], return_index=True)
+        offsets = numpy.append(starts, len(columns["place_uid"])).astype("<i8")
+
+        path = os.path.join(self.directory, name)
+        tmp_path = path + ".tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        for column, values in columns.items():
+            numpy.save(os.path.join(tmp_path, column + ".npy"), values)
+        numpy.save(os.path.join(tmp_path, "places.npy"), places)
+        numpy.save(os.path.join(tmp_path, "offsets.npy"), offsets)
+        old_path = path + ".old"
+        if os.path.exists(path):
+            os.rename(path, old_path)
+        os.rename(tmp_path, path)
+        shutil.rmtree(old_path, ignore_errors=True)
+
+    def _slice(self, partition, place_uid, start, end):
+        """Returns the (start, end) row range of a place between two unix timestamps in a partition"""
+        index = numpy.searchsorted(partition["places"], place_uid)
+        if index >= len(partition["places"]) or partition["places"][index] != place_uid:
+            return 0, 0
+        first, last = partition["offsets"][index], partition["offsets"][index + 1]
+        timestamps = partition["timestamp"][first:last]
+        return (first + numpy.searchsorted(timestamps, start, side="left"),
+                first + numpy.searchsorted(timestamps, end, side="right"))
+
+    def read(self, place_uids, start, end):
+        """Returns an NBTimeSeries.FillSeries of the places from start to end (unix timestamps, both included). The
+        places and time range are sliced from the mapped files without reading anything else, the selected rows are
+        returned as int64 like the series read from the database, so differences of the compact unsigned columns
+        can't wrap around"""
+        parts = list()
+        for name in self.partition_names():
+            part_start, part_end = partition_range(name)
+            if part_end <= start or part_start > end:
+                continue
+            partition = self._open(name)
+            for place_uid in sorted(set(int(place) for place in place_uids)):
+                first, last = self._slice(partition, place_uid, start, end)
+                if last > first:
+                    parts.append(NBTimeSeries.FillSeries(*(partition[column][first:last] for column, _ in COLUMNS)))
+
+        if not parts:
+            return NBTimeSeries.series_from_rows([])
+        series = NBTimeSeries.FillSeries(*(numpy.concatenate([getattr(part, column) for part in parts])
+                                           .astype(numpy.int64) for column, _ in COLUMNS))
+        if len(parts) == 1:
+            return series
+        order = numpy.lexsort((series.timestamp, series.place_uid))
+        return NBTimeSeries.FillSeries(*(values[order] for values in series))
+
+    def state_at(self, place_uid, time):
+        """Returns (timestamp, bikes, free_racks) of the latest row of a place at or before the unix timestamp time,
+        or None if the archive has none. The partitions are searched from the newest one back"""
+        for name in reversed(self.partition_names()):
+            part_start, _ = partition_range(name)
+            if part_start > time:
+                continue
+            partition = self._open(name)
+            first, last = self._slice(partition, int(place_uid), part_start, time)
+            if last > first:
+                return tuple(int(partition[column][last - 1]) for column in ("timestamp", "bikes", "free_racks"))
+        return None
+
+    def last_states(self):
+        """Yields (place_uid, bikes, free_racks, timestamp) of the last row of every place per partition, in
+        chronological order of the partitions, so later rows of a place come after earlier ones"""
+        for name in self.partition_names():
+            partition = self._open(name)
+            last = partition["offsets"][1:] - 1
+            yield from zip(partition["places"].tolist(), partition["bikes"][last].tolist(),
+                           partition["free_racks"][last].tolist(), partition["timestamp"][last].tolist())
+
+    def compact(self, stations_db, before):
+        """Moves all rows of stations_db (including its shards) from months which ended before the unix timestamp
+        before into the archive and deletes them from the database. Rows can't be deleted from frozen shards, so the
+        months they overlap are left in the database as a whole. Returns the names of the partitions written"""
+        c = stations_db.conn.cursor()
+        frozen = list()
+        if stations_db.shards is not None:
+            frozen = [(start, end) for _, _, start, end, read_only in stations_db.shards.shards(end=before)
+                      if read_only]
+        firsts = list()
+        for schema in stations_db.fill_schemas(end=before):
+            c.execute("SELECT MIN(timestamp) FROM {}.stations_fill".format(schema))
+            firsts.append(c.fetchone()[0])
+        firsts = [first for first in firsts if first is not None]
+        if not firsts:
+            return list()
+
+        written = list()
+        for name, part_start, part_end in month_partitions(min(firsts), before):
+            if part_end > before:
+                break
+            # checked before anything is written, so a month is either moved completely or not at all
+            if any(start < part_end and end > part_start for start, end in frozen):
+                print("Skipped", name, "which overlaps a frozen shard")
+                continue
+            # rows are converted to compact arrays chunk by chunk, so the month is never held as python tuples
+            chunks = list()
+            for schema in stations_db.fill_schemas(part_start, part_end - 1):
+                c.execute("SELECT timestamp, place_uid, bikes, free_racks FROM {}.stations_fill "
+                          "WHERE timestamp >= ? AND timestamp < ?".format(schema), (part_start, part_end))
+                rows = c.fetchmany(100000)
+                while rows:
+                    chunks.append(numpy.array(rows, dtype=numpy.int64).reshape(-1, 4).astype(numpy.uint32))
+                    rows = c.fetchmany(100000)
+            if not chunks:
+                continue
+            data = numpy.concatenate(chunks)
+            self.write_partition(name, NBTimeSeries.FillSeries(data[:, 0], data[:, 1], data[:, 2], data[:, 3]))
+
+            # rows are only deleted once their partition is on disk
+            for schema in stations_db.fill_schemas(part_start, part_end - 1):
+                c.execute("DELETE FROM {}.stations_fill WHERE timestamp >= ? AND timestamp < ?".format(schema),
+                          (part_start, part_end))
+            stations_db.conn.commit()
+            written.append(name)
+            print("Archived", len(data), "rows of", name)
+        return written
@@ -0,0 +1,181 @@
+import logging
+import signal
+import threading
+import time
+
+from NB_lib import NBCurrentStatus, NBMetrics, NBPipeline
+
+
+class NBCrawlerDaemon:
+    """Long running crawler: sets up config and databases once and keeps them open, crawls the current state on a fixed
+    interval and updates the master data on a slower one. With a spool, crawls only download and parse, a writer
+    thread writes the states, so the schedule does not depend on the database. With a current status port, the latest
+    states are served as JSON from memory. With configured feeds, every crawl fetches them at the same time instead of
+    the world-wide status, the master data is updated from them as well. SIGHUP reloads the config files, SIGTERM
+    and SIGINT stop the daemon after the running crawl"""
+
+    def __init__(self, config):
+        """"Takes an NBCLI, its master data is shared with the stations database"""
+        self.config = config
+        self.interval = config.cmdl_args.interval
+        self.master_interval = config.cmdl_args.master_interval
+        self.stations_db = None
+        self.current_server = None
+        self.feed_fetcher = None
+        self._wakeup = threading.Event()
+        self._stop = False
+        self._reload = False
+        self._open_stations_db()
+        self._open_feed_fetcher()
+
+    def _open_feed_fetcher(self):
+        """Opens the fetcher of the configured feeds, closes the one of the previous settings"""
+        if self.feed_fetcher is not None:
+            self.feed_fetcher.close()
+        self.feed_fetcher = self.config.open_feed_fetcher()
+
+    def _open_stations_db(self):
+        """Opens the transactions database with the current settings of the config"""
+        if self.stations_db is not None:
+            self._close_stations_db()
+        self.stations_db = self.config.open_stations_db(spooled=True)
+        if self.config.current_status_port is not None:
+            self.stations_db.refresh_current_index()
+            if self.current_server is None:
+                self.current_server = NBCurrentStatus.NBCurrentStatusServer(
+                    self.stations_db.current, self.config.current_status_host, self.config.current_status_port)
+            else:
+                self.current_server.current = self.stations_db.current
+
+    def _close_stations_db(self):
+        """Gives the writer time to write the spooled states, the rest is written after the next start"""
+        self.stations_db.stop_writer(self.config.spool_drain_timeout)
+        self.stations_db.close()
+
+    def _prune(self):
+        """Prunes a batch of expired rows, in the spooled mode the writer thread does this after every state"""
+        if self.stations_db.spool is None:
+            self.stations_db.prune(max_batches=1)
+
+    def _handle_stop(self, signum, frame):
+        self._stop = True
+        self._wakeup.set()
+
+    def _handle_reload(self, signum, frame):
+        self._reload = True
+        self._wakeup.set()
+
+    def crawl(self):
+        """Adds the current state of the configured places to the database and prunes a batch of expired rows"""
+        if self.feed_fetcher is not None:
+            self._crawl_feeds(False)
+            return
+        if self.config.cmdl_args.streaming:
+            self.stations_db.add_current_state_stream(self.config.place_filter)
+        else:
+            self.stations_db.add_current_state(self.config.place_filter)
+        self._prune()
+
+    def _master_data_changed(self, changes_str):
+        """Resolves the places again and sends the changes as log-mail, if the master data changed"""
+        if len(changes_str) > 0:
+            # new places may belong to configured cities or domains
+            self.config.resolve_places()
+            if self.current_server is not None:
+                self.stations_db.refresh_current_index()
+            self.config.send_log_email(changes_str)
+
+    def _crawl_feeds(self, update_master):
+        """Fetches the configured feeds once and adds their states, with update_master the master data is updated from
+        the same results. Feeds which did not change since the last fetch are neither parsed nor written"""
+        results = self.feed_fetcher.fetch_all()
+        self.stations_db.add_feeds(results, self.config.place_filter)
+        self._prune()
+        if update_master:
+            self._master_data_changed(self.config.master_data.update_from_feeds(results))
+
+    def update_master_data(self):
+        """Updates the master data, resolves the places again and sends the changes as log-mail. With configured
+        feeds, the master data comes from them, and the states fetched with it are added as well"""
+        if self.feed_fetcher is not None:
+            self._crawl_feeds(True)
+            return
+        self._master_data_changed(self.config.master_data.update_db())
+
+    def crawl_and_update_master_data(self):
+        """Updates the master data and adds the current state from a single download and a single walk of the status.
+        New places are added to the stations data once the places have been resolved again, from the next crawl on"""
+        if self.feed_fetcher is not None:
+            self._crawl_feeds(True)
+            return
+        pipeline = NBPipeline.NBPipeline(self.config.master_data, self.stations_db,
+                                         place_filter=self.config.place_filter,
+                                         streaming=self.config.cmdl_args.streaming)
+        pipeline.run()
+        self._prune()
+        self._master_data_changed(self.config.master_data.change_str)
+
+    def reload(self):
+        """Reads the config files again and reopens the transactions database with the new settings"""
+        logging.info("Reloading configuration")
+        self.config.reload()
+        self._open_stations_db()
+        self._open_feed_fetcher()
+
+    def _run_job(self, job):
+        """Runs a job, errors are logged and do not stop the daemon. The metrics of every run are exported"""
+        try:
+            job()
+        except Exception as error:
+            NBMetrics.metrics.count("errors")
+            logging.error("%s failed: %s", job.__name__, error)
+        NBMetrics.metrics.write(job.__name__)
+
+    def run(self):
+        """Runs crawls and master data updates until SIGTERM or SIGINT. Due times are multiples of the intervals
+        from the start, so the schedule does not drift with the duration of the jobs. Missed runs are skipped"""
+        signal.signal(signal.SIGTERM, self._handle_stop)
+        signal.signal(signal.SIGINT, self._handle_stop)
+        if hasattr(signal, "SIGHUP"):
+            signal.signal(signal.SIGHUP, self._handle_reload)
+
+        logging.info("Crawler daemon started, interval %ss, master data interval %ss", self.interval,
+                     self.master_interval)
+        # the master data was filled at start up, so the first update is due after one interval
+        start = time.monotonic()
+        next_crawl = start
+        next_master = start + self.master_interval
+
+        while not self._stop:
+            if self._reload:
+                self._reload = False
+                self._run_job(self.reload)
+
+            now = time.monotonic()
+            master_due, crawl_due = now >= next_master, now >= next_crawl
+            if master_due and crawl_due:
+                # both are served by one download
+                self._run_job(self.crawl_and_update_master_data)
+            elif master_due:
+                self._run_job(self.update_master_data)
+            elif crawl_due:
+                self._run_job(self.crawl)
+            if master_due:
+                next_master = self._next_due(start, self.master_interval, time.monotonic())
+            if crawl_due:
+                next_crawl = self._next_due(start, self.interval, time.monotonic())
+
+            self._wakeup.wait(max(0.0, min(next_crawl, next_master) - time.monotonic()))
+            self._wakeup.clear()
+
+        self._close_stations_db()
+        if self.feed_fetcher is not None:
+            self.feed_fetcher.close()
+        if self.current_server is not None:
+            self.current_server.close()
+        logging.info("Crawler daemon stopped")
+
+    @staticmethod
+    def _next_due(start, interval, now):
+        """Returns the first multiple of interval after start which lies in the future"""
+        return start + (int((now - start) // interval) + 1) * interval
@@ -0,0 +1,123 @@
+import http.server
+import json
+import threading
+import urllib.parse
+
+
+class NBCurrentStatus:
+    """Latest (timestamp, bikes, free_racks) of every place in memory, with the places of every city and domain, so
+    current states are looked up without a query. It is updated by the thread writing the states; other threads, like
+    the HTTP endpoint, only read it. Every update replaces single entries, so readers never see a partial state"""
+
+    def __init__(self):
+        self.states = dict()
+        self.cities = dict()
+        self.domains = dict()
+        self.indexed = False
+
+    def load(self, rows):
+        """Replaces all states by the (timestamp, place_uid, bikes, free_racks) rows"""
+        self.states = {place_uid: (timestamp, bikes, free_racks) for timestamp, place_uid, bikes, free_racks in rows}
+
+    def update(self, rows):
+        """Takes the states of (timestamp, place_uid, bikes, free_racks) rows which are newer than the known ones"""
+        states = self.states
+        for timestamp, place_uid, bikes, free_racks in rows:
+            state = states.get(place_uid)
+            if state is None or timestamp > state[0]:
+                states[place_uid] = (timestamp, bikes, free_racks)
+
+    def set_assignments(self, assignments):
+        """Indexes the places of every city and domain from (place_uid, city_uid, domain) rows"""
+        cities, domains = dict(), dict()
+        for place_uid, city_uid, domain in assignments:
+            if city_uid is not None:
+                cities.setdefault(city_uid, list()).append(place_uid)
+            if domain is not None:
+                domains.setdefault(domain, list()).append(place_uid)
+        self.cities = {city_uid: tuple(places) for city_uid, places in cities.items()}
+        self.domains = {domain: tuple(places) for domain, places in domains.items()}
+        self.indexed = True
+
+    def place(self, place_uid):
+        """Returns (timestamp, bikes, free_racks) of a place, or None if no state of it is known"""
+        return self.states.get(place_uid)
+
+    def _group(self, places):
+        states = self.states
+        return {place_uid: states[place_uid] for place_uid in places if place_uid in states}
+
+    def city(self, city_uid):
+        """Returns a dict of place_uid: (timestamp, bikes, free_racks) of all known places of a city"""
+        return self._group(self.cities.get(city_uid, ()))
+
+    def domain(self, domain):
+        """Returns a dict of place_uid: (timestamp, bikes, free_racks) of all known places of a domain"""
+        return self._group(self.domains.get(domain, ()))
+
+
+def _state_json(place_uid, state):
+    return {"place_uid": place_uid, "timestamp": state[0], "bikes": state[1], "free_racks": state[2]}
+
+
+class NBCurrentStatusServer:
+    """Local HTTP endpoint answering with the current states of an NBCurrentStatus as JSON: /places/<uid>,
+    /cities/<uid> and /domains/<domain>. Requests are served by threads of their own and never touch a database"""
+
+    def __init__(self, current, host="127.0.0.1", port=8080):
+        """"Takes the NBCurrentStatus to serve, it can be replaced by setting current. Port 0 picks a free port"""
+        self.current = current
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                parts = [urllib.parse.unquote(part) for part in self.path.split("?")[0].strip("/").split("/")]
+                try:
+                    status, body = server.answer(parts)
+                except ValueError:
+                    status, body = 400, {"error": "invalid id"}
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, name="current_status_server", daemon=True)
+        self.thread.start()
+
+    def answer(self, parts):
+        """Returns the HTTP status and the JSON body of a request path split into its parts"""
+        current = self.current
+        if len(parts) != 2:
+            return 404, {"error": "unknown path"}
+        kind, key = parts
+        if kind == "places":
+            state = current.place(int(key))
+            if state is None:
+                return 404, {"error": "unknown place"}
+            return 200, _state_json(int(key), state)
+        if kind == "cities":
+            name, key = "city", int(key)
+            known, states = key in current.cities, current.city(key)
+        elif kind == "domains":
+            name = "domain"
+            known, states = key in current.domains, current.domain(key)
+        else:
+            return 404, {"error": "unknown path"}
+        if not known:
+            return 404, {"error": "unknown " + name}
+        return 200, {name: key,
+                     "places": [_state_json(place_uid, state) for place_uid, state in sorted(states.items())]}
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
@@ -0,0 +1,57 @@
+import collections
+import concurrent.futures
+import datetime
+import http.client
+import logging
+import threading
+import urllib.parse
+
+from NB_lib import NBFetcher, NBMetrics
+
+# the result of fetching one feed: its name and url in the registry, the local time the request was sent, the body as
+# bytes (None if the feed did not change) and the error if it could not be fetched
+FeedResult = collections.namedtuple("FeedResult", ["source", "url", "query_time", "body", "error"])
+
+
+class NBFeedFetcher:
+    """Fetches several feeds of the registry at the same time, so a crawl takes as long as the slowest feed instead of
+    all of them. Every feed keeps its own NBFetcher and with it its connection and validators, feeds on the same host
+    share a limit of concurrent requests. A feed which cannot be fetched does not stop the others"""
+
+    def __init__(self, feeds, max_workers=8, per_host=2, **fetcher_args):
+        """"Takes (name, url) feeds, e.g. from NBLoginDB.get_feeds. At most max_workers requests run at once, at most
+        per_host of them to the same host. The remaining arguments are passed to every NBFetcher"""
+        self.feeds = list(feeds)
+        self.fetchers = {name: NBFetcher.NBFetcher(url, **fetcher_args) for name, url in self.feeds}
+        self.host_limits = dict()
+        for name, url in self.feeds:
+            host = urllib.parse.urlsplit(url).netloc
+            if host not in self.host_limits:
+                self.host_limits[host] = threading.BoundedSemaphore(per_host)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(self.feeds))),
+                                                              thread_name_prefix="feed_fetcher")
+
+    def _fetch(self, name, url, conditional):
+        with self.host_limits[urllib.parse.urlsplit(url).netloc]:
+            query_time = datetime.datetime.now()
+            try:
+                body = self.fetchers[name].fetch(conditional)
+            except (OSError, http.client.HTTPException) as error:
+                logging.error("Feed %s could not be fetched: %s", name, error)
+                NBMetrics.metrics.count("feeds_failed")
+                return FeedResult(name, url, query_time, None, error)
+        NBMetrics.metrics.count("feeds_fetched" if body is not None else "feeds_unchanged")
+        return FeedResult(name, url, query_time, body, None)
+
+    def fetch_all(self, conditional=True):
+        """Fetches all feeds concurrently and returns a FeedResult for every feed in the order of the feeds. With
+        conditional, feeds which did not change since the last fetch have no body"""
+        with NBMetrics.metrics.stage("download"):
+            futures = [self.executor.submit(self._fetch, name, url, conditional) for name, url in self.feeds]
+            return [future.result() for future in futures]
+
+    def close(self):
+        """Waits for running requests and closes all connections"""
+        self.executor.shutdown()
+        for fetcher in self.fetchers.values():
+            fetcher.close()
@@ -0,0 +1,47 @@
+# uids of GBFS stations and regions start above the uids of the NextBike feeds and still fit 32 bit integer columns
+FIRST_UID = 2000000000
+KINDS = ("place", "city")
+
+
+class NBFeedIds:
+    """Stable integer uids for the string ids of GBFS stations and regions. Ids are namespaced by the feed they come
+    from, so equal ids of different feeds get different uids. New uids are taken above FIRST_UID and above every uid
+    of the master data, so they never collide with the numeric uids of the status xml-files. The mapping is kept in
+    the table feed_ids of the master data and in memory"""
+
+    def __init__(self, conn=None):
+        """"Takes the connection of the master data, without one the uids only live as long as the object"""
+        self.conn = conn
+        self.uids = {kind: dict() for kind in KINDS}
+        self.next_uid = dict.fromkeys(KINDS, FIRST_UID)
+        if conn is None:
+            return
+        c = conn.cursor()
+        c.execute("CREATE TABLE IF NOT EXISTS `feed_ids` ( `kind` TEXT NOT NULL, `source` TEXT NOT NULL, "
+                  "`id` TEXT NOT NULL, `uid` INTEGER NOT NULL, PRIMARY KEY(`kind`, `source`, `id`), "
+                  "UNIQUE(`kind`, `uid`) )")
+        conn.commit()
+        c.execute("SELECT kind, source, id, uid FROM feed_ids")
+        for kind, source, feed_id, uid in c.fetchall():
+            self.uids[kind][(source, feed_id)] = uid
+        for kind, table in (("place", "places_data"), ("city", "city_data")):
+            c.execute("SELECT MAX(uid) FROM {}".format(table))
+            known = c.fetchone()[0]
+            mapped = max(self.uids[kind].values(), default=None)
+            self.next_uid[kind] = max(uid + 1 for uid in (FIRST_UID - 1, known, mapped) if uid is not None)
+
+    def resolve(self, kind, source, feed_ids):
+        """Returns a dict of id: uid for the ids of kind ('place' or 'city') of the feed source. Ids seen for the first
+        time get the next free uids, which are stored at once, so they stay the same for every later status"""
+        uids = self.uids[kind]
+        new = [feed_id for feed_id in dict.fromkeys(feed_ids) if (source, feed_id) not in uids]
+        if new:
+            rows = list()
+            for feed_id in new:
+                uids[(source, feed_id)] = self.next_uid[kind]
+                rows.append((kind, source, feed_id, self.next_uid[kind]))
+                self.next_uid[kind] += 1
+            if self.conn is not None:
+                self.conn.cursor().executemany("INSERT INTO feed_ids VALUES (?, ?, ?, ?)", rows)
+                self.conn.commit()
+        return {feed_id: uids[(source, feed_id)] for feed_id in feed_ids}
@@ -0,0 +1,220 @@
+import datetime
+import json
+import logging
+
+from NB_lib import NBFeedIds, NBMetrics, NBStatusStream
+
+
+def detect_format(body):
+    """Returns the format of a complete status (bytes or str) from its first character: 'gbfs' for JSON, 'xml'
+    otherwise"""
+    start = body.lstrip()[:1]
+    return "gbfs" if start in (b"{", "{") else "xml"
+
+
+def parse_feed(body, source=None, feed_ids=None):
+    """Parses a complete status of either format into an NBXmlStatus or an NBGbfsStatus, which yield the same place
+    records. source is the name of the feed, GBFS feeds without system information use it as domain. The string ids
+    of GBFS stations and regions are mapped to integer uids by the NBFeedIds feed_ids, usually those of the master
+    data"""
+    if detect_format(body) == "gbfs":
+        return NBGbfsStatus(body, source, feed_ids)
+    return NBXmlStatus(body)
+
+
+def _gbfs_time(value):
+    """Converts a GBFS timestamp, seconds since the epoch or an ISO 8601 string, into a local datetime"""
+    if isinstance(value, str) and not value.isdigit():
+        time = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+        return time.astimezone().replace(tzinfo=None) if time.tzinfo is not None else time
+    return datetime.datetime.fromtimestamp(int(value))
+
+
+class NBXmlStatus:
+    """A status xml-file parsed into a tree, status_time is the time of query from its comment or None"""
+
+    format = "xml"
+    has_master_data = True
+    has_states = True
+
+    def __init__(self, body):
+        self.status_xml, self.status_time = NBStatusStream.parse_status(body)
+
+    def records(self, place_filter=None, include_empty=False):
+        """Yields the place records of the tree, see NBStatusStream.iter_tree_records"""
+        return NBStatusStream.iter_tree_records(self.status_xml, place_filter=place_filter,
+                                                include_empty=include_empty)
+
+
+class NBGbfsStatus:
+    """A GBFS-style JSON status: either a single file (station_information, station_status, system_information or
+    system_regions) or an object with several of these files under their names. The stations are flat, static data
+    (name, position, capacity and region) is kept apart from their state, so a feed of station_status alone is enough
+    to add states and is parsed without touching the static data. Stations become places, regions become cities and
+    the system becomes the domain of the place records. Their string ids are mapped to integer uids per feed, stations
+    without id or with a malformed state are left out. status_time is the last_updated time of the station_status,
+    or of the other files if there is none"""
+
+    format = "gbfs"
+    FILES = ("station_information", "station_status", "system_information", "system_regions")
+
+    def __init__(self, body, source=None, feed_ids=None):
+        """"Takes the JSON body, the name of the feed and the NBFeedIds which map the ids of its stations and regions
+        to uids; without one, uids are numbered for this status alone"""
+        document = json.loads(body)
+        if not isinstance(document, dict):
+            raise ValueError("GBFS feed is not a JSON object")
+        # stations by station_id, in the order of the feed
+        self.information = dict()
+        self.status = dict()
+        self.system = dict()
+        self.regions = dict()
+        self.source = source
+        try:
+            self._read_files(document)
+        except (KeyError, TypeError, AttributeError) as error:
+            # like a corrupt xml-file, a malformed feed is a value error
+            raise ValueError("Malformed GBFS feed: {!r}".format(error))
+
+        # ids are namespaced by the feed, or by the system if the name of the feed is not known
+        namespace = source if source is not None else self._domain()["domain"] or ""
+        feed_ids = feed_ids if feed_ids is not None else NBFeedIds.NBFeedIds()
+        self.place_uids = feed_ids.resolve("place", namespace, list(self.information) +
+                                           [station_id for station_id in self.status if station_id not in
+                                            self.information])
+        self.city_uids = feed_ids.resolve("city", namespace, list(self.regions) +
+                                          [str(station["region_id"]) for station in self.information.values()
+                                           if station.get("region_id") is not None])
+
+    def _read_files(self, document):
+        files = [(None, document)] if "data" in document else [(name, document[name]) for name in self.FILES
+                                                               if name in document]
+        if not files:
+            raise ValueError("GBFS feed contains none of {}".format(", ".join(self.FILES)))
+
+        status_time, other_time = None, None
+        for name, file in files:
+            data = file.get("data") or dict()
+            last_updated = file.get("last_updated")
+            stations = data.get("stations")
+            if name == "station_status" or (name is None and stations and "num_bikes_available" in stations[0]):
+                self.status.update(self._valid_stations(stations or (), True))
+                if last_updated is not None:
+                    status_time = _gbfs_time(last_updated)
+                continue
+            if name == "station_information" or (name is None and stations is not None):
+                self.information.update(self._valid_stations(stations, False))
+            elif name == "system_regions" or (name is None and "regions" in data):
+                self.regions.update((str(region["region_id"]), region) for region in data.get("regions") or ())
+            elif name == "system_information" or name is None:
+                self.system = data
+            if last_updated is not None and other_time is None:
+                other_time = _gbfs_time(last_updated)
+        self.status_time = status_time or other_time
+
+    def _valid_stations(self, stations, states):
+        """Returns (station_id, station) of the stations with an id and, for states, with integer numbers of bikes and
+        docks. Malformed stations are logged and left out, they do not spoil the rest of the feed"""
+        valid, errors = list(), list()
+        for station in stations:
+            try:
+                if states:
+                    int(station["num_bikes_available"])
+                    int(station.get("num_docks_available") or 0)
+                valid.append((str(station["station_id"]), station))
+            except (KeyError, TypeError, ValueError, AttributeError) as error:
+                errors.append(error)
+        if errors:
+            logging.warning("%s malformed stations of feed %s skipped, first: %r", len(errors), self.source, errors[0])
+            NBMetrics.metrics.count("stations_malformed", len(errors))
+        return valid
+
+    @property
+    def has_states(self):
+        """True if the feed contains station status, a feed of static data alone has no states to add"""
+        return bool(self.status)
+
+    @property
+    def has_master_data(self):
+        """True if the feed contains station information, a feed of states alone can't update the master data"""
+        return bool(self.information)
+
+    def _domain(self):
+        """Returns the attributes of the system as a domain, its id is the name of the feed if the feed has no system
+        information. The country is empty, GBFS has none"""
+        system = self.system
+        domain = system.get("system_id", self.source)
+        return {"domain": domain, "name": system.get("name", domain), "country": system.get("country_code", ""),
+                "lat": None, "lng": None}
+
+    def _cities(self):
+        """Returns the attributes of every region which has stations or is listed in system_regions"""
+        num_places = dict()
+        for station in self.information.values():
+            region_id = station.get("region_id")
+            if region_id is not None:
+                num_places[str(region_id)] = num_places.get(str(region_id), 0) + 1
+        cities = dict()
+        for region_id in list(self.regions) + [region_id for region_id in num_places if region_id not in self.regions]:
+            cities[region_id] = {"uid": self.city_uids[region_id], "name": self.regions.get(region_id, {}).get("name"),
+                                 "num_places": num_places.get(region_id, 0), "lat": None, "lng": None}
+        return cities
+
+    def records(self, place_filter=None, include_empty=False):
+        """Yields a place record for every station with a state. Places have the attributes of a status xml-file,
+        stations without information have uid, bikes and free_racks only and no city. As the stations are flat, an
+        NBPlaceFilter selects places by their mapped uid alone. If include_empty is true, stations without a state are
+        yielded without bikes and free_racks, regions without stations as records with place None and a system without
+        stations as a record with city None, like empty cities and domains of a status xml-file"""
+        domain = self._domain()
+        cities = self._cities() if self.information else dict()
+        information, status, place_uids = self.information, self.status, self.place_uids
+        station_ids = status
+        if include_empty:
+            station_ids = list(information) + [station_id for station_id in status if station_id not in information]
+        with_places = set()
+        for station_id in station_ids:
+            uid = place_uids[station_id]
+            if place_filter is not None and uid not in place_filter:
+                continue
+            station = information.get(station_id)
+            city = None
+            if station is not None:
+                region_id = station.get("region_id")
+                if region_id is not None:
+                    city = cities[str(region_id)]
+                    with_places.add(city["uid"])
+            yield NBStatusStream.PlaceRecord(domain, city, _StationAttributes(uid, station, status.get(station_id)))
+
+        if include_empty:
+            for region_id, city in cities.items():
+                if region_id not in with_places:
+                    yield NBStatusStream.PlaceRecord(domain, city, None)
+            if not station_ids and not cities:
+                yield NBStatusStream.PlaceRecord(domain, None, None)
+
+
+class _StationAttributes:
+    """Attributes of a GBFS station under the names of the attributes of a place in a status xml-file. They are read
+    from the information and the status of the station when asked for, so walking a feed copies nothing"""
+
+    __slots__ = ("uid", "information", "status")
+
+    # name of a place attribute: (0 for the information or 1 for the status, key of the station)
+    KEYS = {"number": (0, "short_name"), "name": (0, "name"), "bike_racks": (0, "capacity"), "lat": (0, "lat"),
+            "lng": (0, "lon"), "bikes": (1, "num_bikes_available"), "free_racks": (1, "num_docks_available")}
+
+    def __init__(self, uid, information, status):
+        self.uid = uid
+        self.information = information
+        self.status = status
+
+    def get(self, name, default=None):
+        if name == "uid":
+            return self.uid
+        source, key = self.KEYS.get(name, (0, None))
+        station = self.status if source else self.information
+        if station is None or key is None:
+            return default
+        value = station.get(key)
+        return default if value is None else value
@@ -0,0 +1,208 @@
+import gzip
+import hashlib
+import http.client
+import logging
+import random
+import time
+import urllib.parse
+import zlib
+
+from NB_lib import NBMetrics
+
+
+class _CountedResponse:
+    """Reads from a response and counts the bytes received"""
+
+    def __init__(self, fetcher, response):
+        self.fetcher = fetcher
+        self.response = response
+
+    def read(self, size=-1):
+        data = self.response.read(size)
+        self.fetcher.bytes_received += len(data)
+        NBMetrics.metrics.count("bytes_downloaded", len(data))
+        return data
+
+
+class _StreamBody:
+    """File-like body of a streamed response, decompresses gzip on the fly. If it is closed before the body has been
+    read completely, the connection is dropped, so the next request does not read the rest of this one"""
+
+    def __init__(self, fetcher, response):
+        self.fetcher = fetcher
+        self.response = response
+        self.body = _CountedResponse(fetcher, response)
+        if response.getheader("Content-Encoding", "").lower() == "gzip":
+            self.body = gzip.GzipFile(fileobj=self.body)
+
+    def read(self, size=-1):
+        return self.body.read(size)
+
+    def close(self):
+        if not self.response.isclosed():
+            self.fetcher.close()
+        self.response.close()
+
+
+class NBFetcher:
+    """Fetches a single url over a persistent connection. Requests gzip, sends If-None-Match / If-Modified-Since and
+    reports unchanged content, follows redirects, retries with exponential backoff and jitter"""
+
+    REDIRECTS = (301, 302, 303, 307, 308)
+    # permanent redirects replace the url for all later requests
+    PERMANENT_REDIRECTS = (301, 308)
+
+    def __init__(self, url, timeout=30, max_tries=10, backoff_base=1.0, backoff_max=60.0, deadline=300.0,
+                 max_redirects=5):
+        """"timeout is the socket timeout of every request, deadline the time in seconds a request may take with all
+        its tries, the timeout of a try is cut to the time left. At most max_redirects redirects are followed per
+        request"""
+        self.url = urllib.parse.urlsplit(url)
+        self.timeout = timeout
+        self.max_tries = max_tries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.deadline = deadline
+        self.max_redirects = max_redirects
+        self.conn = None
+        # (scheme, netloc) the connection is open to
+        self.conn_host = None
+
+        # validators and hash of the last content received
+        self.etag = None
+        self.last_modified = None
+        self.content_hash = None
+        self.bytes_received = 0
+
+    def close(self):
+        """Closes the connection, the next request opens a new one"""
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def backoff(self, attempt, max_delay=None):
+        """Sleeps before the given retry, exponential in the number of the attempt with full jitter, at most
+        max_delay seconds if given"""
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        time.sleep(delay if max_delay is None else max(0.0, min(delay, max_delay)))
+
+    def _connection(self, url, timeout):
+        """Returns the connection to the host of url with the socket timeout set to timeout. A connection to another
+        host is closed first"""
+        if self.conn is not None and self.conn_host != (url.scheme, url.netloc):
+            self.close()
+        if self.conn is None:
+            if url.scheme == "https":
+                self.conn = http.client.HTTPSConnection(url.netloc, timeout=timeout)
+            else:
+                self.conn = http.client.HTTPConnection(url.netloc, timeout=timeout)
+            self.conn_host = (url.scheme, url.netloc)
+        self._set_timeout(timeout)
+        return self.conn
+
+    def _set_timeout(self, timeout):
+        """Sets the socket timeout of the connection, also on its socket if it is open"""
+        self.conn.timeout = timeout
+        if self.conn.sock is not None:
+            self.conn.sock.settimeout(timeout)
+
+    def _request(self, conditional, read_body=False):
+        """Sends a GET request and returns the response and its body, or None if the server answered 304 Not Modified.
+        With read_body, the body is read and decompressed as part of the request, so a body cut off during the
+        transfer is retried like a failed request; otherwise the body is None and left to read from the response.
+        Redirects are followed, also to other hosts, a permanent one changes the url of the fetcher. Failed requests
+        and server errors are retried until the deadline, the timeout of every try is cut to the time left"""
+        headers = {"Accept-Encoding": "gzip"}
+        if conditional and self.etag:
+            headers["If-None-Match"] = self.etag
+        if conditional and self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+
+        url = self.url
+        start = time.monotonic()
+        attempt = num_redirects = 0
+        while True:
+            path = url.path or "/"
+            if url.query:
+                path += "?" + url.query
+            time_left = self.deadline - (time.monotonic() - start)
+            if time_left <= 0:
+                raise TimeoutError("Deadline of {}s exceeded for {}".format(self.deadline, self.url.geturl()))
+            try:
+                conn = self._connection(url, min(self.timeout, time_left))
+                conn.request("GET", path, headers=headers)
+                response = conn.getresponse()
+                body = None
+                if response.status in self.REDIRECTS:
+                    response.read()
+                elif response.status == 200 and read_body:
+                    body = response.read()
+                    self.bytes_received += len(body)
+                    NBMetrics.metrics.count("bytes_downloaded", len(body))
+                    if response.getheader("Content-Encoding", "").lower() == "gzip":
+                        body = gzip.decompress(body)
+            except (OSError, EOFError, zlib.error, http.client.HTTPException) as exception:
+                # incomplete bodies leave the connection in an unknown state, so it is dropped as well
+                error = exception
+                self.close()
+            else:
+                location = response.getheader("Location")
+                if response.status in self.REDIRECTS and location:
+                    num_redirects += 1
+                    if num_redirects > self.max_redirects:
+                        raise IOError("More than {} redirects for {}".format(self.max_redirects, self.url.geturl()))
+                    url = urllib.parse.urlsplit(urllib.parse.urljoin(url.geturl(), location))
+                    if response.status in self.PERMANENT_REDIRECTS:
+                        self.url = url
+                    NBMetrics.metrics.count("redirects")
+                    continue
+                if response.status == 304:
+                    NBMetrics.metrics.count("not_modified")
+                    response.read()
+                    return None
+                if response.status == 200:
+                    # a streamed body is read after the request, with the usual timeout
+                    self._set_timeout(self.timeout)
+                    return response, body
+                response.read()
+                error = IOError("HTTP {} {} for {}".format(response.status, response.reason, url.geturl()))
+                # only server errors are worth another try
+                if response.status < 500:
+                    raise error
+
+            attempt += 1
+            time_left = self.deadline - (time.monotonic() - start)
+            if attempt >= self.max_tries or time_left <= 0:
+                raise error
+            NBMetrics.metrics.count("download_retries")
+            logging.warning("Downloading %s failed in try %s, trying again: %s", url.geturl(), attempt, error)
+            self.backoff(attempt, time_left)
+
+    def _remember(self, response):
+        self.etag = response.getheader("ETag")
+        self.last_modified = response.getheader("Last-Modified")
+
+    def fetch(self, conditional=True):
+        """Returns the body of the url as bytes, or None if it did not change since the last fetch, either because the
+        server answered 304 or because the body has the same hash as the last one"""
+        result = self._request(conditional, read_body=True)
+        if result is None:
+            return None
+        response, body = result
+        self._remember(response)
+
+        content_hash = hashlib.sha256(body).hexdigest()
+        if conditional and content_hash == self.content_hash:
+            return None
+        self.content_hash = content_hash
+        return body
+
+    def open(self, conditional=True):
+        """Returns a file-like object for streaming the body of the url, or None if the server answered 304"""
+        result = self._request(conditional)
+        if result is None:
+            return None
+        response = result[0]
+        self._remember(response)
+        self.content_hash = None
+        return _StreamBody(self, response)
@@ -1,38 +1,38 @@
 import sqlite3
-import sys
 
 
 class NBLoginDB:
-    """Class to define an abstract interface to the Login Database"""
+    """Class to define an abstract interface to the Login Database. Its urls table (name, url) is the registry of the
+    feeds which can be crawled, 'StationList' is the world-wide status"""
 
     def __init__(self, databasename="login.db"):
         """"Creates a database connection at initialization """
         self.conn = sqlite3.connect(databasename)
 
     def get_url(self, url_type):
-        """Returns the URL to receive general station info and current station occupation from the Database"""
-        if url_type == "StationList":
-            return self._get_station_list_url()
-        else:
-            print("ERROR: Trying to get an unknown URL-Type")
-            sys.exit()
+        """Returns the URL registered under the name url_type, e.g. 'StationList' for the general station info and
+        current station occupation. Raises a ValueError if there is no such URL"""
+        return self.get_feeds([url_type])[0][1]
+
+    def get_feeds(self, names=None):
+        """Returns (name, url) of the registered feeds in the order they were added, if names are given only of these.
+        Raises a ValueError if the registry cannot be read or a name is not registered"""
+        try:
+            c = self.conn.cursor()
+            c.execute("SELECT urls.name, urls.url FROM urls ORDER BY rowid")
+            feeds = c.fetchall()
+        except sqlite3.Error as error:
+            raise ValueError("Could not read the URLs from the login database: {}".format(error))
+        if names is not None:
+            names = set(names)
+            missing = names - set(name for name, url in feeds)
+            if missing:
+                raise ValueError("No URL '{}' in the login database".format("', '".join(sorted(missing))))
+            feeds = [(name, url) for name, url in feeds if name in names]
+        return feeds
 
     def get_apikey(self):
         pass
 
     def get_login(self):
         pass
-
-    def _get_station_list_url(self):
-        try:
-            c = self.conn.cursor()
-            c.execute("SELECT urls.url FROM urls WHERE urls.name = 'StationList'")
-            try:
-                url = c.fetchone()[0]
-                return url
-            except TypeError:
-                print("ERROR: dCould not fetch URL from Database login.db - Is it there?")
-                sys.exit()
-        except sqlite3.Error:
-            print("Error Opening Database login.db")
-            sys.exit()
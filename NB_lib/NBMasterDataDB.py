@@ -1,25 +1,41 @@
-import datetime
 import logging
-import sqlite3
-import urllib.request
 import xml.etree.ElementTree as ElmTree
 
-from NB_lib import NBLoginDB
+from NB_lib import NBFeedIds, NBFeedParser, NBFetcher, NBLoginDB, NBMetrics, NBMigrations, NBPipeline, \
+    NBSnapshotArchive, NBSpatialIndex, NBStatusStream, NBStorageBackend
 
 
 class NBMasterDataDB:
     """Class which defines an interface to the master data base"""
 
+    # name of the stations-status url in the login database, also the feed the ids of a GBFS status are mapped for
+    STATUS_SOURCE = "StationList"
+
     def __init__(self, master_data_db_name="stations_master.db",
                  login_data_db_name="login.db",
                  log_file="master_data.log",
-                 stations_master_migration="0001_PALACE_FIRST_SEEN_LAST_SEEN"):
+                 stations_master_migration="0001_PALACE_FIRST_SEEN_LAST_SEEN",
+                 snapshot_archive_dir=None):
         """"Creates a database connection at initialization and establishes base DB-structure if necessary,
-        also creates an NBLoginDB Object"""
+        also creates an NBLoginDB Object. If a snapshot_archive_dir is given, every downloaded status is kept in an
+        NBSnapshotArchive"""
         self.status_xml = None
+        self.status_xml_raw = None
         self.status_time = None
+        # the parsed status, an NBXmlStatus or an NBGbfsStatus; status_xml is only set for the xml format
+        self.status = None
+        # the fetcher keeps the connection to the server and the hash of the last content received
+        self.fetcher = None
+        self.parsed_hash = None
+        self.master_hash = None
+        self.snapshot_archive = None
+        if snapshot_archive_dir is not None:
+            self.snapshot_archive = NBSnapshotArchive.NBSnapshotArchive(snapshot_archive_dir)
         self.stations_master_migration = stations_master_migration
         self.change_str = ""
+        self.vanished_places = list()
+        # built on first use and dropped whenever new places are added
+        self.spatial_index = None
 
         # see if a logfile was set or if logging was disabled, if so, set logging flag to false or configure logging
         if not log_file:
@@ -32,7 +48,10 @@ class NBMasterDataDB:
                                 datefmt="%Y-%m-%d %H.%M")
 
         self.login_db = NBLoginDB.NBLoginDB(databasename=login_data_db_name)
-        self.conn = sqlite3.connect(master_data_db_name)
+        # the master data is limited to sqlite, whatever backend the transactions database uses: its schema checks and
+        # migrations are sqlite only. Its records are written through the sqlite backend
+        self.backend = NBStorageBackend.get_backend("sqlite")
+        self.conn = self.backend.connect(master_data_db_name)
 
         c = self.conn.cursor()
         # see if database contains five tables and construct them if required
@@ -41,7 +60,7 @@ class NBMasterDataDB:
         if len(c.fetchall()) < 6:
             c.execute("CREATE TABLE `places_data` (`uid` INTEGER NOT NULL,`number` INTEGER, `spot` INTEGER, "
                       "`name` TEXT, `bike_racks` INTEGER, `latitude` REAL, `longitude` REAL,"
-                      "`terminal_type` TEXT, PRIMARY KEY(`uid`))")
+                      "`terminal_type` TEXT, `first_seen` TIMESTAMP, `last_seen` TIMESTAMP, PRIMARY KEY(`uid`))")
             if self.logging:
                 logging.info("Set up table: 'place_data'")
 
@@ -71,12 +90,20 @@ class NBMasterDataDB:
             if self.logging:
                 logging.info("Set up table: 'migrations'")
 
+        # uids of the stations and regions of GBFS feeds, the table is created with the first use
+        self.feed_ids = NBFeedIds.NBFeedIds(self.conn)
+
+    def migrate(self):
+        """Applies the pending migrations of the master data, returns the names of the migrations applied"""
+        return NBMigrations.NBMigrationRunner(self.conn, "master").run()
+
     def fill_if_empty(self):
         """"Makes sure there is data in the master data db. If nothing exists, if will be filled."""
-        c = self.conn.cursor()
-        c.execute("SELECT '1' FROM places_data LIMIT 1")
-        if len(c.fetchall()) < 1:
-            self.update_db()
+        with NBMetrics.metrics.stage("fill_if_empty"):
+            c = self.conn.cursor()
+            c.execute("SELECT '1' FROM places_data LIMIT 1")
+            if len(c.fetchall()) < 1:
+                self.update_db()
 
     def check_place(self, place_uid):
         """Returns true if the provided place_uid is valid"""
@@ -126,48 +153,144 @@ class NBMasterDataDB:
             place_list.extend(self.get_places_from_city(city))
         return place_list
 
+    def get_place_assignments(self):
+        """Returns a list of (place_uid, city_uid, domain) of all places with their cities and domains from a single
+        joined query. City and domain are None for places without assignment"""
+        c = self.conn.cursor()
+        c.execute("SELECT places_data.uid, places_cities_assignment.city_uid, cities_domains_assignment.domain "
+                  "FROM places_data LEFT JOIN places_cities_assignment "
+                  "ON places_cities_assignment.place_uid = places_data.uid "
+                  "LEFT JOIN cities_domains_assignment "
+                  "ON cities_domains_assignment.city_uid = places_cities_assignment.city_uid")
+        return c.fetchall()
+
+    def get_spatial_index(self):
+        """Returns the NBSpatialIndex over the coordinates of all places, it is built again after new places have been
+        added"""
+        if self.spatial_index is None:
+            c = self.conn.cursor()
+            c.execute("SELECT uid, latitude, longitude FROM places_data")
+            self.spatial_index = NBSpatialIndex.NBSpatialIndex.from_rows(c.fetchall())
+        return self.spatial_index
+
+    def get_places_nearest(self, lat, lng, n):
+        """Returns a list of the n places nearest to lat, lng (degrees), nearest first"""
+        return self.get_spatial_index().nearest(lat, lng, n)[0].tolist()
+
+    def get_places_within(self, lat, lng, radius):
+        """Returns a list of all places within radius metres of lat, lng (degrees), nearest first"""
+        return self.get_spatial_index().within(lat, lng, radius)[0].tolist()
+
+    def get_places_in_bbox(self, south, west, north, east):
+        """Returns a list of all places inside the bounding box (degrees), a box with west east of east crosses the
+        antimeridian"""
+        return self.get_spatial_index().in_bbox(south, west, north, east).tolist()
+
+    def get_data_version(self):
+        """Returns a string which changes whenever the places, cities, domains or their assignments the place
+        configuration is resolved against change, or a migration is applied. Records are added, updated by the upserts
+        of the master data sinks and may be deleted by hand, so the version combines the row count and the largest
+        rowid of every table, which changes if a record is deleted and another one added, with the sums of the
+        coordinates of the places, which change if a place is moved in or out of an area"""
+        c = self.conn.cursor()
+        tables = ("domain_data", "city_data", "places_data", "places_cities_assignment", "cities_domains_assignment")
+        c.execute("SELECT {}, (SELECT TOTAL(latitude) || ':' || TOTAL(longitude) FROM places_data), "
+                  "(SELECT MAX(id) FROM admin_migrations)".format(
+                      ", ".join("(SELECT COUNT(*) || ':' || IFNULL(MAX(rowid), 0) FROM {})".format(table)
+                                for table in tables)))
+        return "-".join(str(value) for value in c.fetchone())
+
     def get_station_status(self, current=True):
         """"Returns an XML Tree and time of query for the latest status. If current == True,
-        it will get the current status"""
+        it will get the current status. The tree is None for a status in the GBFS format, see status_records"""
         if current:
-            self._download_station_status()
-            self._parse_station_status()
+            self._refresh_station_status()
         return self.status_xml, self.status_time
 
-    def _download_station_status(self):
-        """" Opens the Stations-status url and saves the result"""
-        url = self.login_db.get_url("StationList")
-        response = urllib.request.urlopen(url)
-        self.status_xml_raw = response.read().decode()
+    def status_records(self, place_filter=None, include_empty=False):
+        """Returns an iterator over the place records of the latest status, whatever its format. An NBPlaceFilter and
+        include_empty are passed to the records of the parsed status"""
+        return self.status.records(place_filter=place_filter, include_empty=include_empty)
+
+    def _get_fetcher(self):
+        """Returns the fetcher for the stations-status url, it is created on first use"""
+        if self.fetcher is None:
+            self.fetcher = NBFetcher.NBFetcher(self.login_db.get_url(self.STATUS_SOURCE))
+        return self.fetcher
+
+    def _refresh_station_status(self):
+        """"Downloads the status and parses it, if its content differs from the one parsed last"""
+        self._download_station_status()
+        if self.status is None or self.parsed_hash != self.fetcher.content_hash:
+            self._parse_station_status()
+
+    def _download_station_status(self, conditional=True):
+        """" Opens the Stations-status url and saves the result. Returns False if the server reported the status as
+        unchanged since the last download, the last result is kept in this case"""
+        # without a last result, there is nothing to compare to
+        with NBMetrics.metrics.stage("download"):
+            body = self._get_fetcher().fetch(conditional and self.status_xml_raw is not None)
+        if body is None:
+            return False
+        self.status_xml_raw = body.decode()
+        return True
+
+    def stream_station_status(self, place_filter=None, include_empty=False):
+        """"Opens the stations-status url and returns an NBStatusStream, which yields the place records while the
+        download is still running, streaming is only supported for the xml format. The time of query is set on the
+        stream once it has been read. Returns None if the server reports the status as unchanged since the last
+        download. An NBPlaceFilter restricts the records to cities with selected places, include_empty adds records for
+        empty cities and domains"""
+        source = self._get_fetcher().open()
+        if source is None:
+            return None
+        # the streamed content is not kept, so the next download must not be answered as unchanged
+        self.status_xml_raw = None
+        if self.snapshot_archive is not None:
+            source = self.snapshot_archive.tee(source)
+        return NBStatusStream.NBStatusStream(source, place_filter=place_filter, include_empty=include_empty)
+
+    def archive_stream(self, stream):
+        """"Keeps the raw content of a completely read stream in the snapshot archive, if one is configured"""
+        if self.snapshot_archive is not None:
+            self.snapshot_archive.commit(stream.source, stream.status_time)
 
     def _parse_station_status(self):
-        """Returns an XML-object with the current status of all stations world-wide and a datetime of query as tuple"""
+        """Parses the current status of all stations world-wide and sets it with its datetime of query. The format,
+        xml or GBFS-style JSON, is detected from the content"""
         success = False
         num_tries = 0
 
         # check if status file as been downloaded. If not, do so
-        if not hasattr(self, "status_xml"):
+        if self.status_xml_raw is None:
             self._download_station_status()
 
         # Parse XML, an if necessary download again if file is corrupt,
         # often for corrupt files getting the time will go wrong
         while not success and num_tries < 10:
             try:
-                self.status_xml = ElmTree.fromstring(self.status_xml_raw)
-                # get the time of the query from the comment at the end of the file
-                query_time_start_pos = self.status_xml_raw.find("<!--")
-                query_time_end_pos = self.status_xml_raw.find("-->")
-                time_string = self.status_xml_raw[query_time_start_pos + 5:query_time_end_pos - 1]
-                self.status_time = datetime.datetime.strptime(time_string, "%d.%m.%Y %H:%M")
+                with NBMetrics.metrics.stage("parse"):
+                    status = NBFeedParser.parse_feed(self.status_xml_raw, self.STATUS_SOURCE, self.feed_ids)
+                # the time of query is part of the status, often it is what goes wrong for corrupt files
+                if status.status_time is None:
+                    raise ValueError("Status does not contain a time of query")
+                self.status = status
+                self.status_xml = getattr(status, "status_xml", None)
+                self.status_time = status.status_time
+                self.parsed_hash = self.fetcher.content_hash
                 success = True
+                if self.snapshot_archive is not None:
+                    self.snapshot_archive.add(self.status_xml_raw.encode(), self.status_time)
             except (ElmTree.ParseError, ValueError):  # parsing of xml went wrong
                 success = False
                 num_tries += 1
+                NBMetrics.metrics.count("parse_retries")
                 print("Problems Downloading Current Stations List Connection try ", num_tries - 1,
                       "failed. Will try again")
-                self._download_station_status()
+                # the corrupt file has been received completely, so it must not be compared against
+                self.fetcher.backoff(num_tries)
+                self._download_station_status(conditional=False)
 
-        assert isinstance(self.status_xml, ElmTree.Element)
         if not success:
             raise ValueError('Could not get Station Data or Parse received XML-File')
 
@@ -178,17 +301,41 @@ class NBMasterDataDB:
             # update db
             self.change_str = ""
 
-            self._download_station_status()
-            self._parse_station_status()
-            self._update_domain_table()
-            self._update_city_table()
-            self._update_cities_domain_assign_table()
-            self._update_places_table()
-            self._update_places_cities_assign_table()
+            self._refresh_station_status()
+            # nothing to do if the master data was already updated from this content
+            if self.master_hash is None or self.master_hash != self.parsed_hash:
+                with NBMetrics.metrics.stage("master_update"):
+                    self._update_tables()
+                self.master_hash = self.parsed_hash
         else:
             raise ValueError('Database Scheme is not Current. Run migrations or fix database by hand')
         return self.change_str
 
+    def update_from_feeds(self, results):
+        """"Updates the master data from fetched FeedResults of either format, every feed in a transaction of its own.
+        Feeds without body, without station information or which cannot be parsed are skipped. Returns the changes
+        as string"""
+        if not self._check_migration():
+            raise ValueError('Database Scheme is not Current. Run migrations or fix database by hand')
+        self.change_str = ""
+        for result in results:
+            if result.body is None:
+                continue
+            try:
+                with NBMetrics.metrics.stage("parse"):
+                    status = NBFeedParser.parse_feed(result.body, result.source, self.feed_ids)
+            except (ElmTree.ParseError, ValueError) as error:
+                logging.error("Feed %s could not be parsed: %s", result.source, error)
+                continue
+            if not status.has_master_data:
+                continue
+            master_sink = NBPipeline.MasterDataSink(self)
+            sinks = [master_sink, NBPipeline.AssignmentSink(self), NBPipeline.ChangeLogSink(self, master_sink)]
+            with NBMetrics.metrics.stage("master_update"):
+                NBPipeline.run_sinks(status.records(include_empty=True), sinks,
+                                     status.status_time or result.query_time)
+        return self.change_str
+
     def print_master_data(self):
         """Prints the list of stations from the current-status-xml-file on screen"""
         for domain in self.status_xml:
@@ -200,116 +347,14 @@ class NBMasterDataDB:
             print("----------------------------------------------------")
 
     def _check_migration(self):
-        """" Checks if the Database has the Scheme uses in  this script """
-        c = self.conn.cursor()
-        c.execute("SELECT name FROM admin_migrations ORDER BY name DESC LIMIT 1")
-        row = c.fetchone()
-        if row is None or row[0] != self.stations_master_migration:
-            return False
-        else:
-            return True
-
-    def _check_status_integrity(self):
-        try:
-            assert isinstance(self.status_xml, ElmTree.ElementTree)
-        except AssertionError:
-            self._parse_station_status()
-
-    def _update_city_table(self):
-        """"Writes general city data from a provided xml-file to the database"""
-        self._check_status_integrity()
-        c = self.conn.cursor()
-        for domain in self.status_xml:
-            for city in domain:
-                uid = city.attrib.get("uid")
-                name = city.attrib.get("name")
-                lat = city.attrib.get("lat")
-                lng = city.attrib.get("lng")
-                num_places = city.attrib.get("num_places")
-                # check if record already exists and insert if not
-                c.execute("SELECT 1 FROM city_data WHERE city_data.uid = ?", (uid,))
-                if len(c.fetchall()) < 1:
-                    c.execute("INSERT INTO city_data VALUES (?, ?, ?, ?, ?)", (uid, name, num_places, lat, lng))
-                    self.conn.commit()
-                    info = "New Insert to city_data for domain '{}': {} - '{}'".format(domain.attrib.get("name"), uid,
-                                                                                       name)
-                    logging.info(info)
-                    self.change_str += info + "\n"
-                    self.status_changed = True
-        self.conn.commit()
-
-    def _update_places_table(self):
-        """Writes general stations data from a provided xml-file to the database """
-        self._check_status_integrity()
-        c = self.conn.cursor()
-        for domain in self.status_xml:
-            for city in domain:
-                for place in city:
-                    uid = place.attrib.get("uid")
-                    number = place.attrib.get("number")
-                    name = place.attrib.get("name")
-                    bike_racks = place.attrib.get("bike_racks")
-                    spot = place.attrib.get("spot")
-                    lat = place.attrib.get("lat")
-                    lng = place.attrib.get("lng")
-                    terminal_type = place.attrib.get("terminal_type")
-                    # check if record already exists and insert if not
-                    c.execute("SELECT 1 FROM places_data WHERE places_data.uid = ?", (uid,))
-                    if len(c.fetchall()) < 1: # record did not exist
-                        c.execute("INSERT INTO places_data VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                                  (uid, number, spot, name, bike_racks, lat, lng, terminal_type,
-                                   datetime.date.today(), datetime.date.today()))
-                        info = "New Insert to places_data for city '{}' in domain '{}': {} - '{}'".format(
-                            city.attrib.get("name"), domain.attrib.get("name"), uid, name)
-                        logging.info(info)
-                        self.change_str += info + "\n"
-                        self.status_changed = True
-                    else: #record existed, update last seen
-                        c.execute("UPDATE places_data SET last_seen = ? WHERE uid = ?", (datetime.date.today(), uid))
-        self.conn.commit()
-
-    def _update_domain_table(self):
-        """"Writes general country data from a provided xml-file to the database """
-        self._check_status_integrity()
-        c = self.conn.cursor()
-        for domain in self.status_xml:
-            domain_item = domain.attrib.get("domain")
-            name = domain.attrib.get("name")
-            country = domain.attrib.get("country")
-            lat = domain.attrib.get("lat")
-            lng = domain.attrib.get("lng")
-            # check if record already exists and insert if not
-            c.execute("SELECT 1 FROM domain_data WHERE domain_data.domain = ?", (domain_item,))
-            if len(c.fetchall()) < 1:
-                c.execute("INSERT INTO domain_data VALUES (?, ?, ?, ?, ?)",
-                          (domain_item, name, country, lat, lng))
-                info = "New Insert to domain_data: '{}' - '{}'".format(domain_item, name)
-                logging.info(info)
-                self.change_str += info + "\n"
-                self.status_changed = True
-        self.conn.commit()
-
-    def _update_cities_domain_assign_table(self):
-        """"Writes teh relation between cities and countries from a provided xml-file to the database"""
-        self._check_status_integrity()
-        c = self.conn.cursor()
-        for domain in self.status_xml:
-            for city in domain:
-                domain_item = domain.attrib.get("domain")
-                city_uid = city.attrib.get("uid")
-                c.execute("INSERT OR IGNORE INTO cities_domains_assignment VALUES (?,?)",
-                          (domain_item, city_uid))
-        self.conn.commit()
-
-    def _update_places_cities_assign_table(self):
-        """"Writes the relation between places and cities from a provided xml-file to the database """
-        self._check_status_integrity()
-        c = self.conn.cursor()
-        for domain in self.status_xml:
-            for city in domain:
-                for place in city:
-                    place_uid = place.attrib.get("uid")
-                    city_uid = city.attrib.get("uid")
-                    c.execute("INSERT OR IGNORE INTO places_cities_assignment VALUES (?, ?)",
-                              (place_uid, city_uid))
-        self.conn.commit()
+        """" Checks if the Database has the Scheme uses in  this script, that is no migration of the master data is
+        pending """
+        return not NBMigrations.NBMigrationRunner(self.conn, "master").pending()
+
+    def _update_tables(self):
+        """"Writes general domain, city and stations data and their relations from the current xml-file to the
+        database. The tree is walked once and every place is passed to the master data, assignment and change log
+        sinks, which only insert new records, in a single transaction"""
+        master_sink = NBPipeline.MasterDataSink(self)
+        sinks = [master_sink, NBPipeline.AssignmentSink(self), NBPipeline.ChangeLogSink(self, master_sink)]
+        NBPipeline.run_sinks(self.status_records(include_empty=True), sinks, self.status_time)
@@ -0,0 +1,85 @@
+import collections
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+
+
+class NBMetrics:
+    """Collects the duration of the stages and the counters of a run and exports them as Prometheus text file and as
+    JSON-lines log. Stages slower than a threshold are logged. Stages and counters may be reported from several
+    threads"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.prometheus_dir = None
+        self.jsonl_file = None
+        self.slow_stage_ms = None
+        self.reset()
+
+    def configure(self, prometheus_dir=None, jsonl_file=None, slow_stage_ms=None):
+        """Sets the outputs, a run is only exported to the outputs which are set"""
+        self.prometheus_dir = prometheus_dir
+        self.jsonl_file = jsonl_file
+        self.slow_stage_ms = slow_stage_ms
+
+    def reset(self):
+        """Starts a new run"""
+        self.stages = collections.OrderedDict()
+        self.counters = collections.OrderedDict()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Times the enclosed block as stage name, the times of a stage which runs several times are added up"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name, duration):
+        """Adds duration (seconds) to the stage name, for stages timed elsewhere, e.g. in worker processes"""
+        with self._lock:
+            self.stages[name] = self.stages.get(name, 0.0) + duration
+        if self.slow_stage_ms is not None and duration * 1000 > self.slow_stage_ms:
+            logging.warning("Slow stage '%s': %.0f ms (threshold %s ms)", name, duration * 1000, self.slow_stage_ms)
+
+    def count(self, name, value=1):
+        """Adds value to the counter name"""
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def write(self, job):
+        """Exports the current run of job to the configured outputs and starts a new run"""
+        with self._lock:
+            stages, counters = self.stages, self.counters
+            self.reset()
+
+        if self.jsonl_file:
+            with open(self.jsonl_file, "a") as file:
+                file.write(json.dumps({"job": job, "time": int(time.time()), "stages": stages,
+                                       "counters": counters}) + "\n")
+
+        if self.prometheus_dir:
+            lines = ["# HELP nb_stage_seconds Duration of the stages of the last run",
+                     "# TYPE nb_stage_seconds gauge"]
+            for stage, duration in stages.items():
+                lines.append('nb_stage_seconds{{job="{}",stage="{}"}} {:.6f}'.format(job, stage, duration))
+            for counter, value in counters.items():
+                lines.append("# TYPE nb_{} gauge".format(counter))
+                lines.append('nb_{}{{job="{}"}} {}'.format(counter, job, value))
+            lines.append("# TYPE nb_last_run_timestamp_seconds gauge")
+            lines.append('nb_last_run_timestamp_seconds{{job="{}"}} {}'.format(job, int(time.time())))
+
+            # written under a temporary name, so a collector never reads a partial file
+            os.makedirs(self.prometheus_dir, exist_ok=True)
+            path = os.path.join(self.prometheus_dir, "nb_{}.prom".format(job))
+            with open(path + ".tmp", "w") as file:
+                file.write("\n".join(lines) + "\n")
+            os.replace(path + ".tmp", path)
+
+
+# metrics of the running process, library code reports to it like to the logging module
+metrics = NBMetrics()
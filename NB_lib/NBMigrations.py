@@ -0,0 +1,209 @@
+import time
+
+from NB_lib import NBMetrics, NBStorageBackend
+
+
+class NBMigration:
+    """One change of the layout of a database. Migrations are applied in the order of their names, the name is
+    recorded in admin_migrations of the database once the migration is done. Large tables are copied in steps: start
+    prepares the copy, step copies one batch and returns the position to continue from, finish completes the
+    migration in a single short transaction. Every step is committed together with its position, so an interrupted
+    migration continues where it stopped"""
+
+    name = None
+    # 'master' or 'transactions'
+    database = None
+    backends = ("sqlite",)
+
+    def needed(self, conn, schema):
+        """Returns false if the database already has the layout of the migration, it is then only recorded"""
+        return True
+
+    def start(self, conn, schema):
+        """Prepares the copy, called again when an interrupted migration is continued"""
+
+    def step(self, conn, schema, position, batch_size):
+        """Copies the next batch of at most batch_size rows from position, returns the next position or None if
+        everything has been copied"""
+        return None
+
+    def finish(self, conn, schema, position):
+        """Completes the migration, called inside a transaction which holds the write lock of the database"""
+        raise NotImplementedError
+
+
+class PlaceFirstLastSeen(NBMigration):
+    """Adds the first_seen and last_seen dates of places to the master data"""
+
+    name = "0001_PALACE_FIRST_SEEN_LAST_SEEN"
+    database = "master"
+
+    def needed(self, conn, schema):
+        c = conn.cursor()
+        c.execute("PRAGMA {}.table_info(places_data)".format(schema))
+        columns = [row[1] for row in c.fetchall()]
+        return bool(columns) and "first_seen" not in columns
+
+    def finish(self, conn, schema, position):
+        c = conn.cursor()
+        c.execute("ALTER TABLE {}.places_data ADD COLUMN first_seen TIMESTAMP".format(schema))
+        c.execute("UPDATE {}.places_data SET first_seen = current_date".format(schema))
+        c.execute("ALTER TABLE {}.places_data ADD COLUMN last_seen TIMESTAMP".format(schema))
+        c.execute("UPDATE {}.places_data SET last_seen = current_date".format(schema))
+
+
+class ClusteredStationsFill(NBMigration):
+    """Rewrites stations_fill from the row store with its unique and covering indexes into the clustered layout, which
+    keeps a single copy of every row ordered by place and time. Triggers mirror every row written to the old table
+    while its rows are copied in rowid ranges, so the crawler keeps writing during the copy and is only blocked by the
+    final swap of the tables"""
+
+    name = "0002_STATIONS_FILL_CLUSTERED"
+    database = "transactions"
+    table = "stations_fill_clustered"
+
+    def __init__(self):
+        self.backend = NBStorageBackend.get_backend("sqlite")
+
+    def needed(self, conn, schema):
+        return self.backend.table_exists(conn, schema, "stations_fill") and not self.backend.is_clustered(conn, schema)
+
+    def start(self, conn, schema):
+        self.backend.create_clustered_fill_table(conn, schema, self.table)
+        c = conn.cursor()
+        # the old table is dropped by the swap, its triggers with it
+        c.execute("CREATE TRIGGER IF NOT EXISTS {0}.`{1}_insert` AFTER INSERT ON stations_fill BEGIN "
+                  "INSERT OR IGNORE INTO `{1}` VALUES (NEW.timestamp, NEW.place_uid, NEW.bikes, NEW.free_racks); END"
+                  .format(schema, self.table))
+        c.execute("CREATE TRIGGER IF NOT EXISTS {0}.`{1}_delete` AFTER DELETE ON stations_fill BEGIN "
+                  "DELETE FROM `{1}` WHERE place_uid = OLD.place_uid AND timestamp = OLD.timestamp; END"
+                  .format(schema, self.table))
+        c.execute("CREATE TRIGGER IF NOT EXISTS {0}.`{1}_update` AFTER UPDATE ON stations_fill BEGIN "
+                  "DELETE FROM `{1}` WHERE place_uid = OLD.place_uid AND timestamp = OLD.timestamp; "
+                  "INSERT OR REPLACE INTO `{1}` VALUES (NEW.timestamp, NEW.place_uid, NEW.bikes, NEW.free_racks); END"
+                  .format(schema, self.table))
+
+    def step(self, conn, schema, position, batch_size):
+        c = conn.cursor()
+        c.execute("SELECT MAX(rowid) FROM {}.stations_fill".format(schema))
+        last = c.fetchone()[0]
+        position = position or 0
+        if last is None or position >= last:
+            return None
+        # values are cast, so rows written as text or real by old versions are stored as integers
+        c.execute("INSERT OR IGNORE INTO {0}.`{1}` SELECT CAST(timestamp AS INTEGER), CAST(place_uid AS INTEGER), "
+                  "CAST(bikes AS INTEGER), CAST(free_racks AS INTEGER) FROM {0}.stations_fill "
+                  "WHERE rowid > ? AND rowid <= ?".format(schema, self.table), (position, position + batch_size))
+        return position + batch_size
+
+    def finish(self, conn, schema, position):
+        # rows added before the triggers existed and after the last step are copied under the write lock
+        while position is not None:
+            position = self.step(conn, schema, position, 1000000)
+        c = conn.cursor()
+        c.execute("DROP TABLE {}.stations_fill".format(schema))
+        c.execute("ALTER TABLE {}.`{}` RENAME TO `stations_fill`".format(schema, self.table))
+        self.backend.create_rollup_triggers(conn, schema)
+
+
+def discover(database):
+    """Returns instances of all migrations of database ('master' or 'transactions') ordered by their names"""
+    def subclasses(cls):
+        for subclass in cls.__subclasses__():
+            yield subclass
+            yield from subclasses(subclass)
+    return sorted((migration() for migration in subclasses(NBMigration) if migration.database == database),
+                  key=lambda migration: migration.name)
+
+
+class NBMigrationRunner:
+    """Applies the pending migrations of a database. Applied migrations are recorded in admin_migrations, the position
+    of a migration in progress in admin_migration_progress of the same database"""
+
+    def __init__(self, conn, database, schema="main", backend="sqlite", batch_size=50000, pause=0.0):
+        """"Takes the connection and schema of the database, database is 'master' or 'transactions'. Rows are copied
+        in batches of batch_size rows, after every batch the runner sleeps for pause seconds, so other writers get
+        the database in between"""
+        self.conn = conn
+        self.database = database
+        self.schema = schema
+        self.backend = backend
+        self.batch_size = batch_size
+        self.pause = pause
+
+        c = self.conn.cursor()
+        c.execute("CREATE TABLE IF NOT EXISTS {}.`admin_migrations` (`id` INTEGER PRIMARY KEY , `name` TEXT NOT NULL"
+                  ", `applied` TIMESTAMP NOT NULL)".format(schema))
+        c.execute("CREATE TABLE IF NOT EXISTS {}.`admin_migration_progress` (`name` TEXT NOT NULL PRIMARY KEY, "
+                  "`position` INTEGER, `updated` TIMESTAMP NOT NULL)".format(schema))
+        self.conn.commit()
+
+    def applied(self):
+        """Returns the names of all migrations recorded in the database"""
+        c = self.conn.cursor()
+        c.execute("SELECT name FROM {}.admin_migrations".format(self.schema))
+        return set(name for name, in c.fetchall())
+
+    def pending(self):
+        """Returns the migrations which are neither recorded nor written for another backend, in their order"""
+        applied = self.applied()
+        return [migration for migration in discover(self.database)
+                if migration.name not in applied and self.backend in migration.backends]
+
+    def _position(self, migration):
+        c = self.conn.cursor()
+        c.execute("SELECT position FROM {}.admin_migration_progress WHERE name = ?".format(self.schema),
+                  (migration.name,))
+        row = c.fetchone()
+        return None if row is None else row[0]
+
+    def _record(self, migration):
+        c = self.conn.cursor()
+        c.execute("DELETE FROM {}.admin_migration_progress WHERE name = ?".format(self.schema), (migration.name,))
+        c.execute("INSERT INTO {}.admin_migrations VALUES (NULL, ?, current_timestamp)".format(self.schema),
+                  (migration.name,))
+
+    def run(self, max_batches=None):
+        """Applies all pending migrations in their order. With max_batches, at most that many batches are copied,
+        an unfinished migration is continued by the next run. Returns the names of the migrations applied"""
+        done = list()
+        num_batches = 0
+        with NBMetrics.metrics.stage("migrate"):
+            for migration in self.pending():
+                if not migration.needed(self.conn, self.schema):
+                    # databases created with the layout of the migration only record it
+                    self._record(migration)
+                    self.conn.commit()
+                    continue
+
+                migration.start(self.conn, self.schema)
+                self.conn.commit()
+                position = self._position(migration)
+                while True:
+                    if max_batches is not None and num_batches >= max_batches:
+                        return done
+                    next_position = migration.step(self.conn, self.schema, position, self.batch_size)
+                    if next_position is None:
+                        break
+                    position = next_position
+                    self.conn.cursor().execute("INSERT OR REPLACE INTO {}.admin_migration_progress "
+                                               "VALUES (?, ?, current_timestamp)".format(self.schema),
+                                               (migration.name, position))
+                    self.conn.commit()
+                    num_batches += 1
+                    NBMetrics.metrics.count("migration_batches")
+                    if self.pause:
+                        time.sleep(self.pause)
+
+                # the swap takes the write lock at once, so it cannot fail half way for a concurrent writer
+                self.conn.commit()
+                self.conn.cursor().execute("BEGIN IMMEDIATE")
+                try:
+                    migration.finish(self.conn, self.schema, position)
+                    self._record(migration)
+                except NBStorageBackend.ERRORS:
+                    self.conn.rollback()
+                    raise
+                self.conn.commit()
+                done.append(migration.name)
+        return done
@@ -0,0 +1,326 @@
+import datetime
+import logging
+import xml.etree.ElementTree as ElmTree
+
+from NB_lib import NBMetrics, NBStationsDataDB, NBStorageBackend
+
+
+class NBSink:
+    """Receives every place record of a status during the walk and writes its results once the walk is finished.
+    Sinks only write inside the open transaction of their connection, run_sinks commits or rolls back all of them"""
+
+    conn = None
+
+    def add(self, record):
+        pass
+
+    def finish(self, status_time):
+        pass
+
+    def abort(self):
+        """Called after the transaction of the sink has been rolled back"""
+        pass
+
+
+class MasterDataSink(NBSink):
+    """Inserts new domains, cities and places into the master data and updates the last seen date of the places still
+    in the status. The existing keys are loaded once, so only new records are written"""
+
+    def __init__(self, master_db):
+        self.master_db = master_db
+        self.conn = master_db.conn
+        c = self.conn.cursor()
+        c.execute("SELECT domain FROM domain_data")
+        self.domains = set(row[0] for row in c.fetchall())
+        c.execute("SELECT uid FROM city_data")
+        self.cities = set(row[0] for row in c.fetchall())
+        c.execute("SELECT uid FROM places_data")
+        self.places = set(row[0] for row in c.fetchall())
+        self.existing_places = set(self.places)
+        self.seen_places = set()
+
+        self.new_domains, self.new_cities, self.new_places = list(), list(), list()
+        self.domain_info, self.city_info, self.place_info = list(), list(), list()
+        self.today = datetime.date.today()
+
+    @property
+    def changes(self):
+        """Messages of all new records, in the order the tables are written"""
+        return self.domain_info + self.city_info + self.place_info
+
+    def add(self, record):
+        domain_item = record.domain.get("domain")
+        domain_name = record.domain.get("name")
+        if domain_item not in self.domains:
+            self.domains.add(domain_item)
+            self.new_domains.append((domain_item, domain_name, record.domain.get("country"),
+                                     record.domain.get("lat"), record.domain.get("lng")))
+            self.domain_info.append("New Insert to domain_data: '{}' - '{}'".format(domain_item, domain_name))
+        if record.city is None:
+            return
+
+        city_uid = int(record.city.get("uid"))
+        city_name = record.city.get("name")
+        if city_uid not in self.cities:
+            self.cities.add(city_uid)
+            self.new_cities.append((city_uid, city_name, record.city.get("num_places"),
+                                    record.city.get("lat"), record.city.get("lng")))
+            self.city_info.append("New Insert to city_data for domain '{}': {} - '{}'".format(domain_name, city_uid,
+                                                                                           city_name))
+        if record.place is None:
+            return
+
+        uid = int(record.place.get("uid"))
+        name = record.place.get("name")
+        self.seen_places.add(uid)
+        if uid not in self.places:
+            self.places.add(uid)
+            self.new_places.append((uid, record.place.get("number"), record.place.get("spot"), name,
+                                    record.place.get("bike_racks"), record.place.get("lat"),
+                                    record.place.get("lng"), record.place.get("terminal_type"), self.today,
+                                    self.today))
+            self.place_info.append("New Insert to places_data for city '{}' in domain '{}': {} - '{}'".format(
+                city_name, domain_name, uid, name))
+
+    def finish(self, status_time):
+        # places which existed before and are still in the status get a new last seen date, vanished ones are kept
+        still_present = self.existing_places & self.seen_places
+        self.master_db.vanished_places = sorted(self.existing_places - self.seen_places)
+
+        backend = self.master_db.backend
+        # records written meanwhile, e.g. by another crawler, are updated, the first seen date of a place is kept
+        backend.insert_rows(self.conn, "domain_data", self.new_domains, ("domain",),
+                            ("name", "country", "latitude", "longitude"))
+        backend.insert_rows(self.conn, "city_data", self.new_cities, ("uid",),
+                            ("name", "num_places", "latitude", "longitude"))
+        backend.insert_rows(self.conn, "places_data", self.new_places, ("uid",),
+                            ("number", "spot", "name", "bike_racks", "latitude", "longitude", "terminal_type",
+                             "last_seen"))
+        backend.update_rows(self.conn, "places_data", ("last_seen",), "uid",
+                            ((self.today, uid) for uid in still_present))
+        if self.new_places:
+            self.master_db.spatial_index = None
+
+
+class AssignmentSink(NBSink):
+    """Inserts new assignments of places to cities and of cities to domains"""
+
+    def __init__(self, master_db):
+        self.backend = master_db.backend
+        self.conn = master_db.conn
+        c = self.conn.cursor()
+        c.execute("SELECT domain, city_uid FROM cities_domains_assignment")
+        self.cities_domains = set(c.fetchall())
+        c.execute("SELECT place_uid, city_uid FROM places_cities_assignment")
+        self.places_cities = set(c.fetchall())
+        self.new_cities_domains, self.new_places_cities = list(), list()
+
+    def add(self, record):
+        if record.city is None:
+            return
+        city_uid = int(record.city.get("uid"))
+        key = (record.domain.get("domain"), city_uid)
+        if key not in self.cities_domains:
+            self.cities_domains.add(key)
+            self.new_cities_domains.append(key)
+        if record.place is None:
+            return
+        key = (int(record.place.get("uid")), city_uid)
+        if key not in self.places_cities:
+            self.places_cities.add(key)
+            self.new_places_cities.append(key)
+
+    def finish(self, status_time):
+        self.backend.insert_rows(self.conn, "cities_domains_assignment", self.new_cities_domains,
+                                 ("domain", "city_uid"))
+        self.backend.insert_rows(self.conn, "places_cities_assignment", self.new_places_cities,
+                                 ("place_uid", "city_uid"))
+
+
+class ChangeLogSink(NBSink):
+    """Logs the new records found by a MasterDataSink and adds them to the change string of the master data"""
+
+    def __init__(self, master_db, master_sink):
+        self.master_db = master_db
+        self.master_sink = master_sink
+
+    def finish(self, status_time):
+        for info in self.master_sink.changes:
+            logging.info(info)
+            self.master_db.change_str += info + "\n"
+            self.master_db.status_changed = True
+
+
+class FillSink(NBSink):
+    """Collects (place_uid, bikes, free_racks) rows and adds them to stations_fill with the time of query, if an
+    NBPlaceFilter is given only rows of its places"""
+
+    def __init__(self, stations_db, place_filter=None):
+        self.stations_db = stations_db
+        # in the spooled mode the rows are handed to the writer thread, which commits them itself
+        self.conn = stations_db.conn if stations_db.spool is None else None
+        self.place_filter = place_filter
+        self.rows = list()
+        self.touched = None
+
+    def add(self, record):
+        if record.place is None:
+            return
+        row = NBStationsDataDB.fill_values(record.place)
+        if self.place_filter is None or row[0] in self.place_filter:
+            self.rows.append(row)
+
+    def finish(self, status_time):
+        self.touched = self.stations_db.add_fill_rows(self.rows, status_time, commit=False)
+
+    def abort(self):
+        if self.touched is not None:
+            # the written rows were rolled back, so the states in memory of their places are set back
+            self.stations_db._restore_states(self.touched)
+
+
+def run_sinks(records, sinks, status_time=None):
+    """Walks the records once and passes every record to all sinks, then finishes the sinks in their order and commits
+    their connections. If anything goes wrong, all connections are rolled back. Without a status_time, the time of
+    query of the records (a status stream) is used once they have been read"""
+    with NBMetrics.metrics.stage("walk"):
+        for record in records:
+            for sink in sinks:
+                sink.add(record)
+
+    if status_time is None:
+        status_time = getattr(records, "status_time", None)
+    if status_time is None:
+        raise ValueError("Status stream does not contain a time of query")
+
+    connections = list()
+    for sink in sinks:
+        if sink.conn is not None and sink.conn not in connections:
+            connections.append(sink.conn)
+    try:
+        with NBMetrics.metrics.stage("write"):
+            for sink in sinks:
+                sink.finish(status_time)
+    except NBStorageBackend.ERRORS + (ValueError,):
+        for conn in connections:
+            conn.rollback()
+        for sink in sinks:
+            sink.abort()
+        raise
+    for conn in connections:
+        conn.commit()
+
+
+class NBPipeline:
+    """Fetches the status once per cycle and walks it once, every place record is dispatched to the active sinks:
+    'master' (domain, city and places data), 'assignments' (places-cities and cities-domains), 'changes' (logging of
+    new master data, requires 'master') and 'fill' (stations_fill rows)"""
+
+    SINKS = ("master", "assignments", "changes", "fill")
+    MASTER_SINKS = ("master", "assignments", "changes")
+
+    def __init__(self, master_db, stations_db=None, sinks=SINKS, place_filter=None, streaming=False):
+        """"Takes the NBMasterDataDB to fetch with and the NBStationsDataDB for the 'fill' sink. A places list or
+        NBPlaceFilter restricts the fill rows, if no master data sink is active the walk also skips the cities
+        without selected places. If streaming is true, the records are walked while the download is running"""
+        unknown = set(sinks) - set(self.SINKS)
+        if unknown:
+            raise ValueError("Unknown sinks: {}".format(", ".join(sorted(unknown))))
+        if "fill" in sinks and stations_db is None:
+            raise ValueError("The 'fill' sink needs a stations database")
+        if "changes" in sinks and "master" not in sinks:
+            raise ValueError("The 'changes' sink needs the 'master' sink")
+
+        self.master_db = master_db
+        self.stations_db = stations_db
+        self.sinks = tuple(sinks)
+        self.streaming = streaming
+        self.place_filter = stations_db._place_filter(place_filter) if stations_db is not None else None
+
+    def _create_sinks(self, names):
+        sinks = list()
+        master_sink = None
+        if "master" in names:
+            master_sink = MasterDataSink(self.master_db)
+            sinks.append(master_sink)
+        if "assignments" in names:
+            sinks.append(AssignmentSink(self.master_db))
+        if "changes" in names:
+            sinks.append(ChangeLogSink(self.master_db, master_sink))
+        if "fill" in names:
+            sinks.append(FillSink(self.stations_db, self.place_filter))
+        return sinks
+
+    def _updates_master(self, names):
+        return any(name in self.MASTER_SINKS for name in names)
+
+    def _walk_filter(self, names):
+        """The walk may only skip cities if no master data sink is active"""
+        return None if self._updates_master(names) else self.place_filter
+
+    def run(self):
+        """Runs one cycle, returns the time of query of the status, or None if nothing had to be done because the
+        status did not change since the last cycle"""
+        if self._updates_master(self.sinks):
+            if not self.master_db._check_migration():
+                raise ValueError('Database Scheme is not Current. Run migrations or fix database by hand')
+            self.master_db.change_str = ""
+        if self.streaming:
+            return self._run_stream()
+        return self._run_tree()
+
+    def _run_tree(self):
+        """Downloads and parses the status, if its content changed, and walks its records. Sinks whose consumers have
+        seen the content before are left out"""
+        master_db = self.master_db
+        master_db._refresh_station_status()
+        content_hash = master_db.parsed_hash
+
+        names = list()
+        for name in self.sinks:
+            if name == "fill":
+                if self.stations_db.ingested_hash is None or self.stations_db.ingested_hash != content_hash:
+                    names.append(name)
+            elif master_db.master_hash is None or master_db.master_hash != content_hash:
+                names.append(name)
+        if not names:
+            return None
+
+        records = master_db.status_records(place_filter=self._walk_filter(names),
+                                           include_empty=self._updates_master(names))
+        run_sinks(records, self._create_sinks(names), master_db.status_time)
+
+        if "fill" in names:
+            self.stations_db.ingested_hash = content_hash
+        if self._updates_master(names):
+            master_db.master_hash = content_hash
+        return master_db.status_time
+
+    def _run_stream(self):
+        """Streams the status and walks the records while they are downloaded. Nothing is written before the stream
+        has been read completely, so corrupt downloads are simply tried again. The status is archived once it has been
+        committed, outside of the retries, so a failure to archive it never writes it a second time"""
+        num_tries = 0
+        while True:
+            stream = self.master_db.stream_station_status(place_filter=self._walk_filter(self.sinks),
+                                                          include_empty=self._updates_master(self.sinks))
+            if stream is None:
+                # server reported the status as unchanged
+                return None
+            with stream:
+                try:
+                    run_sinks(stream, self._create_sinks(self.sinks))
+                    written = True
+                except (ElmTree.ParseError, ValueError) as error:
+                    written = False
+                # the archive reads the content kept by the stream, so it is committed before the stream is closed
+                if written:
+                    self.master_db.archive_stream(stream)
+            if written:
+                return stream.status_time
+            num_tries += 1
+            if num_tries >= 10:
+                raise ValueError('Could not get Station Data or Parse received XML-File')
+            NBMetrics.metrics.count("parse_retries")
+            logging.warning("Streaming the status failed in try %s, trying again: %s", num_tries, error)
+            self.master_db.fetcher.backoff(num_tries)
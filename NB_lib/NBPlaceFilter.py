@@ -0,0 +1,47 @@
+class NBPlaceFilter:
+    """Compiled selection of places: a frozenset of integer place uids together with the cities and domains which
+    contain them, so whole cities and domains without selected places can be skipped while reading a status"""
+
+    def __init__(self, places_list, master_db):
+        """"Takes a list of place uids (as int or str) and the NBMasterDataDB to look up their cities and domains"""
+        self.places = frozenset(int(place) for place in places_list)
+
+        cities = set()
+        domains = set()
+        c = master_db.conn.cursor()
+        places = sorted(self.places)
+        # sqlite limits the number of parameters of a statement, so the places are looked up in chunks
+        for start in range(0, len(places), 500):
+            chunk = places[start:start + 500]
+            c.execute("SELECT DISTINCT places_cities_assignment.city_uid, cities_domains_assignment.domain "
+                      "FROM places_cities_assignment LEFT JOIN cities_domains_assignment "
+                      "ON cities_domains_assignment.city_uid = places_cities_assignment.city_uid "
+                      "WHERE places_cities_assignment.place_uid IN ({})".format(", ".join("?" * len(chunk))), chunk)
+            for city_uid, domain in c.fetchall():
+                cities.add(city_uid)
+                domains.add(domain)
+        self.cities = frozenset(cities)
+        self.domains = frozenset(domains)
+
+    @classmethod
+    def from_sets(cls, places, cities, domains):
+        """Returns a filter of already resolved places, cities and domains, without looking them up"""
+        place_filter = cls.__new__(cls)
+        place_filter.places = frozenset(places)
+        place_filter.cities = frozenset(cities)
+        place_filter.domains = frozenset(domains)
+        return place_filter
+
+    def __len__(self):
+        return len(self.places)
+
+    def __contains__(self, place_uid):
+        return place_uid in self.places
+
+    def wants_domain(self, domain):
+        """Returns true if the domain (attributes of its xml-element) contains selected places"""
+        return domain.get("domain") in self.domains
+
+    def wants_city(self, city):
+        """Returns true if the city (attributes of its xml-element) contains selected places"""
+        return int(city.get("uid")) in self.cities
@@ -0,0 +1,138 @@
+import collections
+import datetime
+import os
+import shutil
+import urllib.parse
+
+
+def period_range(timestamp, period):
+    """Returns (name, start, end) of the 'day', 'month' or 'year' (UTC) the unix timestamp falls in, the end of a
+    period is the start of the next one"""
+    time = datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc)
+    if period == "day":
+        start = time.replace(hour=0, minute=0, second=0, microsecond=0)
+        end = start + datetime.timedelta(days=1)
+        name = start.strftime("%Y-%m-%d")
+    elif period == "month":
+        start = time.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        end = (start + datetime.timedelta(days=32)).replace(day=1)
+        name = start.strftime("%Y-%m")
+    elif period == "year":
+        start = time.replace(month=1, day=1, hour=0, minute=0, second=0, microsecond=0)
+        end = start.replace(year=start.year + 1)
+        name = start.strftime("%Y")
+    else:
+        raise ValueError("Unknown shard period '{}'".format(period))
+    return name, int(start.timestamp()), int(end.timestamp())
+
+
+class NBShardCatalog:
+    """Catalog of the shard files of a transactions database: every period of time is written into a database file of
+    its own, which is attached to the connection of the transactions database while it is used. The catalog table is
+    kept in the main database, at most max_attached shards are attached at once"""
+
+    PERIODS = ("day", "month", "year")
+
+    def __init__(self, conn, directory, period="month", prepare=None, max_attached=8):
+        """"Takes the connection of the main database and the directory of the shard files. prepare is called with
+        the schema name of every writable shard once it is attached, to set it up"""
+        if period not in self.PERIODS:
+            raise ValueError("Unknown shard period '{}'".format(period))
+        self.conn = conn
+        self.directory = directory
+        self.period = period
+        self.prepare = prepare
+        # sqlite attaches at most 10 databases by default
+        self.max_attached = max_attached
+        self._attached = collections.OrderedDict()
+        # range of the shard written last, most writes go to the same shard
+        self._current = (None, 0, 0)
+        os.makedirs(directory, exist_ok=True)
+
+        c = self.conn.cursor()
+        c.execute("CREATE TABLE IF NOT EXISTS `shard_catalog` ( `name` TEXT NOT NULL, `path` TEXT NOT NULL, "
+                  "`start` INTEGER NOT NULL, `end` INTEGER NOT NULL, `read_only` INTEGER NOT NULL DEFAULT 0, "
+                  "PRIMARY KEY(`name`) )")
+        self.conn.commit()
+
+    @staticmethod
+    def schema_name(name):
+        return "shard_" + name.replace("-", "_")
+
+    def shards(self, start=None, end=None, newest_first=False):
+        """Returns (name, path, start, end, read_only) of the shards overlapping start to end (unix timestamps, both
+        included and optional) in chronological order, or the newest first"""
+        c = self.conn.cursor()
+        c.execute("SELECT name, path, start, end, read_only FROM shard_catalog WHERE end > ? AND start <= ? "
+                  "ORDER BY start {}".format("DESC" if newest_first else "ASC"),
+                  (start if start is not None else -2 ** 62, end if end is not None else 2 ** 62))
+        return c.fetchall()
+
+    def _attach(self, name, path, read_only):
+        """Attaches a shard, if it is not attached yet, and returns its schema name. Attaching is not possible within
+        a transaction, so pending writes are committed first"""
+        schema = self.schema_name(name)
+        if schema in self._attached:
+            self._attached.move_to_end(schema)
+            return schema
+
+        self.conn.commit()
+        while len(self._attached) >= self.max_attached:
+            self.conn.execute('DETACH DATABASE "{}"'.format(self._attached.popitem(last=False)[0]))
+        uri = "file:" + urllib.parse.quote(os.path.abspath(path)) + ("?mode=ro" if read_only else "")
+        self.conn.execute('ATTACH DATABASE ? AS "{}"'.format(schema), (uri,))
+        self._attached[schema] = name
+        if not read_only and self.prepare is not None:
+            self.prepare(schema)
+            self.conn.commit()
+        return schema
+
+    def schema_for(self, timestamp):
+        """Returns the schema name of the shard for the unix timestamp, the shard is created if it does not exist"""
+        name, start, end = self._current
+        if name is None or not start <= timestamp < end or self.schema_name(name) not in self._attached:
+            name, start, end = period_range(timestamp, self.period)
+            c = self.conn.cursor()
+            c.execute("SELECT path, read_only FROM shard_catalog WHERE name = ?", (name,))
+            row = c.fetchone()
+            if row is None:
+                row = (os.path.join(self.directory, "stations_fill_{}.db".format(name)), 0)
+                c.execute("INSERT INTO shard_catalog VALUES (?, ?, ?, ?, 0)", (name, row[0], start, end))
+            if row[1]:
+                raise ValueError("Shard '{}' is read-only".format(name))
+            self._attach(name, row[0], False)
+            self._current = (name, start, end)
+        return self.schema_name(name)
+
+    def schemas(self, start=None, end=None, newest_first=False, writable_only=False):
+        """Yields the schema names of the shards overlapping start to end, attaching them one after the other. A shard
+        may be detached again once the following ones are attached, so every schema has to be used before the next
+        one is taken. With writable_only, frozen shards are left out"""
+        for name, path, _, _, read_only in self.shards(start, end, newest_first):
+            if not (read_only and writable_only):
+                yield self._attach(name, path, read_only)
+
+    def _detach(self, name):
+        schema = self.schema_name(name)
+        if schema in self._attached:
+            self.conn.commit()
+            self.conn.execute('DETACH DATABASE "{}"'.format(schema))
+            del self._attached[schema]
+
+    def freeze(self, name):
+        """Marks a shard as read-only, it is attached read-only from now on and can be copied or backed up safely"""
+        self._detach(name)
+        self.conn.execute("UPDATE shard_catalog SET read_only = 1 WHERE name = ?", (name,))
+        self.conn.commit()
+
+    def relocate(self, name, path):
+        """Moves the file of a shard to path, e.g. to slower storage, and updates the catalog"""
+        c = self.conn.cursor()
+        c.execute("SELECT path FROM shard_catalog WHERE name = ?", (name,))
+        row = c.fetchone()
+        if row is None:
+            raise ValueError("Unknown shard '{}'".format(name))
+        self._detach(name)
+        shutil.move(row[0], path)
+        c.execute("UPDATE shard_catalog SET path = ? WHERE name = ?", (path, name))
+        self.conn.commit()
@@ -0,0 +1,117 @@
+import datetime
+import hashlib
+import lzma
+import os
+import sqlite3
+import tempfile
+
+
+class _TeeReader:
+    """Wraps the source of a status stream and compresses everything read from it into a temporary file, which becomes
+    an archive object once the stream is committed"""
+
+    def __init__(self, archive, source):
+        self.archive = archive
+        self.source = source
+        self.hash = hashlib.sha256()
+        self.size = 0
+        handle, self.tmp_path = tempfile.mkstemp(dir=archive.objects_dir, suffix=".tmp")
+        self.file = os.fdopen(handle, "wb")
+        self.compressed = lzma.LZMAFile(self.file, "wb", preset=archive.preset)
+
+    def read(self, size=-1):
+        data = self.source.read(size)
+        self.hash.update(data)
+        self.size += len(data)
+        self.compressed.write(data)
+        return data
+
+    def finish(self):
+        """Flushes the compressed content to the temporary file"""
+        if not self.compressed.closed:
+            self.compressed.close()
+            self.file.close()
+
+    def close(self):
+        """Closes the source, the temporary file is removed if the stream was not committed"""
+        self.source.close()
+        self.finish()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+
+class NBSnapshotArchive:
+    """Archive of raw status downloads. Every payload is stored lzma compressed under its sha256, so identical
+    payloads are stored once, an index database keeps the time of query of every snapshot"""
+
+    def __init__(self, directory, preset=6):
+        self.directory = directory
+        self.objects_dir = os.path.join(directory, "objects")
+        self.preset = preset
+        os.makedirs(self.objects_dir, exist_ok=True)
+
+        self.conn = sqlite3.connect(os.path.join(directory, "snapshots.db"))
+        c = self.conn.cursor()
+        c.execute("CREATE TABLE IF NOT EXISTS `objects` ( `hash` TEXT NOT NULL, `size` INTEGER NOT NULL, "
+                  "`stored_size` INTEGER NOT NULL, PRIMARY KEY(`hash`) )")
+        c.execute("CREATE TABLE IF NOT EXISTS `snapshots` ( `status_time` INTEGER NOT NULL, `hash` TEXT NOT NULL, "
+                  "`archived` TIMESTAMP NOT NULL, UNIQUE ( `status_time`, `hash`) )")
+        self.conn.commit()
+
+    def _object_path(self, content_hash):
+        return os.path.join(self.objects_dir, content_hash[:2], content_hash + ".xz")
+
+    def _index(self, content_hash, size, status_time):
+        """Adds the object (if new) and the snapshot to the index"""
+        c = self.conn.cursor()
+        stored_size = os.path.getsize(self._object_path(content_hash))
+        c.execute("INSERT OR IGNORE INTO objects VALUES (?, ?, ?)", (content_hash, size, stored_size))
+        c.execute("INSERT OR IGNORE INTO snapshots VALUES (?, ?, current_timestamp)",
+                  (int(status_time.timestamp()), content_hash))
+        self.conn.commit()
+
+    def add(self, payload, status_time):
+        """Stores a payload (bytes) with its time of query, returns its hash"""
+        content_hash = hashlib.sha256(payload).hexdigest()
+        path = self._object_path(content_hash)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # written under a temporary name first, so a crash never leaves a truncated object
+            with lzma.open(path + ".tmp", "wb", preset=self.preset) as file:
+                file.write(payload)
+            os.replace(path + ".tmp", path)
+        self._index(content_hash, len(payload), status_time)
+        return content_hash
+
+    def tee(self, source):
+        """Returns a reader of source, which archives everything read once it is passed to commit"""
+        return _TeeReader(self, source)
+
+    def commit(self, reader, status_time):
+        """Stores the content read through a tee reader with its time of query, returns its hash"""
+        reader.finish()
+        content_hash = reader.hash.hexdigest()
+        path = self._object_path(content_hash)
+        if os.path.exists(path):
+            os.remove(reader.tmp_path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(reader.tmp_path, path)
+        self._index(content_hash, reader.size, status_time)
+        return content_hash
+
+    def snapshots(self, start=None, end=None):
+        """Returns a list of (status_time, hash) of all snapshots from start to end (datetimes, both optional) in
+        chronological order"""
+        c = self.conn.cursor()
+        c.execute("SELECT status_time, hash FROM snapshots WHERE status_time >= ? AND status_time <= ? "
+                  "ORDER BY status_time",
+                  (int(start.timestamp()) if start else 0, int(end.timestamp()) if end else 2 ** 62))
+        return [(datetime.datetime.fromtimestamp(status_time), content_hash) for status_time, content_hash in c]
+
+    def open(self, content_hash):
+        """Returns a file-like object of the decompressed payload"""
+        return lzma.open(self._object_path(content_hash), "rb")
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,139 @@
+import math
+
+from NB_lib import NBTimeSeries
+
+# mean radius of the earth in metres
+EARTH_RADIUS = 6371008.8
+
+
+def haversine(lat, lng, lats, lngs):
+    """Returns the great circle distances in metres from the point lat, lng to the points of the arrays lats, lngs
+    (degrees), computed on the whole arrays at once"""
+    numpy = NBTimeSeries.numpy
+    lat, lng = math.radians(lat), math.radians(lng)
+    lats, lngs = numpy.radians(lats), numpy.radians(lngs)
+    a = numpy.sin((lats - lat) / 2) ** 2 + math.cos(lat) * numpy.cos(lats) * numpy.sin((lngs - lng) / 2) ** 2
+    return 2 * EARTH_RADIUS * numpy.arcsin(numpy.sqrt(numpy.minimum(a, 1.0)))
+
+
+class NBSpatialIndex:
+    """Grid index over the coordinates of places: the places are sorted by the grid cell they fall in and every cell
+    keeps the offset of its first place, like the partitions of the columnar archive. Queries only compute distances
+    for the places of the cells around the query, so their cost depends on the density of places, not on their
+    number"""
+
+    def __init__(self, uids, lats, lngs, cell_degrees=0.02):
+        """Takes the uids of the places and their latitudes and longitudes in degrees. cell_degrees is the size of
+        the grid cells, about 2 km at the default, which keeps cities spread over several cells"""
+        NBTimeSeries.require_numpy()
+        numpy = NBTimeSeries.numpy
+        self.cell_degrees = cell_degrees
+        self.num_columns = int(math.ceil(360 / cell_degrees))
+        self.num_rows = int(math.ceil(180 / cell_degrees))
+
+        uids = numpy.asarray(uids, dtype=numpy.int64)
+        lats = numpy.asarray(lats, dtype=numpy.float64)
+        lngs = numpy.asarray(lngs, dtype=numpy.float64)
+        cells = self._cells(lats, lngs)
+        order = numpy.argsort(cells, kind="stable")
+        self.uids, self.lats, self.lngs = uids[order], lats[order], lngs[order]
+        # first place of every occupied cell, the places of a cell end where the next cell starts
+        self.cells, self.offsets = numpy.unique(cells[order], return_index=True)
+        self.offsets = numpy.append(self.offsets, len(self.uids))
+
+    @classmethod
+    def from_rows(cls, rows, cell_degrees=0.02):
+        """Builds the index from (uid, latitude, longitude) rows, rows without coordinates are left out"""
+        rows = [row for row in rows if row[1] is not None and row[2] is not None]
+        return cls([row[0] for row in rows], [row[1] for row in rows], [row[2] for row in rows], cell_degrees)
+
+    def __len__(self):
+        return len(self.uids)
+
+    def _row(self, lats):
+        return NBTimeSeries.numpy.clip(((lats + 90) // self.cell_degrees).astype(NBTimeSeries.numpy.int64), 0,
+                                       self.num_rows - 1)
+
+    def _column(self, lngs):
+        return ((lngs + 180) // self.cell_degrees).astype(NBTimeSeries.numpy.int64) % self.num_columns
+
+    def _cells(self, lats, lngs):
+        return self._row(lats) * self.num_columns + self._column(lngs)
+
+    def _candidates(self, rows, columns):
+        """Returns the positions of all places in the cells of the given grid rows and columns"""
+        numpy = NBTimeSeries.numpy
+        if len(rows) * len(columns) > len(self.cells):
+            # large areas are matched against the occupied cells instead of looking up every cell of the area
+            row_mask = numpy.zeros(self.num_rows, dtype=bool)
+            row_mask[rows] = True
+            column_mask = numpy.zeros(self.num_columns, dtype=bool)
+            column_mask[columns] = True
+            found = numpy.nonzero(row_mask[self.cells // self.num_columns] &
+                                  column_mask[self.cells % self.num_columns])[0]
+        else:
+            wanted = (rows[:, None] * self.num_columns + columns[None, :]).ravel()
+            found = numpy.searchsorted(self.cells, wanted)
+            found = found[found < len(self.cells)]
+            found = numpy.unique(found[numpy.isin(self.cells[found], wanted)])
+        # positions of the places of all found cells, without a loop over the cells
+        starts = self.offsets[found]
+        counts = self.offsets[found + 1] - starts
+        return numpy.arange(counts.sum()) + numpy.repeat(starts - (numpy.cumsum(counts) - counts), counts)
+
+    def _column_range(self, west, east):
+        """Returns the grid columns from west to east, wrapping around the antimeridian if west is east of east"""
+        numpy = NBTimeSeries.numpy
+        if east < west:
+            east += 360
+        # one column more than the span, as west and east may lie anywhere in their cells
+        num_columns = int((east - west) // self.cell_degrees) + 2
+        if num_columns >= self.num_columns:
+            return numpy.arange(self.num_columns)
+        return (self._column(numpy.array([west], dtype=numpy.float64))[0] + numpy.arange(num_columns)) % \
+            self.num_columns
+
+    def within(self, lat, lng, radius):
+        """Returns the uids of all places within radius metres of lat, lng and their distances, nearest first"""
+        numpy = NBTimeSeries.numpy
+        lat_span = math.degrees(radius / EARTH_RADIUS)
+        south, north = lat - lat_span, lat + lat_span
+        rows = numpy.arange(self._row(numpy.array([south]))[0], self._row(numpy.array([north]))[0] + 1)
+        # meridians converge towards the poles, so the longitudes are widened for the latitude closest to a pole
+        widest = max(abs(south), abs(north))
+        if widest >= 90:
+            columns = numpy.arange(self.num_columns)
+        else:
+            lng_span = min(lat_span / math.cos(math.radians(widest)), 180)
+            columns = self._column_range(lng - lng_span, lng + lng_span)
+        candidates = self._candidates(rows, columns)
+        distances = haversine(lat, lng, self.lats[candidates], self.lngs[candidates])
+        inside = distances <= radius
+        candidates, distances = candidates[inside], distances[inside]
+        order = numpy.argsort(distances, kind="stable")
+        return self.uids[candidates[order]], distances[order]
+
+    def in_bbox(self, south, west, north, east):
+        """Returns the uids of all places inside the bounding box, a box with west east of east crosses the
+        antimeridian"""
+        numpy = NBTimeSeries.numpy
+        rows = numpy.arange(self._row(numpy.array([south]))[0], self._row(numpy.array([north]))[0] + 1)
+        candidates = self._candidates(rows, self._column_range(west, east))
+        lats, lngs = self.lats[candidates], self.lngs[candidates]
+        if west <= east:
+            inside = (lngs >= west) & (lngs <= east)
+        else:
+            inside = (lngs >= west) | (lngs <= east)
+        inside &= (lats >= south) & (lats <= north)
+        return numpy.sort(self.uids[candidates[inside]])
+
+    def nearest(self, lat, lng, n):
+        """Returns the uids of the n places nearest to lat, lng and their distances, nearest first. The search radius
+        starts at the size of a cell and is doubled until n places are found"""
+        radius = math.radians(self.cell_degrees) * EARTH_RADIUS
+        while True:
+            uids, distances = self.within(lat, lng, radius)
+            # the radius is a circle, so places found in it are always nearer than any place outside of it
+            if len(uids) >= n or radius >= math.pi * EARTH_RADIUS:
+                return uids[:n], distances[:n]
+            radius *= 2
@@ -0,0 +1,141 @@
+import collections
+import json
+import logging
+import os
+import threading
+import time
+
+from NB_lib import NBMetrics
+
+
+class NBSpool:
+    """Bounded queue of states waiting to be written, backed by a spool directory. Every state is written to its own
+    file before put returns, so a state survives a crash of the writer or of the whole process and is written when
+    the spool is opened again. The last queue_size states are also kept in memory, so the writer reads them without
+    touching the disk; states beyond that are read back from their files. Files are named by the time of query of
+    their state, so states are taken oldest first. With max_files, the spool holds at most that many states: once a
+    writer falls that far behind, the oldest states are dropped and logged, so the crawls keep running and the disk
+    keeps the most recent states instead of filling up"""
+
+    SUFFIX = ".spool"
+
+    def __init__(self, directory, queue_size=16, max_files=None):
+        self.directory = directory
+        self.failed_dir = os.path.join(directory, "failed")
+        self.queue_size = queue_size
+        self.max_files = max_files
+        os.makedirs(self.failed_dir, exist_ok=True)
+        self._cached = collections.OrderedDict()
+        self._condition = threading.Condition()
+        self._sequence = 0
+        # state handed out by get and not removed yet, it is being written and never dropped
+        self._taken = None
+
+    def files(self):
+        """Returns the paths of all spooled states, oldest first"""
+        return [os.path.join(self.directory, name) for name in sorted(os.listdir(self.directory))
+                if name.endswith(self.SUFFIX)]
+
+    def __len__(self):
+        return len(self.files())
+
+    def put(self, timestamp, rows):
+        """Spools a state of (place_uid, bikes, free_racks) rows queried at the unix timestamp, returns its path. The
+        file is synced and renamed into place, so a crash never leaves a partial state. If the spool then holds more
+        than max_files states, the oldest ones are dropped"""
+        rows = [list(row) for row in rows]
+        with self._condition:
+            self._sequence += 1
+            name = "{:012d}_{}_{:06d}{}".format(timestamp, os.getpid(), self._sequence, self.SUFFIX)
+        path = os.path.join(self.directory, name)
+        with open(path + ".tmp", "w") as file:
+            json.dump({"timestamp": timestamp, "rows": rows}, file, separators=(",", ":"))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(path + ".tmp", path)
+
+        with self._condition:
+            if len(self._cached) < self.queue_size:
+                self._cached[path] = (timestamp, rows)
+            else:
+                # the writer is behind, the state is only kept on disk until it catches up
+                NBMetrics.metrics.count("spool_overflows")
+            self._drop_oldest()
+            self._condition.notify_all()
+        NBMetrics.metrics.count("states_spooled")
+        return path
+
+    def get(self, timeout=None):
+        """Returns (path, timestamp, rows) of the oldest spooled state, waits up to timeout seconds for one. Returns
+        None if the spool is still empty. The state stays spooled until it is removed, files which cannot be read are
+        moved aside"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._condition:
+                files = self.files()
+                if not files:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        return None
+                    self._condition.wait(remaining)
+                    continue
+                path = files[0]
+                self._taken = path
+                if path in self._cached:
+                    return (path,) + self._cached[path]
+            try:
+                with open(path) as file:
+                    state = json.load(file)
+                return path, state["timestamp"], state["rows"]
+            except (ValueError, KeyError, TypeError) as error:
+                logging.error("Spool file %s cannot be read and is moved aside: %s", path, error)
+                NBMetrics.metrics.count("states_failed")
+                self.quarantine(path)
+
+    def _drop_oldest(self):
+        """Removes the oldest states beyond max_files, except the one being written. Called with the lock held"""
+        if self.max_files is None:
+            return
+        files = self.files()
+        if len(files) <= self.max_files:
+            return
+        for path in [path for path in files if path != self._taken][:len(files) - self.max_files]:
+            self._cached.pop(path, None)
+            os.remove(path)
+            NBMetrics.metrics.count("states_dropped")
+            logging.error("The spool holds more than %s states, the oldest state %s is dropped", self.max_files, path)
+
+    def remove(self, path):
+        """Removes a state once it has been written"""
+        with self._condition:
+            self._cached.pop(path, None)
+            if path == self._taken:
+                self._taken = None
+            os.remove(path)
+            self._condition.notify_all()
+
+    def quarantine(self, path):
+        """Moves a state which cannot be written to the failed directory, so it does not block the states after it"""
+        with self._condition:
+            self._cached.pop(path, None)
+            if path == self._taken:
+                self._taken = None
+            os.replace(path, os.path.join(self.failed_dir, os.path.basename(path)))
+            self._condition.notify_all()
+
+    def wait_empty(self, timeout=None):
+        """Waits up to timeout seconds until all spooled states have been written, returns true if the spool is
+        empty"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while self.files():
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+        return True
+
+    def wake(self):
+        """Wakes up threads waiting on the spool, e.g. a writer which is asked to stop"""
+        with self._condition:
+            self._condition.notify_all()
@@ -1,84 +1,855 @@
-import sqlite3
+import datetime
+import itertools
+import logging
+import threading
 import xml.etree.ElementTree as ElmTree
 
-from NB_lib import NBMasterDataDB
+from NB_lib import NBColumnarArchive, NBCurrentStatus, NBFeedParser, NBMasterDataDB, NBMetrics, NBMigrations, \
+    NBPlaceFilter, NBShardCatalog, NBSpool, NBStatusStream, NBStorageBackend, NBTimeSeries
+
+
+def fill_values(place):
+    """Returns place_uid, bikes and free_racks of the attributes of a place as integers, handles the '5+' bikes and the
+    missing free_racks of legacy files"""
+    bikes = place.get("bikes")
+    if bikes == "5+":
+        bikes = 5
+    free_racks = place.get("free_racks")
+    if free_racks is None:
+        free_racks = 0
+    return int(place.get("uid")), int(bikes), int(free_racks)
+
+
+def _batches(rows, batch_size):
+    """Splits an iterable of rows into lists of at most batch_size rows"""
+    rows = iter(rows)
+    batch = list(itertools.islice(rows, batch_size))
+    while batch:
+        yield batch
+        batch = list(itertools.islice(rows, batch_size))
+
+
+def _to_timestamp(time):
+    """Returns a datetime or a unix timestamp as unix timestamp"""
+    if isinstance(time, datetime.datetime):
+        return int(time.timestamp())
+    return int(time)
 
 
 class NBStationsDataDB:
     """Class which defines an abstract interface to the master database"""
 
+    STORAGE_MODES = ("full", "changes")
+    ROLLUPS = NBStorageBackend.ROLLUPS
+
     def __init__(self, transactions_db_name="stations_transactions.db", master_data_db_name="stations_master.db",
-                 login_data_db_name="login.db", log_file="db_log.log"):
+                 login_data_db_name="login.db", log_file="db_log.log", journal_mode="WAL", synchronous="NORMAL",
+                 cache_size=None, batch_size=5000, storage_mode="full", master_db=None, archive_dir=None,
+                 retention_days=None, hourly_retention_days=None, prune_batch_size=10000, shard_dir=None,
+                 shard_period="month", backend="sqlite", events=False):
         """"Creates a database connection at initialization and establishes base DB-structure if necessary,
-               also creates an NBMasterDataDB Object and fills it"""
-        self.master_db = NBMasterDataDB.NBMasterDataDB(login_data_db_name=login_data_db_name,
-                                                       master_data_db_name=master_data_db_name,
-                                                       log_file=log_file)
-        self.master_db.fill_if_empty()
+               also creates an NBMasterDataDB Object and fills it. journal_mode, synchronous and cache_size are set as
+               pragmas on the connection, batch_size is the number of rows written per executemany. With storage_mode
+               'changes' a row is only written if the values of a place differ from its last state. An already opened
+               and filled NBMasterDataDB can be passed as master_db, so it is not opened a second time. With an
+               archive_dir, series queries also read the compacted history from the columnar archive. Raw rows older
+               than retention_days and hourly rollups older than hourly_retention_days are removed by prune, in
+               batches of prune_batch_size rows. With a shard_dir, rows are written into a shard file per
+               shard_period ('day', 'month' or 'year'), reads attach the shards of their time range. backend is the
+               storage engine of the database, 'sqlite' or 'duckdb'. With events, the bikes taken and returned at
+               every place are derived while rows are added and kept in stations_events"""
+        if storage_mode not in self.STORAGE_MODES:
+            raise ValueError("Unknown storage mode '{}'".format(storage_mode))
+        self.storage_mode = storage_mode
+        self.backend = NBStorageBackend.get_backend(backend)
+        if shard_dir is not None and not self.backend.supports_shards:
+            raise ValueError("The storage backend '{}' does not support shards".format(backend))
+        self.events = events
+        # states are tracked in memory if rows are filtered by changes or events are derived from them
+        self.tracks_state = storage_mode == "changes" or events
+        self.last_state = dict()
+        # last (timestamp, bikes) of every place, events are the differences to it
+        self.last_seen = dict()
+        # latest state of every place, kept in stations_current and in memory for lookups without a query
+        self.current = NBCurrentStatus.NBCurrentStatus()
+        self.archive = None if archive_dir is None else NBColumnarArchive.NBColumnarArchive(archive_dir)
 
-        self.conn = sqlite3.connect(transactions_db_name)
-        c = self.conn.cursor()
-        # check if database contains a table with transaction data; create table if necessary
-        # noinspection SqlResolve
-        c.execute("SELECT 1 FROM sqlite_master WHERE tbl_name = 'stations_fill' AND type = 'table'")
-        if len(c.fetchall()) < 1:
-            c.execute("CREATE TABLE `stations_fill` ( `timestamp` INTEGER NOT NULL, `place_uid` INTEGER NOT NULL, "
-                      "`bikes` INTEGER NOT NULL, `free_racks` INTEGER NOT NULL,UNIQUE ( `place_uid`, `timestamp`) ) ")
+        if master_db is None:
+            master_db = NBMasterDataDB.NBMasterDataDB(login_data_db_name=login_data_db_name,
+                                                      master_data_db_name=master_data_db_name,
+                                                      log_file=log_file)
+            master_db.fill_if_empty()
+        self.master_db = master_db
+        # hash of the status content added last, unchanged downloads are not added again
+        self.ingested_hash = None
+        self.batch_size = batch_size
+        self.retention_days = retention_days
+        self.hourly_retention_days = hourly_retention_days
+        self.prune_batch_size = prune_batch_size
+        # (schema, table): a time no row of the table is older than, so prune only looks at tables with expired rows
+        self.prune_watermarks = dict()
+        # spooled mode: states are handed to a writer thread, see start_writer
+        self.spool = None
+        self.writer = None
+        self._stop_writer = threading.Event()
 
-    def add_state_domain_level(self, status_xml, status_time):
-        """"Adds a state defined by an status_xml and a time to the database"""
-        c = self.conn.cursor()
+        self.conn = self.backend.connect(transactions_db_name)
+        self.journal_mode, self.synchronous = journal_mode, synchronous
+        self.backend.set_pragmas(self.conn, journal_mode, synchronous, cache_size)
+        self.backend.create_fill_schema(self.conn, "main")
+        if self.events:
+            self.backend.create_event_schema(self.conn, "main")
+        self.conn.commit()
+
+        # the main database keeps the rows written before sharding was enabled, so it is always read as well
+        self.shards = None
+        if shard_dir is not None:
+            self.shards = NBShardCatalog.NBShardCatalog(self.conn, shard_dir, shard_period, self._prepare_shard)
+
+        if not self.backend.table_exists(self.conn, "main", "stations_current"):
+            self.backend.create_current_schema(self.conn)
+            # databases from before the table start with the latest stored row of every place
+            for schema in self.fill_schemas():
+                self.backend.upsert_current(self.conn, [(timestamp, place_uid, bikes, free_racks) for
+                                                        place_uid, bikes, free_racks, timestamp in
+                                                        self.backend.read_last_states(self.conn, schema)])
+            self.conn.commit()
+        self.current.load(self.backend.read_current(self.conn))
+
+        if self.tracks_state:
+            self._load_last_state()
+
+    def _prepare_shard(self, schema):
+        """"Sets the pragmas of the connection on a newly attached shard and creates its tables"""
+        self.backend.set_schema_pragmas(self.conn, schema, self.journal_mode, self.synchronous)
+        self.backend.create_fill_schema(self.conn, schema)
+        if self.events:
+            self.backend.create_event_schema(self.conn, schema)
+
+    def _write_schema(self, time):
+        """Returns the schema rows of the time (datetime or unix timestamp) are written to. Attaching a new shard
+        commits pending writes"""
+        timestamp = _to_timestamp(time)
+        schema = "main" if self.shards is None else self.shards.schema_for(timestamp)
+        # a late state may land in a bucket below a watermark, prune has to look for the oldest row again then
+        for table in ["stations_fill"] + ["stations_fill_" + name for name, _ in NBStorageBackend.ROLLUPS]:
+            watermark = self.prune_watermarks.get((schema, table))
+            if watermark is not None and watermark > timestamp - NBStorageBackend.ROLLUPS[-1][1]:
+                del self.prune_watermarks[(schema, table)]
+        return schema
+
+    def fill_schemas(self, start=None, end=None, newest_first=False, writable_only=False):
+        """Yields the schemas holding rows from start to end (datetimes or unix timestamps, both optional): the main
+        database first, then the shards of the time range in chronological order or the newest first. Shards are
+        attached while they are yielded, so every schema has to be used before the next one is taken. With
+        writable_only, shards which have been made read-only are left out"""
+        yield "main"
+        if self.shards is not None:
+            yield from self.shards.schemas(None if start is None else _to_timestamp(start),
+                                           None if end is None else _to_timestamp(end), newest_first, writable_only)
 
-        for domain in status_xml:
-            for city in domain:
-                for place in city:
-                    place_uid = place.attrib.get("uid")
-                    bikes = place.attrib.get("bikes")
-                    free_racks = place.attrib.get("free_racks")
-                    c.execute("INSERT OR IGNORE INTO stations_fill VALUES (?, ?, ?, ?)",
-                              (int(status_time.timestamp()), place_uid, bikes, free_racks))
+    def _prune_table(self, table, before, max_batches):
+        """Deletes rows older than the unix timestamp before from stations_fill or a rollup table of every schema in
+        batches, every batch is committed on its own. Tables whose oldest row is not older than before are skipped
+        without touching their rows. Returns the number of rows deleted"""
+        num_deleted = 0
+        # shards which have been made read-only are left alone
+        for schema in self.fill_schemas(end=before, writable_only=True):
+            watermark = self.prune_watermarks.get((schema, table))
+            if watermark is None or watermark < before:
+                watermark = self.backend.oldest_timestamp(self.conn, schema, table)
+            if watermark is None or watermark >= before:
+                self.prune_watermarks[(schema, table)] = before if watermark is None else watermark
+                continue
+            num_batches = 0
+            for num_batch in self.backend.prune_rows(self.conn, schema, table, before, self.prune_batch_size):
+                self.conn.commit()
+                num_deleted += num_batch
+                num_batches += 1
+                if max_batches is not None and num_batches >= max_batches:
+                    break
+            else:
+                self.prune_watermarks[(schema, table)] = before
+        return num_deleted
+
+    def prune(self, now=None, max_batches=None):
+        """Applies the retention policy: deletes raw rows older than retention_days and hourly rollups older than
+        hourly_retention_days, daily rollups are kept. Rows are deleted in batches, so writers are never blocked for
+        long; with max_batches, at most that many batches per table are deleted, the rest is left for the next call.
+        Returns the number of rows deleted"""
+        now = _to_timestamp(now) if now is not None else int(datetime.datetime.now().timestamp())
+        num_deleted = 0
+        with NBMetrics.metrics.stage("prune"):
+            if self.retention_days is not None:
+                num_deleted += self._prune_table("stations_fill", now - int(self.retention_days * 86400), max_batches)
+            if self.hourly_retention_days is not None:
+                num_deleted += self._prune_table("stations_fill_hourly", now - int(self.hourly_retention_days * 86400),
+                                                 max_batches)
+        NBMetrics.metrics.count("rows_pruned", num_deleted)
+        return num_deleted
+
+    def migrate(self, batch_size=50000, pause=0.0, max_batches=None):
+        """Applies the pending migrations to the main database and every shard, copying large tables in batches of
+        batch_size rows with a pause of pause seconds after every batch, while the crawler keeps writing. With
+        max_batches, at most that many batches per schema are copied, the next call continues. Returns the names of the
+        migrations applied per schema"""
+        applied = dict()
+        if not any(self.backend.name in migration.backends for migration in NBMigrations.discover("transactions")):
+            return applied
+        # shards which have been made read-only are left alone
+        for schema in self.fill_schemas(writable_only=True):
+            runner = NBMigrations.NBMigrationRunner(self.conn, "transactions", schema, self.backend.name, batch_size,
+                                                    pause)
+            applied[schema] = runner.run(max_batches)
+        return applied
+
+    def start_writer(self, spool_dir, queue_size=16, retry_delay=1.0, max_retry_delay=60.0, max_files=None):
+        """Switches to the spooled mode: states added from now on are spooled in spool_dir and the calls return at
+        once, a writer thread writes them in the order of their times of query and prunes a batch of expired rows
+        after every state. States left in the spool by an earlier run are written first. A write failing with a
+        transient error (locked database, slow disk) is retried after retry_delay seconds, doubled up to
+        max_retry_delay, until it succeeds. With max_files, the spool keeps at most that many states and drops the
+        oldest ones, see NBSpool. Until stop_writer, the connection belongs to the writer thread"""
+        if self.writer is not None:
+            raise ValueError("The writer is already running")
+        self.spool = NBSpool.NBSpool(spool_dir, queue_size, max_files)
+        self.retry_delay, self.max_retry_delay = retry_delay, max_retry_delay
+        self._stop_writer.clear()
+        self.writer = threading.Thread(target=self._run_writer, name="stations_writer", daemon=True)
+        self.writer.start()
+
+    def stop_writer(self, timeout=None):
+        """Leaves the spooled mode: waits up to timeout seconds until all spooled states have been written, then stops
+        the writer thread. States which have not been written stay in the spool for the next start. Returns the number
+        of states left"""
+        if self.writer is None:
+            return 0
+        self.spool.wait_empty(timeout)
+        self._stop_writer.set()
+        self.spool.wake()
+        self.writer.join()
+        num_left = len(self.spool)
+        self.spool, self.writer = None, None
+        return num_left
+
+    def _run_writer(self):
+        """Consumer of the spooled mode, writes the spooled states until stop_writer is called. An unexpected error
+        does not end the thread, it is logged and the writer continues after a delay, doubled with every failure in a
+        row, so the spool keeps being drained"""
+        delay = self.retry_delay
+        while not self._stop_writer.is_set():
+            try:
+                state = self.spool.get(timeout=1.0)
+                if state is not None:
+                    self._write_spooled(*state)
+                delay = self.retry_delay
+            except Exception:
+                NBMetrics.metrics.count("writer_errors")
+                logging.exception("The writer failed, continuing in %ss", delay)
+                try:
+                    self.conn.rollback()
+                except NBStorageBackend.ERRORS:
+                    pass
+                self._stop_writer.wait(delay)
+                delay = min(delay * 2, self.max_retry_delay)
+
+    def _write_spooled(self, path, timestamp, rows):
+        """Writes a spooled state and removes it from the spool. Transient errors are retried until the write succeeds
+        or the writer is stopped, states which cannot be written at all are moved aside"""
+        delay = self.retry_delay
+        while True:
+            try:
+                with NBMetrics.metrics.stage("spool_write"):
+                    self._write_fill_rows(((timestamp,) + tuple(row) for row in rows),
+                                          schema=self._write_schema(timestamp))
+                break
+            except NBStorageBackend.TRANSIENT_ERRORS as error:
+                self.conn.rollback()
+                NBMetrics.metrics.count("write_retries")
+                logging.warning("Writing the state of %s failed, retrying in %ss: %s", timestamp, delay, error)
+                if self._stop_writer.wait(delay):
+                    # the state stays in the spool for the next start
+                    return
+                delay = min(delay * 2, self.max_retry_delay)
+            except NBStorageBackend.ERRORS + (ValueError,) as error:
+                self.conn.rollback()
+                NBMetrics.metrics.count("states_failed")
+                logging.error("The state of %s cannot be written and is moved aside: %s", timestamp, error)
+                self.spool.quarantine(path)
+                return
+        self.spool.remove(path)
+        try:
+            self.prune(max_batches=1)
+        except NBStorageBackend.TRANSIENT_ERRORS:
+            # expired rows are pruned after the next state
+            self.conn.rollback()
+
+    def close(self):
+        """Stops the writer of the spooled mode without waiting for the spool, commits pending rows and closes the
+        connection to the transactions database"""
+        self.stop_writer(timeout=0)
         self.conn.commit()
+        self.conn.close()
+
+    def _load_last_state(self):
+        """"Seeds the last known (bikes, free_racks) and the last seen (timestamp, bikes) of every place from the
+        latest row of the place in the database"""
+        self.last_state = dict()
+        self.last_seen = dict()
+        # the archive holds the oldest rows and the schemas are read in chronological order, so later states replace
+        # earlier ones. Places whose rows have all been compacted are seeded from the archive
+        last_states = [] if self.archive is None else [self.archive.last_states()]
+        last_states += [self.backend.read_last_states(self.conn, schema) for schema in self.fill_schemas()]
+        for place_uid, bikes, free_racks, timestamp in itertools.chain.from_iterable(last_states):
+            seen = self.last_seen.get(place_uid)
+            if seen is None or timestamp >= seen[0]:
+                self.last_state[place_uid] = (bikes, free_racks)
+                self.last_seen[place_uid] = (timestamp, bikes)
+
+    def _touched_rows(self, rows, touched):
+        """Yields the rows unchanged and keeps the last state, the last seen state and the current state of their
+        places in touched, as they were before the first row of the place, so they can be restored if the rows are
+        rolled back"""
+        last_state, last_seen, current = self.last_state, self.last_seen, self.current.states
+        for row in rows:
+            if row[1] not in touched:
+                touched[row[1]] = (last_state.get(row[1]), last_seen.get(row[1]), current.get(row[1]))
+            yield row
+
+    def _restore_states(self, touched):
+        """Sets the states kept in memory of the places in touched back after their rows have been rolled back, the
+        states of other places are left as they are"""
+        for place_uid, (state, seen, current) in touched.items():
+            for states, value in ((self.last_state, state), (self.last_seen, seen), (self.current.states, current)):
+                if value is None:
+                    states.pop(place_uid, None)
+                else:
+                    states[place_uid] = value
+
+    @staticmethod
+    def _current_rows(rows, current):
+        """Yields the rows unchanged and collects them in current, all rows of a state update stations_current"""
+        for row in rows:
+            current.append(row)
+            yield row
+
+    def _changed_rows(self, rows):
+        """Yields only rows whose values differ from the last known state of their place and updates that state.
+        States have to be added in chronological order for this to be correct"""
+        for row in rows:
+            state = row[2:]
+            if self.last_state.get(row[1]) != state:
+                self.last_state[row[1]] = state
+                yield row
+
+    def _event_rows(self, rows, events):
+        """Yields the rows unchanged and collects a (place_uid, timestamp, gap, taken, returned) event in events for
+        every row whose bikes differ from the last seen bikes of its place. Rows which are not newer than the last
+        seen state give no event, so states added twice are not counted twice"""
+        for row in rows:
+            timestamp, place_uid, bikes = row[0], row[1], row[2]
+            last = self.last_seen.get(place_uid)
+            if last is None or timestamp > last[0]:
+                if last is not None and bikes != last[1]:
+                    events.append((place_uid, timestamp, timestamp - last[0], max(last[1] - bikes, 0),
+                                   max(bikes - last[1], 0)))
+                self.last_seen[place_uid] = (timestamp, bikes)
+            yield row
+
+    @staticmethod
+    def _state_rows(records, status_time, places=None):
+        """Yields typed (timestamp, place_uid, bikes, free_racks) rows for place records, if a set of places is
+        provided, only for places from the set"""
+        timestamp = int(status_time.timestamp())
+        for record in records:
+            row = fill_values(record.place)
+            if places is None or row[0] in places:
+                yield (timestamp,) + row
+
+    def _write_rows(self, table, rows, commit=True, ignore_duplicates=True):
+        """"Bulk writer for all inserts: appends rows to table in batches of batch_size rows, with ignore_duplicates
+        rows violating its unique key are ignored. All batches are written in a single transaction, which is rolled
+        back if anything goes wrong. Returns the number of rows passed and the number of rows written"""
+        num_rows = num_changed = 0
+        try:
+            for batch in _batches(rows, self.batch_size):
+                num_changed += self.backend.append_rows(self.conn, table, batch, ignore_duplicates)
+                num_rows += len(batch)
+        except NBStorageBackend.ERRORS + (ElmTree.ParseError, ValueError):
+            self.conn.rollback()
+            raise
+        if commit:
+            self.conn.commit()
+        return num_rows, num_changed
+
+    @staticmethod
+    def _count_fill_rows(num_rows, num_written):
+        NBMetrics.metrics.count("rows_written", num_written)
+        NBMetrics.metrics.count("rows_ignored", num_rows - num_written)
+
+    def _write_fill_rows(self, rows, commit=True, schema="main"):
+        """"Writes (timestamp, place_uid, bikes, free_racks) rows to stations_fill of schema, in storage mode 'changes'
+        only rows which change the state of their place. With events, the events of the rows are written to
+        stations_events of schema in the same transaction, as are the newer states of stations_current, which are
+        taken into memory once written. Returns the states in memory of the places as they were before the rows, if
+        the rows are rolled back they are restored by _restore_states"""
+        current, events, touched = list(), list(), dict()
+        rows = self._touched_rows(self._current_rows(rows, current), touched)
+        if self.storage_mode == "changes":
+            rows = self._changed_rows(rows)
+        if self.events:
+            # events are taken from the rows which are stored, so they match the events derived by backfill_events
+            rows = self._event_rows(rows, events)
+        with NBMetrics.metrics.stage("insert"):
+            try:
+                self._count_fill_rows(*self._write_rows("{}.stations_fill".format(schema), rows, commit=False))
+                if events:
+                    NBMetrics.metrics.count("events_written", self._write_rows("{}.stations_events".format(schema),
+                                                                               events, commit=False)[1])
+                self.backend.upsert_current(self.conn, current)
+            except NBStorageBackend.ERRORS + (ElmTree.ParseError, ValueError):
+                self.conn.rollback()
+                self._restore_states(touched)
+                raise
+            if commit:
+                self.conn.commit()
+            self.current.update(current)
+        return touched
+
+    def _add_state(self, rows, status_time, commit=True):
+        """"Writes the (timestamp, place_uid, bikes, free_racks) rows of a state queried at status_time (datetime or
+        unix timestamp), in the spooled mode they are spooled for the writer thread instead. Returns the states in
+        memory the rows replaced, see _write_fill_rows, or None if they were spooled"""
+        if self.spool is not None:
+            self.spool.put(_to_timestamp(status_time), [row[1:] for row in rows])
+            return None
+        schema = self._write_schema(status_time)
+        return self._write_fill_rows(rows, commit, schema)
+
+    def add_state_domain_level(self, status_xml, status_time):
+        """"Adds a state defined by an status_xml and a time to the database"""
+        self._add_state(self._state_rows(NBStatusStream.iter_tree_records(status_xml), status_time), status_time)
 
     def add_state_country_level(self, status_xml, status_time):
         """"Adds a state defined by an status_xml and a time to the database"""
+        self._add_state(self._state_rows(NBStatusStream.iter_tree_records(status_xml), status_time), status_time)
+
+    def add_fill_rows(self, rows, status_time, commit=True):
+        """"Adds a state defined by (place_uid, bikes, free_racks) rows and a time to the database. If commit is False,
+        the rows are left in the open transaction, so several states can be committed at once; the returned states
+        in memory the rows replaced are restored by _restore_states if the transaction is rolled back instead"""
+        timestamp = int(status_time.timestamp())
+        return self._add_state(((timestamp,) + row for row in rows), timestamp, commit)
+
+    def _place_filter(self, places_list):
+        """Returns an NBPlaceFilter for a list of places, or None if the list is empty. Filters are passed through"""
+        if isinstance(places_list, NBPlaceFilter.NBPlaceFilter):
+            return places_list if len(places_list) > 0 else None
+        if not places_list:
+            return None
+        return NBPlaceFilter.NBPlaceFilter(places_list, self.master_db)
+
+    def add_state_stream(self, records, status_time=None, places_list=None):
+        """"Adds the place records of a status stream to the database while the stream is still being read. If no
+        status_time is given, the time of query of the stream is used once it has been read completely. If a
+        places_list or NBPlaceFilter is provided, only places from it are added"""
+        places = self._place_filter(places_list)
+
+        if status_time is not None:
+            self._add_state(self._state_rows(records, status_time, places), status_time)
+            return
+        if self.spool is not None:
+            # the writer thread owns the connection, so the rows are collected until the time of query is known
+            rows = [row for row in (fill_values(record.place) for record in records)
+                    if places is None or row[0] in places]
+            if records.status_time is None:
+                raise ValueError("Status stream does not contain a time of query")
+            self.spool.put(int(records.status_time.timestamp()), rows)
+            return
+
+        # the time is only known at the end of the stream, so rows are staged in a temporary table until then
+        self.backend.create_stage(self.conn)
         c = self.conn.cursor()
+        # attaching a shard commits the staged rows, so rows left by a failed stream are removed first
+        c.execute("DELETE FROM stations_fill_stage")
+        staged = (row for row in (fill_values(record.place) for record in records)
+                  if places is None or row[0] in places)
+        with NBMetrics.metrics.stage("stream"):
+            num_staged = self._write_rows("stations_fill_stage", staged, commit=False,
+                                         ignore_duplicates=False)[0]
 
-        for country in status_xml:
-            for city in country:
-                for place in city:
-                    place_uid = place.attrib.get("uid")
-                    bikes = place.attrib.get("bikes")
-                    if bikes == "5+":
-                        bikes = 5
-                    free_racks = place.attrib.get("free_racks")
-                    if free_racks is None:
-                        free_racks = 0
-                    c.execute("INSERT OR IGNORE INTO stations_fill VALUES (?, ?, ?, ?)",
-                              (int(status_time.timestamp()), place_uid, int(bikes), int(free_racks)))
+        if records.status_time is None:
+            self.conn.rollback()
+            raise ValueError("Status stream does not contain a time of query")
+        schema = self._write_schema(records.status_time)
+        if self.tracks_state:
+            # staged rows have to pass the change filter or give events, so they are read back instead of copied in sql
+            rows = self.conn.cursor().execute("SELECT ?, place_uid, bikes, free_racks FROM stations_fill_stage",
+                                              (int(records.status_time.timestamp()),))
+            self._write_fill_rows(rows.fetchall(), commit=False, schema=schema)
+        else:
+            with NBMetrics.metrics.stage("insert"):
+                num_written = self.backend.execute_count(
+                    self.conn, "INSERT OR IGNORE INTO {}.stations_fill SELECT ?, place_uid, bikes, free_racks "
+                               "FROM stations_fill_stage".format(schema), (int(records.status_time.timestamp()),))
+            self._count_fill_rows(num_staged, num_written)
+        c.execute("DELETE FROM stations_fill_stage")
         self.conn.commit()
 
+    def add_current_state_stream(self, places_list=list()):
+        """Streams the current state from the server into the database, if station list or NBPlaceFilter is provided,
+        only add stations from list. Rows are written while the download is still running"""
+        places = self._place_filter(places_list)
+        num_tries = 0
+        while True:
+            stream = self.master_db.stream_station_status(place_filter=places)
+            if stream is None:
+                # server reported the status as unchanged
+                return None
+            with stream:
+                try:
+                    self.add_state_stream(stream, places_list=places)
+                    written = True
+                except (ElmTree.ParseError, ValueError) as error:
+                    # corrupt or incomplete download, try again
+                    written = False
+                # archived after the rows are committed and outside of the retries, so they are never written twice
+                if written:
+                    self.master_db.archive_stream(stream)
+            if written:
+                return stream.status_time
+            num_tries += 1
+            if num_tries >= 10:
+                raise ValueError('Could not get Station Data or Parse received XML-File')
+            NBMetrics.metrics.count("parse_retries")
+            logging.warning("Streaming the status failed in try %s, trying again: %s", num_tries, error)
+            self.master_db.fetcher.backoff(num_tries)
+
     def add_current_state(self, places_list=list()):
-        """Downloads the current state and adds it to the database, if station list is provided,
-        only add stations from list"""
+        """Downloads the current state and adds it to the database, if station list or NBPlaceFilter is provided,
+        only add stations from list. With a filter, domains and cities without selected places are skipped"""
+        places = self._place_filter(places_list)
+
+        # get snapshot of station, in either format
+        self.master_db._refresh_station_status()
+        status_time = self.master_db.status_time
+
+        # skip parse results which have been added before
+        if self.master_db.parsed_hash is not None and self.master_db.parsed_hash == self.ingested_hash:
+            return
+
+        # if places are specified, only visit the cities containing them and add data for the places specified
+        records = self.master_db.status_records(place_filter=places)
+        self._add_state(self._state_rows(records, status_time, places), status_time)
+        self.ingested_hash = self.master_db.parsed_hash
+
+    def add_feeds(self, results, places_list=list()):
+        """Adds the states of fetched FeedResults of either format, each with its own time of query, if station list
+        or NBPlaceFilter is provided, only add stations from list. Feeds without a time of query in their status get
+        the time their request was sent, to the minute. Results without body are skipped, as are feeds without states;
+        every feed is written in a transaction of its own, a feed which cannot be parsed or written is logged and does
+        not stop the others. Returns a dict of source: time of query of the feeds added"""
+        places = self._place_filter(places_list)
+        added = dict()
+        for result in results:
+            if result.body is None:
+                continue
+            try:
+                with NBMetrics.metrics.stage("parse"):
+                    status = NBFeedParser.parse_feed(result.body, result.source, self.master_db.feed_ids)
+                if not status.has_states:
+                    continue
+                status_time = status.status_time
+                if status_time is None:
+                    status_time = result.query_time.replace(second=0, microsecond=0)
+                # a failed write has been rolled back, so the next feed starts with a clean transaction
+                self._add_state(self._state_rows(status.records(place_filter=places), status_time, places),
+                                status_time)
+            except NBStorageBackend.ERRORS + (ElmTree.ParseError, ValueError) as error:
+                logging.error("Feed %s could not be added: %s", result.source, error)
+                NBMetrics.metrics.count("feeds_failed")
+                continue
+            added[result.source] = status_time
+        return added
+
+    def replay_snapshots(self, archive, start=None, end=None, places_list=None):
+        """Adds the snapshots of an NBSnapshotArchive from start to end (datetimes, both optional) through the normal
+        ingest path in chronological order, each with its time of query. The format of a snapshot is detected from its
+        first bytes: xml snapshots are streamed, GBFS snapshots are parsed with the uids of the master data like the
+        status they were archived from. If a places_list or NBPlaceFilter is provided, only places from it are added.
+        Returns the number of snapshots replayed"""
+        places = self._place_filter(places_list)
+        snapshots = archive.snapshots(start, end)
+        for status_time, content_hash in snapshots:
+            with archive.open(content_hash) as source:
+                if NBFeedParser.detect_format(source.peek(64)) == "gbfs":
+                    status = NBFeedParser.parse_feed(source.read(), NBMasterDataDB.NBMasterDataDB.STATUS_SOURCE,
+                                                     self.master_db.feed_ids)
+                    self._add_state(self._state_rows(status.records(place_filter=places), status_time, places),
+                                    status_time)
+                else:
+                    self.add_state_stream(NBStatusStream.NBStatusStream(source, place_filter=places), status_time,
+                                          places)
+        return len(snapshots)
+
+    def add_current_feeds(self, feed_fetcher, places_list=list()):
+        """Fetches the feeds of an NBFeedFetcher concurrently and adds their states, if station list or NBPlaceFilter
+        is provided, only add stations from list. Returns a dict of source: time of query of the feeds added"""
+        return self.add_feeds(feed_fetcher.fetch_all(), places_list)
+
+    def get_current(self, place_uid):
+        """Returns (timestamp, bikes, free_racks) of the latest state added for a place, or None if nothing is known
+        about it. Looked up in memory, neither the server nor the history is queried"""
+        return self.current.place(int(place_uid))
+
+    def refresh_current_index(self):
+        """Indexes the places of every city and domain for the current state lookups, called again after the master
+        data changed"""
+        self.current.set_assignments(self.master_db.get_place_assignments())
+
+    def get_current_city(self, city_uid):
+        """Returns a dict of place_uid: (timestamp, bikes, free_racks) of the latest states of all places of a city"""
+        if not self.current.indexed:
+            self.refresh_current_index()
+        return self.current.city(int(city_uid))
 
-        # get snapshot of station  and make sure it is a valid ElmTree
-        status_xml, status_time = self.master_db.get_station_status(True)
-        assert isinstance(status_xml, ElmTree.Element)
+    def get_current_domain(self, domain):
+        """Returns a dict of place_uid: (timestamp, bikes, free_racks) of the latest states of all places of a
+        domain"""
+        if not self.current.indexed:
+            self.refresh_current_index()
+        return self.current.domain(domain)
 
-        if not len(places_list) > 0:
-            # if no places are specified, add all places to DB
-            self.add_state_domain_level(status_xml, status_time)
+    def get_state_at(self, place_uid, time):
+        """Returns (timestamp, bikes, free_racks) of the latest row of a place at or before time (datetime or unix
+        timestamp), or None if nothing is known about the place at that time. The timestamp is the time of the row
+        the state was taken from, which works for full and change-only storage alike"""
+        c = self.conn.cursor()
+        state = None
+        # the main database holds the rows from before sharding, the shards are searched from the newest one back
+        for schema in self.fill_schemas(end=time, newest_first=True):
+            c.execute("SELECT timestamp, bikes, free_racks FROM {}.stations_fill WHERE place_uid = ? "
+                      "AND timestamp <= ? ORDER BY timestamp DESC LIMIT 1".format(schema),
+                      (int(place_uid), _to_timestamp(time)))
+            row = c.fetchone()
+            if row is not None and (state is None or row[0] > state[0]):
+                state = row
+            if row is not None and schema != "main":
+                break
+        # compacted months are only in the archive
+        if self.archive is not None:
+            row = self.archive.state_at(place_uid, _to_timestamp(time))
+            if row is not None and (state is None or row[0] > state[0]):
+                state = row
+        return state
+
+    def get_state_series(self, place_uid, start, end, step):
+        """Returns a list of (timestamp, bikes, free_racks) of a place at regular steps from start to end, rebuilt
+        from the rows of the place. start and end are datetimes or unix timestamps, step is a timedelta or seconds.
+        bikes and free_racks are None for times before the first row of the place"""
+        start, end = _to_timestamp(start), _to_timestamp(end)
+        if isinstance(step, datetime.timedelta):
+            step = step.total_seconds()
+        step = int(step)
+
+        # the state at start is taken from the latest row before it, which may lie in an earlier shard
+        first = self.get_state_at(place_uid, start)
+        changes = [first] if first is not None else list()
+        c = self.conn.cursor()
+        for schema in self.fill_schemas(start, end):
+            c.execute("SELECT timestamp, bikes, free_racks FROM {}.stations_fill WHERE place_uid = ? "
+                      "AND timestamp > ? AND timestamp <= ? ORDER BY timestamp".format(schema),
+                      (int(place_uid), start, end))
+            changes.extend(c.fetchall())
+        if self.archive is not None:
+            archived = self.archive.read([place_uid], start + 1, end)
+            changes.extend(zip(archived.timestamp.tolist(), archived.bikes.tolist(), archived.free_racks.tolist()))
+        changes.sort()
+
+        series = list()
+        state = (None, None)
+        next_change = 0
+        for timestamp in range(start, end + 1, step):
+            while next_change < len(changes) and changes[next_change][0] <= timestamp:
+                state = changes[next_change][1:]
+                next_change += 1
+            series.append((timestamp,) + tuple(state))
+        return series
+
+    def get_fill_series(self, place_uids, start, end):
+        """Returns an NBTimeSeries.FillSeries of all rows of the given places from start to end (datetimes or unix
+        timestamps, both included), sorted by place_uid and timestamp"""
+        places = sorted(set(int(place) for place in place_uids))
+        rows = list()
+        for schema in self.fill_schemas(start, end):
+            # sqlite limits the number of parameters of a statement, so the places are read in chunks
+            for chunk_start in range(0, len(places), 500):
+                rows.extend(self.backend.read_fill_rows(self.conn, schema, places[chunk_start:chunk_start + 500],
+                                                        _to_timestamp(start), _to_timestamp(end)))
+        series = NBTimeSeries.series_from_rows(rows)
+        if self.shards is not None:
+            # rows of several schemas are only sorted within each schema
+            order = NBTimeSeries.numpy.lexsort((series.timestamp, series.place_uid))
+            series = NBTimeSeries.FillSeries(*(values[order] for values in series))
+
+        if self.archive is None:
+            return series
+        # compacted months are only in the archive, recent ones only in the database
+        archived = self.archive.read(places, _to_timestamp(start), _to_timestamp(end))
+        if len(archived.timestamp) == 0:
+            return series
+        if len(series.timestamp) == 0:
+            return archived
+        merged = [NBTimeSeries.numpy.concatenate((old, new)) for old, new in zip(archived, series)]
+        order = NBTimeSeries.numpy.lexsort((merged[0], merged[1]))
+        return NBTimeSeries.FillSeries(*(values[order] for values in merged))
+
+    def get_rollup_series(self, place_uids, start, end, resolution="hourly"):
+        """Returns an NBTimeSeries.ResampledSeries of the given places from the 'hourly' or 'daily' rollup, for all
+        buckets starting from start to end (datetimes or unix timestamps, both included). The occupancy of a bucket is
+        bikes / (bikes + free_racks) summed over its rows. Rollups aggregate the stored rows, which are only the changes
+        in storage mode 'changes', so they are refused there; resample get_state_series or get_fill_series instead"""
+        seconds = dict(self.ROLLUPS).get(resolution)
+        if seconds is None:
+            raise ValueError("Unknown rollup resolution '{}'".format(resolution))
+        if self.storage_mode == "changes":
+            raise ValueError("Rollups do not describe the states of places in storage mode 'changes'")
+        NBTimeSeries.require_numpy()
+        numpy = NBTimeSeries.numpy
+
+        places = sorted(set(int(place) for place in place_uids))
+        rows = list()
+        for schema in self.fill_schemas(start, end):
+            # sqlite limits the number of parameters of a statement, so the places are read in chunks
+            for chunk_start in range(0, len(places), 500):
+                rows.extend(self.backend.read_rollup_rows(self.conn, schema, places[chunk_start:chunk_start + 500],
+                                                          _to_timestamp(start), _to_timestamp(end), resolution,
+                                                          seconds))
+
+        data = numpy.array(rows, dtype=numpy.int64).reshape(-1, 9)
+        if self.shards is not None:
+            # rows of several schemas are only sorted within each schema
+            data = data[numpy.lexsort((data[:, 0], data[:, 1]))]
+        count = data[:, 2]
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            occupancy = numpy.where(data[:, 3] + data[:, 6] > 0, data[:, 3] / (data[:, 3] + data[:, 6]), numpy.nan)
+        return NBTimeSeries.ResampledSeries(bucket=data[:, 0], place_uid=data[:, 1], count=count,
+                                            bikes_mean=data[:, 3] / count, bikes_min=data[:, 4],
+                                            bikes_max=data[:, 5], free_racks_mean=data[:, 6] / count,
+                                            free_racks_min=data[:, 7], free_racks_max=data[:, 8],
+                                            occupancy=occupancy)
+
+    def get_events(self, place_uids, start, end):
+        """Returns an NBTimeSeries.EventSeries of the stored events of the given places from start to end (datetimes or
+        unix timestamps, both included), sorted by place_uid and timestamp"""
+        NBTimeSeries.require_numpy()
+        numpy = NBTimeSeries.numpy
+        places = sorted(set(int(place) for place in place_uids))
+        rows = list()
+        for schema in self.fill_schemas(start, end):
+            if not self.backend.table_exists(self.conn, schema, "stations_events"):
+                continue
+            c = self.conn.cursor()
+            # sqlite limits the number of parameters of a statement, so the places are read in chunks
+            for chunk_start in range(0, len(places), 500):
+                chunk = places[chunk_start:chunk_start + 500]
+                c.execute("SELECT place_uid, timestamp, gap, taken, returned FROM {}.stations_events "
+                          "WHERE place_uid IN ({}) AND timestamp BETWEEN ? AND ? ORDER BY place_uid, timestamp"
+                          .format(schema, ", ".join("?" * len(chunk))),
+                          chunk + [_to_timestamp(start), _to_timestamp(end)])
+                rows.extend(c.fetchall())
+        data = numpy.array(rows, dtype=numpy.int64).reshape(-1, 5)
+        if self.shards is not None:
+            # rows of several schemas are only sorted within each schema
+            data = data[numpy.lexsort((data[:, 1], data[:, 0]))]
+        return NBTimeSeries.EventSeries(*(data[:, column].copy() for column in range(5)))
+
+    def _write_events(self, events):
+        """Writes an EventSeries to stations_events of the schemas of its timestamps without committing, events
+        already stored are ignored. Returns the number of events written"""
+        numpy = NBTimeSeries.numpy
+        data = numpy.column_stack([values.astype(numpy.int64) for values in events])
+        if self.shards is None:
+            groups = [(None, data)]
         else:
-            # if places are specified, go through entire results file but only add data for the places specified
+            # events are grouped by the start of the shard period of their timestamp
+            timestamps, inverse = numpy.unique(data[:, 1], return_inverse=True)
+            period_starts = numpy.array([NBShardCatalog.period_range(timestamp, self.shards.period)[1]
+                                         for timestamp in timestamps.tolist()], dtype=numpy.int64)[inverse]
+            groups = [(period_start, data[period_starts == period_start])
+                      for period_start in numpy.unique(period_starts).tolist()]
+        num_written = 0
+        for time, rows in groups:
+            schema = "main" if time is None else self._write_schema(time)
+            self.backend.create_event_schema(self.conn, schema)
+            num_written += self._write_rows("{}.stations_events".format(schema), rows.tolist(), commit=False)[1]
+        return num_written
+
+    def backfill_events(self, start=None, end=None, chunk_places=1000, chunk_days=30):
+        """Derives the events of all stored rows from start to end (datetimes or unix timestamps, both optional),
+        including the archive, and writes the missing ones to stations_events. The places are read in chunks of
+        chunk_places and their history in windows of chunk_days, every window is committed on its own; the last row of
+        every place is carried into the next window, so no event is lost at a window border. Returns the number of
+        events written"""
+        NBTimeSeries.require_numpy()
+        numpy = NBTimeSeries.numpy
+        places = set()
+        first, last = list(), list()
+        for schema in self.fill_schemas(start, end):
             c = self.conn.cursor()
+            c.execute("SELECT DISTINCT place_uid FROM {}.stations_fill".format(schema))
+            places.update(place_uid for place_uid, in c.fetchall())
+            c.execute("SELECT MIN(timestamp), MAX(timestamp) FROM {}.stations_fill".format(schema))
+            bounds = c.fetchone()
+            if bounds[0] is not None:
+                first.append(bounds[0])
+                last.append(bounds[1])
+        if self.archive is not None:
+            names = self.archive.partition_names()
+            if names:
+                places.update(self.archive.place_uids().tolist())
+                first.append(NBColumnarArchive.partition_range(names[0])[0])
+                last.append(NBColumnarArchive.partition_range(names[-1])[1] - 1)
+        if not places:
+            return 0
+        start = _to_timestamp(start) if start is not None else min(first)
+        end = _to_timestamp(end) if end is not None else max(last)
 
-            for domain in status_xml:
-                for city in domain:
-                    for place in city:
-                        place_uid = place.attrib.get("uid")
-                        bikes = place.attrib.get("bikes")
-                        free_racks = place.attrib.get("free_racks")
-                        if int(place_uid) in places_list:
-                            c.execute("INSERT OR IGNORE INTO stations_fill VALUES (?, ?, ?, ?)",
-                                      (int(status_time.timestamp()), place_uid, bikes, free_racks))
-            self.conn.commit()
+        places = sorted(places)
+        window = int(chunk_days * 86400)
+        num_written = 0
+        with NBMetrics.metrics.stage("events"):
+            for chunk_start in range(0, len(places), chunk_places):
+                chunk = places[chunk_start:chunk_start + chunk_places]
+                carried = None
+                for window_start in range(start, end + 1, window):
+                    series = self.get_fill_series(chunk, window_start, min(window_start + window - 1, end))
+                    if len(series.timestamp) == 0:
+                        continue
+                    if carried is not None:
+                        series = NBTimeSeries.FillSeries(*(numpy.concatenate(values)
+                                                           for values in zip(carried, series)))
+                        order = numpy.lexsort((series.timestamp, series.place_uid))
+                        series = NBTimeSeries.FillSeries(*(values[order] for values in series))
+                    events = NBTimeSeries.events(series)
+                    if len(events.timestamp):
+                        num_written += self._write_events(events)
+                        self.conn.commit()
+                    # last row of every place, the previous state for the first row of the next window. Carried rows
+                    # are part of the series, so places without rows in this window keep theirs
+                    is_last = numpy.append(series.place_uid[1:] != series.place_uid[:-1], True)
+                    carried = NBTimeSeries.FillSeries(*(values[is_last] for values in series))
+        NBMetrics.metrics.count("events_written", num_written)
+        return num_written
+
+    def get_place_series(self, place_uid, start, end):
+        """Returns the FillSeries of a single place from start to end"""
+        return self.get_fill_series([place_uid], start, end)
+
+    def get_city_series(self, city_uid, start, end):
+        """Returns the FillSeries of all places of a city from start to end"""
+        return self.get_fill_series(self.master_db.get_places_from_city(city_uid), start, end)
+
+    def get_domain_series(self, domain, start, end):
+        """Returns the FillSeries of all places of a domain from start to end"""
+        return self.get_fill_series(self.master_db.get_places_from_domain(domain), start, end)
@@ -0,0 +1,118 @@
+import collections
+import datetime
+import xml.etree.ElementTree as ElmTree
+
+# a single place from a status file together with the attributes of the city and domain it belongs to
+PlaceRecord = collections.namedtuple("PlaceRecord", ["domain", "city", "place"])
+
+
+def parse_status_time(time_string):
+    """Converts the query time found in the comment of a status file into a datetime"""
+    return datetime.datetime.strptime(time_string.strip(), "%d.%m.%Y %H:%M")
+
+
+def parse_status(body):
+    """Parses a complete status file (bytes or str) and returns its xml-tree and the time of query from its comment,
+    or None as time if the file has no such comment"""
+    parser = ElmTree.XMLPullParser(events=("start", "comment"))
+    parser.feed(body)
+    parser.close()
+    status_xml, status_time = None, None
+    for event, element in parser.read_events():
+        if event == "start" and status_xml is None:
+            status_xml = element
+        elif event == "comment" and status_time is None:
+            try:
+                status_time = parse_status_time(element.text)
+            except ValueError:
+                pass
+    if status_xml is None:
+        raise ElmTree.ParseError("Status file without root element")
+    return status_xml, status_time
+
+
+def iter_tree_records(status_xml, place_filter=None, include_empty=False):
+    """Yields the place records of an already parsed status xml-tree. With an NBPlaceFilter, domains and cities without
+    selected places are skipped without descending into them. If include_empty is true, cities without places and
+    domains without cities are yielded as records with place (and city) None"""
+    for domain in status_xml:
+        if place_filter and not place_filter.wants_domain(domain.attrib):
+            continue
+        if include_empty and len(domain) == 0:
+            yield PlaceRecord(domain.attrib, None, None)
+        for city in domain:
+            if place_filter and not place_filter.wants_city(city.attrib):
+                continue
+            if include_empty and len(city) == 0:
+                yield PlaceRecord(domain.attrib, city.attrib, None)
+            for place in city:
+                yield PlaceRecord(domain.attrib, city.attrib, place.attrib)
+
+
+class NBStatusStream:
+    """Incremental reader for status xml-files. Yields place records while the file is still being read and drops
+    every element once it has been handled, so memory use does not depend on the size of the file"""
+
+    def __init__(self, source, chunk_size=64 * 1024, place_filter=None, include_empty=False):
+        """"Takes a file-like object (an opened file or a http response) which will be read in chunks. With an
+        NBPlaceFilter, only places from cities with selected places are yielded. If include_empty is true, cities
+        without places and domains without cities are yielded as records with place (and city) None"""
+        self.source = source
+        self.chunk_size = chunk_size
+        self.place_filter = place_filter
+        self.include_empty = include_empty
+        self.status_time = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        """Closes the underlying source"""
+        self.source.close()
+
+    def __iter__(self):
+        parser = ElmTree.XMLPullParser(events=("start", "end", "comment"))
+        # open elements from the root down to the current one: root, domain, city, place
+        path = list()
+        # number of children seen of every open element, finished children are detached so they can't be counted
+        children = list()
+
+        chunk = self.source.read(self.chunk_size)
+        while chunk:
+            parser.feed(chunk)
+            yield from self._read_records(parser, path, children)
+            chunk = self.source.read(self.chunk_size)
+        parser.close()
+        yield from self._read_records(parser, path, children)
+
+    def _read_records(self, parser, path, children):
+        """Handles all pending parser events and yields a record for every completed place"""
+        place_filter = self.place_filter
+        for event, element in parser.read_events():
+            if event == "start":
+                if children:
+                    children[-1] += 1
+                path.append(element)
+                children.append(0)
+            elif event == "end":
+                path.pop()
+                num_children = children.pop()
+                if len(path) == 3 and (not place_filter or place_filter.wants_city(path[2].attrib)):
+                    yield PlaceRecord(path[1].attrib, path[2].attrib, element.attrib)
+                elif self.include_empty and num_children == 0:
+                    if len(path) == 2 and (not place_filter or place_filter.wants_city(element.attrib)):
+                        yield PlaceRecord(path[1].attrib, element.attrib, None)
+                    elif len(path) == 1 and (not place_filter or place_filter.wants_domain(element.attrib)):
+                        yield PlaceRecord(element.attrib, None, None)
+                # detach finished elements from their parent, so the tree never grows beyond a single branch
+                if path:
+                    path[-1].remove(element)
+            elif event == "comment" and self.status_time is None:
+                # the time of the query is given in a comment at the end of the file, other comments are ignored
+                try:
+                    self.status_time = parse_status_time(element.text)
+                except ValueError:
+                    pass
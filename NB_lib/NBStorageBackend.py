@@ -0,0 +1,464 @@
+import sqlite3
+
+try:
+    import duckdb
+except ImportError:  # duckdb is only needed for the duckdb backend, the sqlite backend works without it
+    duckdb = None
+
+from NB_lib import NBTimeSeries
+
+# errors of all storage engines, writers roll back on any of them
+ERRORS = (sqlite3.Error,) if duckdb is None else (sqlite3.Error, duckdb.Error)
+# errors of a locked database or a failing disk, a write may succeed when it is tried again
+TRANSIENT_ERRORS = (sqlite3.OperationalError,) if duckdb is None else (sqlite3.OperationalError, duckdb.IOException)
+# rollups of the fill rows and the length of their buckets in seconds, buckets are aligned to UTC
+ROLLUPS = (("hourly", 3600), ("daily", 86400))
+
+
+class NBStorageBackend:
+    """SQL which differs between storage engines: schema setup, bulk append of fill rows, range and aggregate reads of
+    the fill history and writes of master data records. Everything else is plain SQL run on the connection returned by
+    connect, which behaves like an sqlite3 connection: a transaction is always open until commit or rollback"""
+
+    name = None
+    # whether shard files can be attached to the connection
+    supports_shards = False
+
+    def connect(self, path):
+        raise NotImplementedError
+
+    def set_pragmas(self, conn, journal_mode, synchronous, cache_size):
+        """Tunes the connection, engines without these settings ignore them"""
+        pass
+
+    def table_exists(self, conn, schema, table):
+        raise NotImplementedError
+
+    def create_fill_schema(self, conn, schema):
+        """Creates stations_fill and the structures its reads need in schema, if necessary"""
+        raise NotImplementedError
+
+    def create_event_schema(self, conn, schema):
+        """Creates stations_events in schema, if necessary: one row per change of the bikes of a place with the
+        seconds since the previous state of the place and the bikes taken and returned in between"""
+        raise NotImplementedError
+
+    def create_current_schema(self, conn):
+        """Creates stations_current in the main database, if necessary: the latest state of every place"""
+        raise NotImplementedError
+
+    def upsert_current(self, conn, rows):
+        """Writes (timestamp, place_uid, bikes, free_racks) rows to stations_current, a row replaces the state of its
+        place only if it is newer"""
+        raise NotImplementedError
+
+    def read_current(self, conn):
+        """Returns the (timestamp, place_uid, bikes, free_racks) rows of stations_current"""
+        c = conn.cursor()
+        c.execute("SELECT timestamp, place_uid, bikes, free_racks FROM stations_current")
+        return c.fetchall()
+
+    def create_stage(self, conn):
+        """Creates the temporary table stations_fill_stage for rows whose time of query is not known yet"""
+        raise NotImplementedError
+
+    def append_rows(self, conn, table, rows, ignore_duplicates=True):
+        """Appends a batch of integer rows to table, with ignore_duplicates rows violating its unique key are ignored.
+        Returns the number of rows written"""
+        raise NotImplementedError
+
+    def execute_count(self, conn, statement, parameters=()):
+        """Runs an INSERT, UPDATE or DELETE statement and returns the number of rows changed"""
+        raise NotImplementedError
+
+    def read_fill_rows(self, conn, schema, places, start, end):
+        """Returns the (timestamp, place_uid, bikes, free_racks) rows of the places from the unix timestamps start to
+        end (both included), sorted by place_uid and timestamp"""
+        c = conn.cursor()
+        c.execute("SELECT timestamp, place_uid, bikes, free_racks FROM {}.stations_fill WHERE place_uid IN ({}) "
+                  "AND timestamp BETWEEN ? AND ? ORDER BY place_uid, timestamp".format(schema,
+                                                                                      ", ".join("?" * len(places))),
+                  list(places) + [start, end])
+        return c.fetchall()
+
+    def read_rollup_rows(self, conn, schema, places, start, end, resolution, seconds):
+        """Returns (bucket, place_uid, count, bikes_sum, bikes_min, bikes_max, free_racks_sum, free_racks_min,
+        free_racks_max) rows of the places for all buckets of seconds starting from start to end, sorted by place_uid
+        and bucket"""
+        raise NotImplementedError
+
+    def read_last_states(self, conn, schema):
+        """Returns (place_uid, bikes, free_racks, timestamp) of the latest row of every place"""
+        raise NotImplementedError
+
+    @staticmethod
+    def _time_column(table):
+        """Returns the column holding the time of stations_fill or a rollup table"""
+        return "timestamp" if table == "stations_fill" else "bucket"
+
+    @staticmethod
+    def _places_query(schema, table):
+        """Returns a query of the place_uids of stations_fill or a rollup table. Every layout has an index led by
+        place_uid, so each place is found by a single seek for the next larger one instead of a scan of the table"""
+        return ("WITH RECURSIVE places(place_uid) AS (SELECT MIN(place_uid) FROM {0}.{1} UNION ALL "
+                "SELECT (SELECT MIN(place_uid) FROM {0}.{1} WHERE place_uid > places.place_uid) FROM places "
+                "WHERE places.place_uid IS NOT NULL) SELECT place_uid FROM places WHERE place_uid IS NOT NULL"
+                .format(schema, table))
+
+    def oldest_timestamp(self, conn, schema, table):
+        """Returns the unix timestamp of the oldest row of stations_fill or the oldest bucket of a rollup table, None
+        if the table is empty or does not exist. The oldest time of every place is read from the start of its range
+        of the index"""
+        if not self.table_exists(conn, schema, table):
+            return None
+        c = conn.cursor()
+        c.execute("SELECT MIN((SELECT MIN({2}) FROM {0}.{1} WHERE {1}.place_uid = expiring.place_uid)) FROM ({3}) "
+                  "AS expiring".format(schema, table, self._time_column(table), self._places_query(schema, table)))
+        return c.fetchone()[0]
+
+    def prune_rows(self, conn, schema, table, before, batch_size):
+        """Deletes the rows older than the unix timestamp before from stations_fill or a rollup table. The expired rows
+        of every place are the start of its key range, so they are deleted place by place without a scan of the table.
+        Yields the number of rows deleted after every batch of at least batch_size rows and after the last place, the
+        caller commits in between and may stop at any batch"""
+        if not self.table_exists(conn, schema, table):
+            return
+        c = conn.cursor()
+        c.execute(self._places_query(schema, table))
+        statement = "DELETE FROM {}.{} WHERE place_uid = ? AND {} < ?".format(schema, table, self._time_column(table))
+        num_batch = 0
+        for place_uid, in c.fetchall():
+            num_batch += self.execute_count(conn, statement, (place_uid, before))
+            if num_batch >= batch_size:
+                yield num_batch
+                num_batch = 0
+        if num_batch > 0:
+            yield num_batch
+
+    def insert_rows(self, conn, table, rows, key, update=()):
+        """Upserts master data records, rows of any type with a value for every column of table. key are the columns
+        of a unique key of table: a row matching a stored record on them only sets the update columns of that record,
+        so writing a record twice never fails. Without update columns, stored records are kept as they are"""
+        rows = list(rows)
+        if not rows:
+            return
+        action = "NOTHING"
+        if update:
+            action = "UPDATE SET " + ", ".join("{0} = excluded.{0}".format(column) for column in update)
+        conn.cursor().executemany("INSERT INTO {} VALUES ({}) ON CONFLICT ({}) DO {}".format(
+            table, ", ".join("?" * len(rows[0])), ", ".join(key), action), rows)
+
+    def update_rows(self, conn, table, columns, key, rows):
+        """Sets columns of the master data records whose key column matches, rows are the new values followed by the
+        key"""
+        conn.cursor().executemany("UPDATE {} SET {} WHERE {} = ?".format(
+            table, ", ".join("{} = ?".format(column) for column in columns), key), rows)
+
+
+class SQLiteBackend(NBStorageBackend):
+    """Default backend: stations_fill clustered on (place_uid, timestamp), so the rows of a place are a single range,
+    and rollup tables kept up to date by triggers. Databases created before the clustered layout keep a row store with
+    a covering index for range reads until they are migrated"""
+
+    name = "sqlite"
+    supports_shards = True
+
+    JOURNAL_MODES = ("DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF")
+    SYNCHRONOUS_LEVELS = ("OFF", "NORMAL", "FULL", "EXTRA")
+
+    def connect(self, path):
+        # shards are attached by uri, so they can be attached read-only. The connection may be handed to the writer
+        # thread of the spooled mode, it is never used by two threads at once
+        return sqlite3.connect(path, uri=True, check_same_thread=False)
+
+    def set_pragmas(self, conn, journal_mode, synchronous, cache_size):
+        """"Tunes the connection; with WAL, readers of the database do not block the crawler and vice versa"""
+        c = conn.cursor()
+        # pragmas do not take parameters, so the values are checked before they are put into the statement
+        if journal_mode:
+            if journal_mode.upper() not in self.JOURNAL_MODES:
+                raise ValueError("Unknown journal mode '{}'".format(journal_mode))
+            c.execute("PRAGMA journal_mode = {}".format(journal_mode.upper()))
+        if synchronous:
+            if synchronous.upper() not in self.SYNCHRONOUS_LEVELS:
+                raise ValueError("Unknown synchronous level '{}'".format(synchronous))
+            c.execute("PRAGMA synchronous = {}".format(synchronous.upper()))
+        if cache_size:
+            c.execute("PRAGMA cache_size = {}".format(int(cache_size)))
+
+    def set_schema_pragmas(self, conn, schema, journal_mode, synchronous):
+        """"Sets the pragmas of the connection on an attached database"""
+        c = conn.cursor()
+        if journal_mode:
+            c.execute("PRAGMA {}.journal_mode = {}".format(schema, journal_mode.upper()))
+        if synchronous:
+            c.execute("PRAGMA {}.synchronous = {}".format(schema, synchronous.upper()))
+
+    def table_exists(self, conn, schema, table):
+        c = conn.cursor()
+        # noinspection SqlResolve
+        c.execute("SELECT 1 FROM {}.sqlite_master WHERE tbl_name = ? AND type = 'table'".format(schema), (table,))
+        return c.fetchone() is not None
+
+    def create_clustered_fill_table(self, conn, schema, table):
+        """"Creates table in the clustered layout of stations_fill: the primary key is the table itself, so there is
+        neither a rowid nor an index holding a second copy of the rows. Integers are stored in as few bytes as their
+        values need, one for bikes and four for timestamps"""
+        conn.cursor().execute("CREATE TABLE IF NOT EXISTS {}.`{}` ( `timestamp` INTEGER NOT NULL, "
+                              "`place_uid` INTEGER NOT NULL, `bikes` INTEGER NOT NULL, `free_racks` INTEGER NOT NULL, "
+                              "PRIMARY KEY(`place_uid`, `timestamp`) ) WITHOUT ROWID".format(schema, table))
+
+    def is_clustered(self, conn, schema):
+        """Returns true if stations_fill of schema is in the clustered layout, false for the row store"""
+        c = conn.cursor()
+        # noinspection SqlResolve
+        c.execute("SELECT sql FROM {}.sqlite_master WHERE name = 'stations_fill' AND type = 'table'".format(schema))
+        row = c.fetchone()
+        return row is not None and "WITHOUT ROWID" in row[0].upper()
+
+    def create_fill_schema(self, conn, schema):
+        # check if database contains a table with transaction data; create table if necessary
+        if not self.table_exists(conn, schema, "stations_fill"):
+            self.create_clustered_fill_table(conn, schema, "stations_fill")
+        elif not self.is_clustered(conn, schema):
+            # covering index for range reads, so series queries never touch the table itself
+            conn.cursor().execute("CREATE INDEX IF NOT EXISTS {}.`stations_fill_series` ON `stations_fill` "
+                                  "( `place_uid`, `timestamp`, `bikes`, `free_racks` )".format(schema))
+        self._create_rollups(conn, schema)
+
+    def _create_rollups(self, conn, schema):
+        """"Creates the hourly and daily rollup tables with count, min, max and sum of bikes and free_racks per place
+        and bucket. A trigger adds every row inserted into stations_fill to the buckets it falls in, so the rollups
+        are updated incrementally in the transaction of the insert and rows ignored as duplicates are not counted.
+        Rollups of an existing database are built once from its rows. In storage mode 'changes' the rollups
+        aggregate the stored changes"""
+        c = conn.cursor()
+        for name, seconds in ROLLUPS:
+            table = "stations_fill_" + name
+            if self.table_exists(conn, schema, table):
+                continue
+            c.execute("CREATE TABLE {}.`{}` ( `place_uid` INTEGER NOT NULL, `bucket` INTEGER NOT NULL, "
+                      "`count` INTEGER NOT NULL, `bikes_min` INTEGER NOT NULL, `bikes_max` INTEGER NOT NULL, "
+                      "`bikes_sum` INTEGER NOT NULL, `free_racks_min` INTEGER NOT NULL, "
+                      "`free_racks_max` INTEGER NOT NULL, `free_racks_sum` INTEGER NOT NULL, "
+                      "PRIMARY KEY(`place_uid`, `bucket`) ) WITHOUT ROWID".format(schema, table))
+            c.execute("INSERT INTO {2}.`{0}` SELECT place_uid, timestamp - timestamp % {1}, COUNT(*), MIN(bikes), "
+                      "MAX(bikes), SUM(bikes), MIN(free_racks), MAX(free_racks), SUM(free_racks) "
+                      "FROM {2}.stations_fill GROUP BY place_uid, timestamp - timestamp % {1}".format(table, seconds,
+                                                                                                     schema))
+        self.create_rollup_triggers(conn, schema)
+
+    def create_rollup_triggers(self, conn, schema):
+        """"Creates the triggers adding the rows inserted into stations_fill of schema to its rollups, if necessary"""
+        c = conn.cursor()
+        for name, seconds in ROLLUPS:
+            table = "stations_fill_" + name
+            # the trigger lives in the schema of its table, so its statements refer to the rollup of that schema
+            c.execute("CREATE TRIGGER IF NOT EXISTS {2}.`{0}_insert` AFTER INSERT ON stations_fill BEGIN "
+                      "INSERT INTO `{0}` VALUES (NEW.place_uid, NEW.timestamp - NEW.timestamp % {1}, 1, "
+                      "NEW.bikes, NEW.bikes, NEW.bikes, NEW.free_racks, NEW.free_racks, NEW.free_racks) "
+                      "ON CONFLICT (place_uid, bucket) DO UPDATE SET count = count + 1, "
+                      "bikes_min = MIN(bikes_min, excluded.bikes_min), bikes_max = MAX(bikes_max, excluded.bikes_max), "
+                      "bikes_sum = bikes_sum + excluded.bikes_sum, "
+                      "free_racks_min = MIN(free_racks_min, excluded.free_racks_min), "
+                      "free_racks_max = MAX(free_racks_max, excluded.free_racks_max), "
+                      "free_racks_sum = free_racks_sum + excluded.free_racks_sum; END".format(table, seconds, schema))
+
+    def create_event_schema(self, conn, schema):
+        # clustered on place and time, so the events of a place are a single range read
+        conn.cursor().execute("CREATE TABLE IF NOT EXISTS {}.`stations_events` ( `place_uid` INTEGER NOT NULL, "
+                              "`timestamp` INTEGER NOT NULL, `gap` INTEGER NOT NULL, `taken` INTEGER NOT NULL, "
+                              "`returned` INTEGER NOT NULL, PRIMARY KEY(`place_uid`, `timestamp`) ) WITHOUT ROWID"
+                              .format(schema))
+
+    def create_current_schema(self, conn):
+        conn.cursor().execute("CREATE TABLE IF NOT EXISTS `stations_current` ( `timestamp` INTEGER NOT NULL, "
+                              "`place_uid` INTEGER NOT NULL, `bikes` INTEGER NOT NULL, `free_racks` INTEGER NOT NULL, "
+                              "PRIMARY KEY(`place_uid`) ) WITHOUT ROWID")
+
+    def upsert_current(self, conn, rows):
+        conn.cursor().executemany("INSERT INTO stations_current VALUES (?, ?, ?, ?) ON CONFLICT (place_uid) DO UPDATE "
+                                  "SET timestamp = excluded.timestamp, bikes = excluded.bikes, "
+                                  "free_racks = excluded.free_racks WHERE excluded.timestamp > timestamp", rows)
+
+    def create_stage(self, conn):
+        conn.cursor().execute("CREATE TEMP TABLE IF NOT EXISTS `stations_fill_stage` ( `place_uid` INTEGER NOT NULL, "
+                              "`bikes` INTEGER NOT NULL, `free_racks` INTEGER NOT NULL)")
+
+    def append_rows(self, conn, table, rows, ignore_duplicates=True):
+        c = conn.cursor()
+        c.executemany("INSERT {}INTO {} VALUES ({})".format("OR IGNORE " if ignore_duplicates else "", table,
+                                                             ", ".join("?" * len(rows[0]))), rows)
+        return c.rowcount
+
+    def execute_count(self, conn, statement, parameters=()):
+        c = conn.cursor()
+        c.execute(statement, parameters)
+        return c.rowcount
+
+    def read_fill_rows(self, conn, schema, places, start, end):
+        if self.is_clustered(conn, schema):
+            return super().read_fill_rows(conn, schema, places, start, end)
+        c = conn.cursor()
+        c.execute("SELECT timestamp, place_uid, bikes, free_racks FROM {}.stations_fill "
+                  "INDEXED BY stations_fill_series WHERE place_uid IN ({}) AND timestamp BETWEEN ? AND ? "
+                  "ORDER BY place_uid, timestamp".format(schema, ", ".join("?" * len(places))),
+                  list(places) + [start, end])
+        return c.fetchall()
+
+    def read_rollup_rows(self, conn, schema, places, start, end, resolution, seconds):
+        c = conn.cursor()
+        c.execute("SELECT bucket, place_uid, count, bikes_sum, bikes_min, bikes_max, free_racks_sum, "
+                  "free_racks_min, free_racks_max FROM {}.stations_fill_{} WHERE place_uid IN ({}) "
+                  "AND bucket BETWEEN ? AND ? ORDER BY place_uid, bucket".format(schema, resolution,
+                                                                                ", ".join("?" * len(places))),
+                  list(places) + [start, end])
+        return c.fetchall()
+
+    def read_last_states(self, conn, schema):
+        c = conn.cursor()
+        # sqlite takes the bare columns from the row holding the maximum
+        c.execute("SELECT place_uid, bikes, free_racks, MAX(timestamp) FROM {}.stations_fill "
+                  "GROUP BY place_uid".format(schema))
+        return c.fetchall()
+
+
+class _DuckDBConnection:
+    """Gives a duckdb connection the transactions of an sqlite3 connection: a transaction is always open, commit and
+    rollback end it and open the next one. Cursors of duckdb are connections of their own, so the connection itself
+    is returned as cursor to keep all statements in one transaction"""
+
+    def __init__(self, conn):
+        self._conn = conn
+        self._conn.begin()
+
+    def cursor(self):
+        return self._conn
+
+    def execute(self, *args):
+        return self._conn.execute(*args)
+
+    def executemany(self, *args):
+        return self._conn.executemany(*args)
+
+    def commit(self):
+        self._conn.commit()
+        self._conn.begin()
+
+    def rollback(self):
+        self._conn.rollback()
+        self._conn.begin()
+
+    def close(self):
+        self._conn.commit()
+        self._conn.close()
+
+
+class DuckDBBackend(NBStorageBackend):
+    """Column store for fast aggregate scans over the fill history. Rollups need no tables of their own, they are
+    aggregated from stations_fill when they are read. Needs the duckdb and numpy packages"""
+
+    name = "duckdb"
+
+    def connect(self, path):
+        if duckdb is None:
+            raise ImportError("duckdb is required for the duckdb storage backend")
+        NBTimeSeries.require_numpy()
+        return _DuckDBConnection(duckdb.connect(path))
+
+    def table_exists(self, conn, schema, table):
+        c = conn.cursor()
+        c.execute("SELECT 1 FROM information_schema.tables WHERE table_schema = ? AND table_name = ?", (schema, table))
+        return c.fetchone() is not None
+
+    def create_fill_schema(self, conn, schema):
+        # the unique key is kept, so duplicate rows are ignored like in sqlite
+        conn.cursor().execute("CREATE TABLE IF NOT EXISTS {}.stations_fill ( timestamp BIGINT NOT NULL, "
+                              "place_uid INTEGER NOT NULL, bikes INTEGER NOT NULL, free_racks INTEGER NOT NULL, "
+                              "UNIQUE ( place_uid, timestamp ) )".format(schema))
+
+    def create_event_schema(self, conn, schema):
+        conn.cursor().execute("CREATE TABLE IF NOT EXISTS {}.stations_events ( place_uid INTEGER NOT NULL, "
+                              "timestamp BIGINT NOT NULL, gap INTEGER NOT NULL, taken INTEGER NOT NULL, "
+                              "returned INTEGER NOT NULL, PRIMARY KEY ( place_uid, timestamp ) )".format(schema))
+
+    def create_current_schema(self, conn):
+        conn.cursor().execute("CREATE TABLE IF NOT EXISTS stations_current ( timestamp BIGINT NOT NULL, "
+                              "place_uid INTEGER NOT NULL, bikes INTEGER NOT NULL, free_racks INTEGER NOT NULL, "
+                              "PRIMARY KEY ( place_uid ) )")
+
+    def upsert_current(self, conn, rows):
+        rows = list(rows)
+        if not rows:
+            return
+        data = NBTimeSeries.numpy.array(rows, dtype=NBTimeSeries.numpy.int64).reshape(len(rows), 4)
+        c = conn.cursor()
+        c.register("stations_current_batch", {"c{}".format(column): data[:, column] for column in range(4)})
+        try:
+            c.execute("INSERT INTO stations_current SELECT * FROM stations_current_batch ON CONFLICT (place_uid) "
+                      "DO UPDATE SET timestamp = excluded.timestamp, bikes = excluded.bikes, "
+                      "free_racks = excluded.free_racks WHERE excluded.timestamp > stations_current.timestamp")
+        finally:
+            c.unregister("stations_current_batch")
+
+    def create_stage(self, conn):
+        conn.cursor().execute("CREATE TEMP TABLE IF NOT EXISTS stations_fill_stage ( place_uid INTEGER NOT NULL, "
+                              "bikes INTEGER NOT NULL, free_racks INTEGER NOT NULL )")
+
+    def append_rows(self, conn, table, rows, ignore_duplicates=True):
+        # rows bound one by one are slow in duckdb, so the batch is scanned from numpy arrays instead
+        data = NBTimeSeries.numpy.array(rows, dtype=NBTimeSeries.numpy.int64).reshape(len(rows), -1)
+        c = conn.cursor()
+        c.register("stations_fill_batch", {"c{}".format(column): data[:, column] for column in range(data.shape[1])})
+        try:
+            # duckdb only ignores rows of tables with a unique key
+            return c.execute("INSERT {}INTO {} SELECT * FROM stations_fill_batch".format(
+                "OR IGNORE " if ignore_duplicates else "", table)).fetchone()[0]
+        finally:
+            c.unregister("stations_fill_batch")
+
+    def execute_count(self, conn, statement, parameters=()):
+        # duckdb returns the number of rows changed as result of the statement
+        return conn.cursor().execute(statement, parameters).fetchone()[0]
+
+    def read_rollup_rows(self, conn, schema, places, start, end, resolution, seconds):
+        # the buckets from start to end hold the rows from the start of the first bucket to the end of the last one
+        first = -(-start // seconds) * seconds
+        last = (end // seconds + 1) * seconds
+        c = conn.cursor()
+        c.execute("SELECT timestamp - timestamp % {0} AS bucket, place_uid, COUNT(*), SUM(bikes), MIN(bikes), "
+                  "MAX(bikes), SUM(free_racks), MIN(free_racks), MAX(free_racks) FROM {1}.stations_fill "
+                  "WHERE place_uid IN ({2}) AND timestamp >= ? AND timestamp < ? GROUP BY place_uid, bucket "
+                  "ORDER BY place_uid, bucket".format(seconds, schema, ", ".join("?" * len(places))),
+                  list(places) + [first, last])
+        return c.fetchall()
+
+    def oldest_timestamp(self, conn, schema, table):
+        if not self.table_exists(conn, schema, table):
+            return None
+        # the minimum is taken from the statistics of the row groups of the column
+        return conn.cursor().execute("SELECT MIN({}) FROM {}.{}".format(self._time_column(table), schema,
+                                                                        table)).fetchone()[0]
+
+    def prune_rows(self, conn, schema, table, before, batch_size):
+        if not self.table_exists(conn, schema, table):
+            return
+        # without an index led by place_uid, a single delete scans the column once instead of once per place
+        yield self.execute_count(conn, "DELETE FROM {}.{} WHERE {} < ?".format(schema, table, self._time_column(table)),
+                                 (before,))
+
+    def read_last_states(self, conn, schema):
+        c = conn.cursor()
+        c.execute("SELECT place_uid, arg_max(bikes, timestamp), arg_max(free_racks, timestamp), MAX(timestamp) "
+                  "FROM {}.stations_fill GROUP BY place_uid".format(schema))
+        return c.fetchall()
+
+
+BACKENDS = {backend.name: backend for backend in (SQLiteBackend, DuckDBBackend)}
+
+
+def get_backend(name):
+    """Returns the backend named 'sqlite' or 'duckdb'"""
+    if name not in BACKENDS:
+        raise ValueError("Unknown storage backend '{}'".format(name))
+    return BACKENDS[name]()
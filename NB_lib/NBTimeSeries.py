@@ -0,0 +1,91 @@
+import collections
+
+try:
+    import numpy
+except ImportError:  # numpy is only needed for time series, crawling works without it
+    numpy = None
+
+# fill levels of one or more places as numpy arrays of equal length, sorted by place_uid and timestamp
+FillSeries = collections.namedtuple("FillSeries", ["timestamp", "place_uid", "bikes", "free_racks"])
+
+# aggregated fill levels per bucket (and place), every field is a numpy array with one entry per group
+ResampledSeries = collections.namedtuple("ResampledSeries", [
+    "bucket", "place_uid", "count", "bikes_mean", "bikes_min", "bikes_max",
+    "free_racks_mean", "free_racks_min", "free_racks_max", "occupancy"])
+
+# changes of the bikes of a place between two consecutive states: seconds since the previous state and the bikes taken
+# and returned in between, sorted by place_uid and timestamp
+EventSeries = collections.namedtuple("EventSeries", ["place_uid", "timestamp", "gap", "taken", "returned"])
+
+
+def require_numpy():
+    if numpy is None:
+        raise ImportError("numpy is required for time series queries")
+
+
+def series_from_rows(rows):
+    """Returns a FillSeries of (timestamp, place_uid, bikes, free_racks) rows"""
+    require_numpy()
+    data = numpy.array(rows, dtype=numpy.int64).reshape(-1, 4)
+    return FillSeries(data[:, 0].copy(), data[:, 1].copy(), data[:, 2].copy(), data[:, 3].copy())
+
+
+def occupancy(series):
+    """Returns the share of occupied racks bikes / (bikes + free_racks) of every row, NaN where a place has no racks"""
+    require_numpy()
+    total = series.bikes + series.free_racks
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        return numpy.where(total > 0, series.bikes / total, numpy.nan)
+
+
+def resample(series, bucket_seconds, by_place=True, origin=0):
+    """Aggregates a FillSeries to fixed buckets of bucket_seconds, aligned to origin (unix time). Returns a
+    ResampledSeries with count, mean, min and max of bikes and free_racks and the mean occupancy of every bucket, per
+    place if by_place is true, else over all places together (place_uid is -1 then). All work is done on whole arrays"""
+    require_numpy()
+    bucket = origin + (series.timestamp - origin) // bucket_seconds * bucket_seconds
+    place_uid = series.place_uid if by_place else numpy.full(len(bucket), -1, dtype=numpy.int64)
+
+    # sort rows by group, the groups are then contiguous and can be reduced at their start indices
+    order = numpy.lexsort((bucket, place_uid))
+    bucket, place_uid = bucket[order], place_uid[order]
+    bikes, free_racks = series.bikes[order], series.free_racks[order]
+    ratio = occupancy(FillSeries(None, None, bikes, free_racks))
+
+    if len(order) == 0:
+        starts = numpy.zeros(0, dtype=numpy.int64)
+    else:
+        changed = (numpy.diff(bucket) != 0) | (numpy.diff(place_uid) != 0)
+        starts = numpy.concatenate(([0], numpy.flatnonzero(changed) + 1))
+    count = numpy.diff(numpy.append(starts, len(order)))
+
+    def reduce(ufunc, values):
+        if len(starts) == 0:
+            return values[:0]
+        return ufunc.reduceat(values, starts)
+
+    valid = ~numpy.isnan(ratio)
+    ratio_count = reduce(numpy.add, valid.astype(numpy.int64))
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        ratio_mean = reduce(numpy.add, numpy.where(valid, ratio, 0.0)) / ratio_count
+
+    return ResampledSeries(bucket=bucket[starts], place_uid=place_uid[starts], count=count,
+                           bikes_mean=reduce(numpy.add, bikes) / count,
+                           bikes_min=reduce(numpy.minimum, bikes), bikes_max=reduce(numpy.maximum, bikes),
+                           free_racks_mean=reduce(numpy.add, free_racks) / count,
+                           free_racks_min=reduce(numpy.minimum, free_racks),
+                           free_racks_max=reduce(numpy.maximum, free_racks),
+                           occupancy=ratio_mean)
+
+
+def events(series):
+    """Returns an EventSeries of a FillSeries sorted by place_uid and timestamp: an event for every row whose bikes
+    differ from the previous row of the same place. All work is done on whole arrays"""
+    require_numpy()
+    same_place = series.place_uid[1:] == series.place_uid[:-1]
+    delta = series.bikes[1:] - series.bikes[:-1]
+    changed = same_place & (delta != 0)
+    delta = delta[changed]
+    return EventSeries(place_uid=series.place_uid[1:][changed], timestamp=series.timestamp[1:][changed],
+                       gap=(series.timestamp[1:] - series.timestamp[:-1])[changed],
+                       taken=numpy.maximum(-delta, 0), returned=numpy.maximum(delta, 0))
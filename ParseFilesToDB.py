@@ -1,5 +1,5 @@
 # for accessing the database and the CLI-Interface
-from NB_lib import NBStationsDataDB, NBCLI
+from NB_lib import NBStationsDataDB, NBStatusStream, NBBackfill, NBCLI, NBMetrics
 from datetime import datetime
 
 # for some file operations
@@ -9,38 +9,58 @@ import os
 import xml.etree.ElementTree as ElmTree
 
 
-def parse_file(file, bike_status_db):
-    # get xml data from datafile
-    try:
-        xml_tree = ElmTree.parse(file)
-        status_xml = xml_tree.getroot()
-    except (ElmTree.ParseError, ValueError):
-        print("Could not parse XML-File", file)
-        return
+def file_time(file):
+    """Returns the time of the status from the end of a legacy file name like 'NB_DATA_2016-10-18-12h05m.xml', hours
+    and minutes may be padded with spaces instead of zeros. Raises a ValueError for other names"""
+    return datetime.strptime(file[-21:-4].replace(' ', '0'), "%Y-%m-%d-%Hh%Mm")
+
+
+def chronological(paths):
+    """Sorts paths by the time in their file names. The names are not sorted themselves, as their prefixes may differ
+    and a space padded hour sorts before a zero padded one. Names without a time come last, parse_file reports them"""
+    def key(path):
+        try:
+            return file_time(path), path
+        except ValueError:
+            return datetime.max, path
+    return sorted(paths, key=key)
+
 
+def parse_file(file):
+    """Parses a legacy xml-file and returns the time of the status and a list of (place_uid, bikes, free_racks) rows,
+    or None if the file could not be parsed. Runs in the worker processes of the backfill"""
     # get time / place info from filename
     try:
-        status_time = datetime.strptime(file[-21:-4].replace(' ', '0'), "%Y-%m-%d-%Hh%Mm")
+        status_time = file_time(file)
     except ValueError:
         print("Could not convert filename '", file, "' to datetime")
-        return
+        return None
 
-    # add data and time data if data from file was parsed
-    bike_status_db.add_state_country_level(status_xml, status_time)
-    print("File ", file, " parsed and data saved in DB.")
+    # get rows from datafile, the file is streamed so no xml-tree is kept in memory
+    try:
+        with NBStatusStream.NBStatusStream(open(file, "rb")) as stream:
+            rows = [NBStationsDataDB.fill_values(record.place) for record in stream]
+    except (ElmTree.ParseError, ValueError):
+        print("Could not parse XML-File", file)
+        return None
+
+    return status_time, rows
 
 
 if __name__ == '__main__':
     # parse command line arguments and read config files
     config = NBCLI.NBCLI()
 
-    # open database (this will also open all other depending databases)
-    stations_db = NBStationsDataDB.NBStationsDataDB(transactions_db_name=config.stations_transactions_db_file,
-                                                    master_data_db_name=config.stations_master_db_file,
-                                                    login_data_db_name=config.login_db_file,
-                                                    log_file=config.cmdl_args.logfile)
+    # open database, the master data opened by the config is shared
+    stations_db = config.open_stations_db()
 
-    # iteratively open files, get info from file names and save to db
+    # parse files in parallel, get info from file names and save to db; files finished before are skipped
+    # file names end with the time of the status, the files are written in its order, so change-only storage sees the
+    # states in chronological order
     path = config.cmdl_args.datadir
-    for filename in os.listdir(path):
-        parse_file(os.path.join(path, filename), stations_db)
+    backfill = NBBackfill.NBBackfill(stations_db, parse_file, workers=config.cmdl_args.workers)
+    with NBMetrics.metrics.stage("backfill"):
+        backfill.run(chronological(os.path.join(path, filename) for filename in os.listdir(path)))
+
+    # export stage timings and counters of this run
+    NBMetrics.metrics.write("parse_files_to_db")
@@ -0,0 +1,18 @@
+from NB_lib import NBCLI
+import time
+
+if __name__ == '__main__':
+
+    # parse command line arguments and read config files
+    config = NBCLI.NBCLI()
+    archive = config.master_data.snapshot_archive
+    if archive is None:
+        raise AssertionError("Please provide a snapshot archive dir in the database configuration")
+
+    # open database, the master data opened by the config is shared
+    stations_db = config.open_stations_db()
+
+    # add every archived snapshot, xml or GBFS, through the normal ingest path in chronological order
+    start = time.monotonic()
+    num_snapshots = stations_db.replay_snapshots(archive, places_list=config.place_filter)
+    print(num_snapshots, "snapshots replayed in {:.1f}s".format(time.monotonic() - start))
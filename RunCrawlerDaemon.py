@@ -0,0 +1,10 @@
+from NB_lib import NBCLI, NBCrawlerDaemon
+
+if __name__ == '__main__':
+
+    # parse command line arguments and read config files, this also opens and fills the master data
+    config = NBCLI.NBCLI()
+
+    # crawl until stopped, databases stay open between the crawls
+    daemon = NBCrawlerDaemon.NBCrawlerDaemon(config)
+    daemon.run()
@@ -1,15 +1,42 @@
-from NB_lib import NBCLI, NBStationsDataDB
+from NB_lib import NBCLI, NBMetrics, NBPipeline
 
 if __name__ == '__main__':
 
     # parse command line arguments and read config files
     config = NBCLI.NBCLI()
 
-    # open database (this will also open all other depending databases)
-    stations_db = NBStationsDataDB.NBStationsDataDB(transactions_db_name=config.stations_transactions_db_file,
-                                                    master_data_db_name=config.stations_master_db_file,
-                                                    login_data_db_name=config.login_db_file,
-                                                    log_file=config.cmdl_args.logfile)
+    # open database, the master data opened by the config is shared. With a spool, states left by earlier runs are
+    # written first and this run's state is safe on disk before it is written
+    stations_db = config.open_stations_db(spooled=True)
 
-    # write info from relevant stations to database
-    stations_db.add_current_state(config.places_list)
+    # write info from relevant stations to database, the master data can be updated from the same walk of the status
+    feed_fetcher = config.open_feed_fetcher()
+    if feed_fetcher is not None:
+        # the configured feeds are fetched at the same time, each is added with its own time of query
+        results = feed_fetcher.fetch_all()
+        feed_fetcher.close()
+        stations_db.add_feeds(results, config.place_filter)
+        if config.cmdl_args.update_master:
+            # feeds with station information (xml or GBFS) update the master data from the same download
+            changes_str = config.master_data.update_from_feeds(results)
+            if len(changes_str) > 0:
+                config.send_log_email(changes_str)
+    elif config.cmdl_args.update_master:
+        pipeline = NBPipeline.NBPipeline(config.master_data, stations_db, place_filter=config.place_filter,
+                                         streaming=config.cmdl_args.streaming)
+        pipeline.run()
+        if len(config.master_data.change_str) > 0:
+            config.send_log_email(config.master_data.change_str)
+    elif config.cmdl_args.streaming:
+        stations_db.add_current_state_stream(config.place_filter)
+    else:
+        stations_db.add_current_state(config.place_filter)
+
+    # apply the retention policy a batch at a time, so a crawl never spends long on it
+    if stations_db.spool is None:
+        stations_db.prune(max_batches=1)
+    # states which could not be written in time stay spooled for the next run
+    stations_db.stop_writer(config.spool_drain_timeout)
+
+    # export stage timings and counters of this run
+    NBMetrics.metrics.write("save_current_station_status")
@@ -0,0 +1,86 @@
+import datetime
+import json
+import os
+import random
+import xml.etree.ElementTree as ElmTree
+
+
+def generate_feed(num_domains=10, num_cities=10, num_places=20, seed=0,
+                  status_time=datetime.datetime(2016, 10, 18, 12, 0), legacy_quirks=True):
+    """Returns a deterministic NextBike-style status xml as bytes with num_domains domains, num_cities cities per
+    domain and num_places places per city. With legacy_quirks, some places report '5+' bikes or no free_racks"""
+    rnd = random.Random(seed)
+    lines = ['<?xml version="1.0" encoding="utf-8"?>', "<markers>"]
+    place_uid = 100000
+    for domain in range(num_domains):
+        lines.append('<country lat="{:.4f}" lng="{:.4f}" name="Domain {}" domain="d{}" country="DE" '
+                     'country_name="Germany">'.format(rnd.uniform(47, 55), rnd.uniform(6, 15), domain, domain))
+        for city in range(num_cities):
+            city_uid = domain * 1000 + city + 1
+            lat, lng = rnd.uniform(47, 55), rnd.uniform(6, 15)
+            lines.append('<city uid="{}" lat="{:.4f}" lng="{:.4f}" name="City {}-{}" num_places="{}">'.format(
+                city_uid, lat, lng, domain, city, num_places))
+            for place in range(num_places):
+                place_uid += 1
+                bikes = str(rnd.randint(0, 9))
+                free_racks = ' free_racks="{}"'.format(rnd.randint(0, 12))
+                if legacy_quirks and rnd.random() < 0.1:
+                    bikes = "5+"
+                if legacy_quirks and rnd.random() < 0.1:
+                    free_racks = ""
+                lines.append('<place uid="{}" lat="{:.5f}" lng="{:.5f}" name="Station {}" spot="1" number="{}" '
+                             'bikes="{}" bike_racks="12" terminal_type="free"{}/>'.format(
+                                 place_uid, lat + rnd.uniform(-0.05, 0.05), lng + rnd.uniform(-0.05, 0.05),
+                                 place_uid, place_uid, bikes, free_racks))
+            lines.append("</city>")
+        lines.append("</country>")
+    lines.append("</markers>")
+    lines.append("<!-- {} -->".format(status_time.strftime("%d.%m.%Y %H:%M")))
+    return "\n".join(lines).encode()
+
+
+GBFS_FILES = ("station_information", "station_status", "system_information", "system_regions")
+
+
+def generate_gbfs_feed(num_domains=10, num_cities=10, num_places=20, seed=0,
+                       status_time=datetime.datetime(2016, 10, 18, 12, 0), files=GBFS_FILES):
+    """Returns the stations of generate_feed with the same arguments as GBFS-style JSON bytes: an object with the
+    given files under their names, or the file itself if a single one is given. Cities become regions, the legacy
+    '5+' bikes and missing free_racks become 5 and 0"""
+    status_xml = ElmTree.fromstring(generate_feed(num_domains, num_cities, num_places, seed, status_time))
+    last_updated = int(status_time.timestamp())
+    information, status, regions = list(), list(), list()
+    for domain in status_xml:
+        for city in domain:
+            regions.append({"region_id": city.get("uid"), "name": city.get("name")})
+            for place in city:
+                information.append({"station_id": place.get("uid"), "name": place.get("name"),
+                                     "short_name": place.get("number"), "lat": float(place.get("lat")),
+                                     "lon": float(place.get("lng")), "region_id": city.get("uid"),
+                                     "capacity": int(place.get("bike_racks"))})
+                bikes = place.get("bikes")
+                status.append({"station_id": place.get("uid"),
+                               "num_bikes_available": 5 if bikes == "5+" else int(bikes),
+                               "num_docks_available": int(place.get("free_racks", 0)), "is_installed": True,
+                               "is_renting": True, "is_returning": True, "last_reported": last_updated})
+    documents = {"station_information": {"stations": information}, "station_status": {"stations": status},
+                 "system_information": {"system_id": "gbfs", "name": "GBFS System"},
+                 "system_regions": {"regions": regions}}
+    documents = {name: {"last_updated": last_updated, "ttl": 60, "data": documents[name]} for name in files}
+    return json.dumps(documents[files[0]] if len(files) == 1 else documents, separators=(",", ":")).encode()
+
+
+def generate_directory(path, num_files=10, interval=datetime.timedelta(minutes=5), **feed_args):
+    """Writes num_files legacy status files into path, named with their time like the files of ParseFilesToDB, and
+    returns their paths"""
+    os.makedirs(path, exist_ok=True)
+    status_time = feed_args.pop("status_time", datetime.datetime(2016, 10, 18, 12, 0))
+    seed = feed_args.pop("seed", 0)
+    paths = list()
+    for index in range(num_files):
+        file_time = status_time + index * interval
+        file_path = os.path.join(path, "NB_DATA_{}.xml".format(file_time.strftime("%Y-%m-%d-%Hh%Mm")))
+        with open(file_path, "wb") as file:
+            file.write(generate_feed(seed=seed + index, status_time=file_time, **feed_args))
+        paths.append(file_path)
+    return paths
@@ -0,0 +1,214 @@
+import argparse
+import contextlib
+import json
+import os
+import platform
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import feed_generator
+import stub_server
+
+# the benchmarks run against the library and scripts of this checkout
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from NB_lib import NBBackfill, NBFeedFetcher, NBFeedParser, NBMasterDataDB, NBPipeline, NBPlaceFilter, \
+    NBStationsDataDB  # noqa: E402
+import ParseFilesToDB  # noqa: E402
+
+
+def measure(run, setup=None, repeats=5):
+    """Times run(setup()) repeats times and traces the peak memory of one more run. The setup is not timed"""
+    times = list()
+    for _ in range(repeats):
+        args = setup() if setup else ()
+        start = time.perf_counter()
+        run(*args)
+        times.append(time.perf_counter() - start)
+
+    args = setup() if setup else ()
+    tracemalloc.start()
+    run(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {"best_s": min(times), "mean_s": sum(times) / len(times), "runs": len(times), "peak_bytes": peak}
+
+
+class Bench:
+    """Creates the databases of a benchmark in a temporary directory and runs all benchmarks against a stub server"""
+
+    def __init__(self, directory, server, repeats):
+        self.directory = directory
+        self.server = server
+        self.repeats = repeats
+        self.counter = 0
+
+        self.login_db = os.path.join(directory, "login.db")
+        conn = sqlite3.connect(self.login_db)
+        conn.execute("CREATE TABLE urls (name TEXT, url TEXT)")
+        conn.execute("INSERT INTO urls VALUES ('StationList', ?)", (server.url,))
+        conn.commit()
+        conn.close()
+
+        # filled master data shared by the ingest benchmarks
+        self.master_file = self.path("master")
+        self.master = self.new_master(self.master_file)
+        self.master.update_db()
+
+    def path(self, name):
+        self.counter += 1
+        return os.path.join(self.directory, "{}_{}.db".format(name, self.counter))
+
+    def new_master(self, master_file=None):
+        """Opens a master database, a new one if no file is given. Every object starts without a cached download"""
+        return NBMasterDataDB.NBMasterDataDB(master_data_db_name=master_file or self.path("master"),
+                                             login_data_db_name=self.login_db, log_file="")
+
+    def new_stations(self):
+        """Opens an empty transactions database on the filled master data, so a crawl downloads and parses the feed"""
+        return NBStationsDataDB.NBStationsDataDB(transactions_db_name=self.path("transactions"),
+                                                 master_db=self.new_master(self.master_file))
+
+    def run(self, name, run, setup=None):
+        result = measure(run, setup, self.repeats)
+        print("{:<32} best {:8.4f}s  mean {:8.4f}s  peak {:8.1f} MB".format(
+            name, result["best_s"], result["mean_s"], result["peak_bytes"] / 2 ** 20))
+        return result
+
+
+def run_benchmarks(args, feed):
+    results = dict()
+
+    with tempfile.TemporaryDirectory() as directory, stub_server.StubServer(feed) as server:
+        bench = Bench(directory, server, args.repeats)
+        master = bench.master
+
+        results["download"] = bench.run("download", lambda: master._download_station_status(conditional=False))
+        results["parse"] = bench.run("parse", master._parse_station_status)
+
+        def fresh_master():
+            new_master = bench.new_master()
+            new_master._download_station_status()
+            new_master._parse_station_status()
+            return new_master,
+        results["master_update_fresh"] = bench.run("master_update_fresh", lambda m: m._update_tables(), fresh_master)
+        results["master_update_unchanged"] = bench.run("master_update_unchanged", master._update_tables)
+
+        results["ingest_unfiltered"] = bench.run("ingest_unfiltered", lambda db: db.add_current_state(),
+                                                 lambda: (bench.new_stations(),))
+        results["ingest_stream_unfiltered"] = bench.run("ingest_stream_unfiltered",
+                                                        lambda db: db.add_current_state_stream(),
+                                                        lambda: (bench.new_stations(),))
+
+        # a crawler following a single city
+        place_filter = NBPlaceFilter.NBPlaceFilter(master.get_places_from_city(1), master)
+        results["ingest_filtered"] = bench.run("ingest_filtered", lambda db: db.add_current_state(place_filter),
+                                               lambda: (bench.new_stations(),))
+        results["ingest_stream_filtered"] = bench.run("ingest_stream_filtered",
+                                                      lambda db: db.add_current_state_stream(place_filter),
+                                                      lambda: (bench.new_stations(),))
+
+        # current states of a city from memory, against the latest rows of its places from the history
+        stations_db = bench.new_stations()
+        stations_db.add_current_state()
+        stations_db.refresh_current_index()
+        city_places = master.get_places_from_city(1)
+        results["current_city_memory"] = bench.run("current_city_memory", lambda: stations_db.get_current_city(1))
+        results["current_city_history"] = bench.run(
+            "current_city_history", lambda: [stations_db.get_state_at(place_uid, 2 ** 40) for place_uid in city_places])
+
+        # area selection on the spatial index, built once before the timed runs
+        lat, lng = master.conn.execute("SELECT latitude, longitude FROM places_data LIMIT 1").fetchone()
+        master.get_spatial_index()
+        results["places_within_2km"] = bench.run("places_within_2km",
+                                                 lambda: master.get_places_within(lat, lng, 2000))
+        results["places_nearest_10"] = bench.run("places_nearest_10", lambda: master.get_places_nearest(lat, lng, 10))
+
+        # master update and ingest from one download and one walk, against empty databases
+        def fresh_pipeline(streaming):
+            stations_db = NBStationsDataDB.NBStationsDataDB(transactions_db_name=bench.path("transactions"),
+                                                            master_db=bench.new_master())
+            return NBPipeline.NBPipeline(stations_db.master_db, stations_db, streaming=streaming),
+        results["pipeline_fused"] = bench.run("pipeline_fused", lambda p: p.run(), lambda: fresh_pipeline(False))
+        results["pipeline_fused_stream"] = bench.run("pipeline_fused_stream", lambda p: p.run(),
+                                                     lambda: fresh_pipeline(True))
+
+        # backfill of a generated directory of legacy files
+        files = feed_generator.generate_directory(os.path.join(directory, "legacy"), args.files,
+                                                  num_domains=args.domains, num_cities=args.cities,
+                                                  num_places=args.places, seed=args.seed)
+
+        def parse_files(db):
+            for file in files:
+                status_time, rows = ParseFilesToDB.parse_file(file)
+                db.add_fill_rows(rows, status_time)
+        results["parse_files_sequential"] = bench.run("parse_files_sequential", parse_files,
+                                                      lambda: (bench.new_stations(),))
+        results["parse_files_backfill"] = bench.run(
+            "parse_files_backfill",
+            lambda db: NBBackfill.NBBackfill(db, ParseFilesToDB.parse_file, workers=args.workers).run(files),
+            lambda: (bench.new_stations(),))
+
+    # several feeds with the latency of remote servers, one at a time against all at once
+    with contextlib.ExitStack() as stack:
+        servers = [stack.enter_context(stub_server.StubServer(feed, delay=args.feed_delay)) for _ in range(args.feeds)]
+        feeds = [("feed_{}".format(number), server.url) for number, server in enumerate(servers)]
+        for name, workers in (("feeds_sequential", 1), ("feeds_concurrent", args.feeds)):
+            feed_fetcher = stack.enter_context(contextlib.closing(
+                NBFeedFetcher.NBFeedFetcher(feeds, max_workers=workers, per_host=args.feeds)))
+            results[name] = bench.run(name, lambda: feed_fetcher.fetch_all(conditional=False))
+
+    # parse and walk of the same stations as status xml and as GBFS-style JSON: the states of every place, and the
+    # records of the master data, which GBFS keeps apart in station_information
+    gbfs_feed = feed_generator.generate_gbfs_feed(args.domains, args.cities, args.places, seed=args.seed)
+    gbfs_status = feed_generator.generate_gbfs_feed(args.domains, args.cities, args.places, seed=args.seed,
+                                                    files=("station_status",))
+
+    def parse_states(body):
+        status = NBFeedParser.parse_feed(body)
+        return list(NBStationsDataDB.NBStationsDataDB._state_rows(status.records(), status.status_time))
+
+    def parse_master(body):
+        return list(NBFeedParser.parse_feed(body).records(include_empty=True))
+    for name, run, body in (("feed_states_xml", parse_states, feed), ("feed_states_gbfs", parse_states, gbfs_feed),
+                            ("feed_states_gbfs_status", parse_states, gbfs_status),
+                            ("feed_master_xml", parse_master, feed), ("feed_master_gbfs", parse_master, gbfs_feed)):
+        results[name] = bench.run(name, lambda: run(body))
+        results[name]["feed_bytes"] = len(body)
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=ROOT, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark download, parse, master update and ingest of synthetic "
+                                                 "NextBike feeds.")
+    parser.add_argument("--domains", type=int, default=20, help="number of domains in the feed")
+    parser.add_argument("--cities", type=int, default=10, help="number of cities per domain")
+    parser.add_argument("--places", type=int, default=25, help="number of places per city")
+    parser.add_argument("--files", type=int, default=20, help="number of legacy files for the backfill benchmarks")
+    parser.add_argument("--workers", type=int, default=None, help="number of backfill processes")
+    parser.add_argument("--feeds", type=int, default=4, help="number of feeds for the concurrent fetch benchmarks")
+    parser.add_argument("--feed-delay", type=float, default=0.05, help="seconds every feed server delays its answer")
+    parser.add_argument("--repeats", type=int, default=5, help="timed runs per benchmark")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the feed generator")
+    parser.add_argument("-o", "--output", type=str, default="bench_results.json", help="json file for the results")
+    args = parser.parse_args()
+
+    feed = feed_generator.generate_feed(args.domains, args.cities, args.places, seed=args.seed)
+    report = {"commit": git_commit(), "python": platform.python_version(), "sqlite": sqlite3.sqlite_version,
+              "parameters": vars(args), "feed_bytes": len(feed), "results": run_benchmarks(args, feed)}
+    with open(args.output, "w") as file:
+        json.dump(report, file, indent=2)
+    print("Results written to", args.output)
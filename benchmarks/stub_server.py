@@ -0,0 +1,89 @@
+import gzip
+import hashlib
+import http.server
+import threading
+import time
+
+
+class StubServer:
+    """Local http server which serves a status feed like the NextBike servers, with gzip and ETags. The feed can be
+    exchanged while the server runs. Every answer is delayed by delay seconds, like the latency of a remote server.
+    The next errors requests are answered with 503, with a redirect url every request is redirected there with
+    redirect_status, without etags If-None-Match is ignored. max_active is the largest number of requests which were
+    answered at the same time"""
+
+    def __init__(self, feed=b"", port=0, delay=0.0, errors=0, redirect=None, redirect_status=302, etags=True):
+        self.feed = feed
+        self.delay = delay
+        self.errors = errors
+        self.redirect = redirect
+        self.redirect_status = redirect_status
+        self.etags = etags
+        self.requests = 0
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+        stub = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                with stub.lock:
+                    stub.requests += 1
+                    stub.active += 1
+                    stub.max_active = max(stub.max_active, stub.active)
+                try:
+                    self._answer()
+                finally:
+                    with stub.lock:
+                        stub.active -= 1
+
+            def _answer(self):
+                if stub.delay:
+                    time.sleep(stub.delay)
+                with stub.lock:
+                    failing = stub.errors > 0
+                    stub.errors -= failing
+                if failing or stub.redirect is not None:
+                    self.send_response(503 if failing else stub.redirect_status)
+                    if not failing:
+                        self.send_header("Location", stub.redirect)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                body = stub.feed
+                etag = '"{}"'.format(hashlib.sha256(body).hexdigest())
+                if stub.etags and self.headers.get("If-None-Match") == etag:
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                if "gzip" in self.headers.get("Accept-Encoding", ""):
+                    body = gzip.compress(body, compresslevel=1)
+                    self.send_header("Content-Encoding", "gzip")
+                self.send_header("ETag", etag)
+                self.send_header("Content-Type", "text/xml")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}/nextbike-live.xml".format(self.server.server_address[1])
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.server.shutdown()
+        self.server.server_close()
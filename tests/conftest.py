@@ -0,0 +1,30 @@
+import os
+import sys
+
+import pytest
+
+# the tests run against the library of this checkout, with the feed generator and stub server of the benchmarks
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+from NB_lib import NBMetrics  # noqa: E402
+
+
+class MasterStub:
+    """Stands in for the master data, the tests never download a status"""
+    conn = None
+    parsed_hash = None
+    feed_ids = None
+
+
+@pytest.fixture
+def master_stub():
+    return MasterStub()
+
+
+@pytest.fixture(autouse=True)
+def metrics():
+    """Every test starts with empty stages and counters"""
+    NBMetrics.metrics.reset()
+    return NBMetrics.metrics
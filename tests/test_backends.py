@@ -0,0 +1,216 @@
+import datetime
+import io
+import os
+
+import pytest
+
+import feed_generator
+from NB_lib import NBStationsDataDB, NBStatusStream, NBStorageBackend, NBTimeSeries
+
+# the same operations run against every storage backend and have to give the values worked out by hand below. duckdb
+# is skipped if it is not installed, unless NB_REQUIRE_DUCKDB is set, which CI does after installing duckdb and numpy
+REQUIRE_DUCKDB = bool(os.environ.get("NB_REQUIRE_DUCKDB"))
+BACKENDS = ["sqlite", pytest.param("duckdb", marks=pytest.mark.skipif(
+    NBStorageBackend.duckdb is None and not REQUIRE_DUCKDB, reason="duckdb is not installed"))]
+
+# 2016-10-18 12:00 UTC, the start of an hourly bucket and the middle of a daily one
+T0 = 1476792000
+DAY0, DAY1 = T0 - 43200, T0 + 43200
+
+# (seconds after T0, (place_uid, bikes, free_racks) rows) of five states
+STATES = [
+    (0, [(1, 5, 3), (2, 0, 10), (3, 2, 2)]),
+    (900, [(1, 5, 3), (2, 1, 9), (3, 2, 2)]),
+    (1800, [(1, 4, 4), (2, 1, 9), (3, 0, 4)]),
+    (3600, [(1, 4, 4), (2, 3, 7), (3, 0, 4)]),
+    (86400, [(1, 6, 2), (2, 3, 7), (3, 1, 3)]),
+]
+
+
+def as_rows(series):
+    return list(zip(*(values.tolist() for values in series)))
+
+
+@pytest.fixture(params=BACKENDS)
+def backend(request):
+    if request.param == "duckdb":
+        if NBStorageBackend.duckdb is None:
+            pytest.fail("duckdb is required by NB_REQUIRE_DUCKDB but not installed")
+        NBTimeSeries.require_numpy()
+    return request.param
+
+
+@pytest.fixture(params=NBStationsDataDB.NBStationsDataDB.STORAGE_MODES)
+def storage_mode(request):
+    return request.param
+
+
+@pytest.fixture
+def open_db(tmp_path, master_stub, backend, storage_mode):
+    """Opens the transactions database of the test, if called again it is closed and opened again"""
+    opened = list()
+
+    def open_db(**kwargs):
+        if opened:
+            opened.pop().close()
+        opened.append(NBStationsDataDB.NBStationsDataDB(str(tmp_path / "stations_transactions.db"),
+                                                        master_db=master_stub, log_file=None,
+                                                        storage_mode=storage_mode, backend=backend, **kwargs))
+        return opened[0]
+
+    yield open_db
+    if opened:
+        opened.pop().close()
+
+
+@pytest.fixture
+def stations_db(open_db):
+    db = open_db(events=True)
+    for offset, rows in STATES:
+        db.add_fill_rows(rows, datetime.datetime.fromtimestamp(T0 + offset))
+    return db
+
+
+def test_fill_series(stations_db, storage_mode):
+    expected = {
+        "full": [(T0, 1, 5, 3), (T0 + 900, 1, 5, 3), (T0 + 1800, 1, 4, 4), (T0 + 3600, 1, 4, 4),
+                 (T0, 3, 2, 2), (T0 + 900, 3, 2, 2), (T0 + 1800, 3, 0, 4), (T0 + 3600, 3, 0, 4)],
+        # only the rows which change the state of their place are stored
+        "changes": [(T0, 1, 5, 3), (T0 + 1800, 1, 4, 4), (T0, 3, 2, 2), (T0 + 1800, 3, 0, 4)],
+    }
+    assert as_rows(stations_db.get_fill_series([3, 1], T0, T0 + 3600)) == expected[storage_mode]
+
+
+def test_states_added_twice_are_ignored(stations_db):
+    before = as_rows(stations_db.get_fill_series([1, 2, 3], T0, T0 + 86400))
+    stations_db.add_fill_rows(STATES[-1][1], datetime.datetime.fromtimestamp(T0 + 86400))
+    assert as_rows(stations_db.get_fill_series([1, 2, 3], T0, T0 + 86400)) == before
+
+
+def test_state_at(stations_db, storage_mode):
+    # the timestamp is the one of the row the state was taken from
+    expected = {"full": (T0 + 1800, 1, 9), "changes": (T0 + 900, 1, 9)}
+    assert stations_db.get_state_at(2, T0 + 2000) == expected[storage_mode]
+    assert stations_db.get_state_at(2, T0 - 1) is None
+
+
+def test_state_series(stations_db):
+    assert stations_db.get_state_series(2, T0 - 900, T0 + 3600, 1800) == [(T0 - 900, None, None), (T0 + 900, 1, 9),
+                                                                          (T0 + 2700, 1, 9)]
+
+
+def rollup_rows(series):
+    return list(zip(series.bucket.tolist(), series.place_uid.tolist(), series.count.tolist(),
+                    series.bikes_min.tolist(), series.bikes_max.tolist(), series.bikes_mean.tolist(),
+                    series.free_racks_min.tolist(), series.free_racks_max.tolist(), series.free_racks_mean.tolist()))
+
+
+# rollups aggregate the stored rows, which are only the changes in storage mode 'changes'
+@pytest.mark.parametrize("storage_mode", ["full"])
+def test_hourly_rollup(stations_db):
+    # (bucket, place_uid, count, bikes min, max and mean, free_racks min, max and mean)
+    expected = [(T0, 1, 3, 4, 5, 14 / 3, 3, 4, 10 / 3), (T0 + 3600, 1, 1, 4, 4, 4, 4, 4, 4),
+                (T0 + 86400, 1, 1, 6, 6, 6, 2, 2, 2),
+                (T0, 2, 3, 0, 1, 2 / 3, 9, 10, 28 / 3), (T0 + 3600, 2, 1, 3, 3, 3, 7, 7, 7),
+                (T0 + 86400, 2, 1, 3, 3, 3, 7, 7, 7),
+                (T0, 3, 3, 0, 2, 4 / 3, 2, 4, 8 / 3), (T0 + 3600, 3, 1, 0, 0, 0, 4, 4, 4),
+                (T0 + 86400, 3, 1, 1, 1, 1, 3, 3, 3)]
+    assert rollup_rows(stations_db.get_rollup_series([1, 2, 3], T0, T0 + 86400, "hourly")) == expected
+
+
+@pytest.mark.parametrize("storage_mode", ["full"])
+def test_daily_rollup(stations_db):
+    expected = [(DAY0, 1, 4, 4, 5, 4.5, 3, 4, 3.5), (DAY1, 1, 1, 6, 6, 6, 2, 2, 2),
+                (DAY0, 2, 4, 0, 3, 1.25, 7, 10, 8.75), (DAY1, 2, 1, 3, 3, 3, 7, 7, 7),
+                (DAY0, 3, 4, 0, 2, 1, 2, 4, 3), (DAY1, 3, 1, 1, 1, 1, 3, 3, 3)]
+    assert rollup_rows(stations_db.get_rollup_series([1, 2, 3], DAY0, T0 + 86400, "daily")) == expected
+
+
+@pytest.mark.parametrize("storage_mode", ["full"])
+@pytest.mark.parametrize("resolution, seconds", NBStationsDataDB.NBStationsDataDB.ROLLUPS)
+def test_rollup_matches_resample(stations_db, resolution, seconds):
+    rollup = stations_db.get_rollup_series([1, 2, 3], DAY0, T0 + 86400, resolution)
+    resampled = NBTimeSeries.resample(stations_db.get_fill_series([1, 2, 3], DAY0, T0 + 86400), seconds)
+    assert rollup_rows(rollup) == rollup_rows(resampled)
+    # the occupancy of a rollup is taken from the sums of its bucket, not from the mean of the rows
+    assert rollup.occupancy.tolist() == (resampled.bikes_mean / (resampled.bikes_mean +
+                                                                 resampled.free_racks_mean)).tolist()
+
+
+@pytest.mark.parametrize("storage_mode", ["changes"])
+def test_rollups_are_refused_for_changes(stations_db):
+    with pytest.raises(ValueError):
+        stations_db.get_rollup_series([1, 2, 3], T0, T0 + 86400, "hourly")
+
+
+def test_events(stations_db, storage_mode):
+    # (place_uid, timestamp, gap, taken, returned), the gap reaches back to the last stored row of the place
+    expected = {
+        "full": [(1, T0 + 1800, 900, 1, 0), (1, T0 + 86400, 82800, 0, 2),
+                 (2, T0 + 900, 900, 0, 1), (2, T0 + 3600, 1800, 0, 2),
+                 (3, T0 + 1800, 900, 2, 0), (3, T0 + 86400, 82800, 0, 1)],
+        "changes": [(1, T0 + 1800, 1800, 1, 0), (1, T0 + 86400, 84600, 0, 2),
+                    (2, T0 + 900, 900, 0, 1), (2, T0 + 3600, 2700, 0, 2),
+                    (3, T0 + 1800, 1800, 2, 0), (3, T0 + 86400, 84600, 0, 1)],
+    }
+    assert as_rows(stations_db.get_events([1, 2, 3], T0, T0 + 86400)) == expected[storage_mode]
+
+
+def test_states_are_seeded_when_opened_again(stations_db, open_db, storage_mode):
+    db = open_db()
+    assert [db.get_current(place_uid) for place_uid in (1, 2, 3)] == [(T0 + 86400, 6, 2), (T0 + 86400, 3, 7),
+                                                                     (T0 + 86400, 1, 3)]
+    if storage_mode == "changes":
+        assert sorted(db.last_state.items()) == [(1, (6, 2)), (2, (3, 7)), (3, (1, 3))]
+
+
+def test_status_stream(open_db):
+    db = open_db()
+    status_time = datetime.datetime.fromtimestamp(T0 + 7200)
+    feed = feed_generator.generate_feed(1, 1, 3, legacy_quirks=False, status_time=status_time)
+    db.add_state_stream(NBStatusStream.NBStatusStream(io.BytesIO(feed)))
+
+    expected = [(int(record.place.get("uid")), int(record.place.get("bikes")), int(record.place.get("free_racks")))
+                for record in NBStatusStream.NBStatusStream(io.BytesIO(feed))]
+    series = db.get_fill_series([uid for uid, _, _ in expected], T0, T0 + 86400)
+    assert as_rows(series) == [(T0 + 7200,) + row for row in expected]
+
+
+def test_prune(stations_db, storage_mode):
+    stations_db.retention_days = 0.5
+    # every row before noon of the second day is deleted
+    assert stations_db.prune(now=T0 + 86400) == {"full": 12, "changes": 7}[storage_mode]
+    assert stations_db.prune(now=T0 + 86400) == 0
+    expected = {"full": [(T0 + 86400, 1, 6, 2), (T0 + 86400, 2, 3, 7), (T0 + 86400, 3, 1, 3)],
+                "changes": [(T0 + 86400, 1, 6, 2), (T0 + 86400, 3, 1, 3)]}
+    assert as_rows(stations_db.get_fill_series([1, 2, 3], T0, T0 + 86400)) == expected[storage_mode]
+
+
+@pytest.mark.parametrize("storage_mode", ["full"])
+def test_prune_hourly_rollup(stations_db):
+    stations_db.retention_days = stations_db.hourly_retention_days = 0.5
+    stations_db.prune(now=T0 + 86400)
+    series = stations_db.get_rollup_series([1, 2, 3], T0, T0 + 86400, "hourly")
+    assert series.bucket.tolist() == [T0 + 86400] * 3
+    assert series.place_uid.tolist() == [1, 2, 3]
+
+
+def test_master_records(tmp_path, backend):
+    storage = NBStorageBackend.get_backend(backend)
+    conn = storage.connect(str(tmp_path / "master.db"))
+    conn.cursor().execute("CREATE TABLE places_check ( uid INTEGER NOT NULL, name TEXT, last_seen DATE, "
+                          "PRIMARY KEY(uid) )")
+    day = datetime.date(2016, 10, 18)
+    storage.insert_rows(conn, "places_check", [(uid, "Station {}".format(uid), day) for uid in (1, 2, 3)], ("uid",))
+    storage.update_rows(conn, "places_check", ("last_seen",), "uid", [(day + datetime.timedelta(days=1), 2)])
+    # records written again are upserted: only the update columns of stored records change
+    storage.insert_rows(conn, "places_check", [(3, "Renamed", day), (4, "Station 4", day)], ("uid",), ("name",))
+    storage.insert_rows(conn, "places_check", [(1, "Ignored", day)], ("uid",))
+    conn.commit()
+    c = conn.cursor()
+    c.execute("SELECT uid, name, last_seen FROM places_check ORDER BY uid")
+    # engines return dates as strings or as dates
+    assert [(uid, name, str(last_seen)) for uid, name, last_seen in c.fetchall()] == [
+        (1, "Station 1", "2016-10-18"), (2, "Station 2", "2016-10-19"), (3, "Renamed", "2016-10-18"),
+        (4, "Station 4", "2016-10-18")]
+    conn.close()
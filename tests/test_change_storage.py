@@ -0,0 +1,67 @@
+import datetime
+import random
+
+import pytest
+
+from NB_lib import NBStationsDataDB
+
+T0 = 1476792000
+PLACES = (1, 2, 3, 4)
+
+
+def crawls(num_crawls=40, seed=0):
+    """Yields (timestamp, rows) of crawls every 5 minutes, the places keep their state most of the time"""
+    rnd = random.Random(seed)
+    states = {place_uid: (rnd.randint(0, 9), rnd.randint(0, 9)) for place_uid in PLACES}
+    for crawl in range(num_crawls):
+        for place_uid in PLACES:
+            if rnd.random() < 0.3:
+                states[place_uid] = (rnd.randint(0, 9), rnd.randint(0, 9))
+        yield T0 + crawl * 300, [(place_uid,) + states[place_uid] for place_uid in PLACES]
+
+
+@pytest.fixture
+def open_db(tmp_path, master_stub):
+    """Opens the database of a storage mode, if it is open already it is closed and opened again"""
+    opened = dict()
+
+    def open_db(storage_mode):
+        if storage_mode in opened:
+            opened.pop(storage_mode).close()
+        opened[storage_mode] = NBStationsDataDB.NBStationsDataDB(str(tmp_path / "{}.db".format(storage_mode)),
+                                                                 master_db=master_stub, log_file=None,
+                                                                 storage_mode=storage_mode)
+        return opened[storage_mode]
+
+    yield open_db
+    for db in opened.values():
+        db.close()
+
+
+def test_changes_round_trip_through_state_at(open_db):
+    full, changes = open_db("full"), open_db("changes")
+    for timestamp, rows in crawls():
+        for db in (full, changes):
+            db.add_fill_rows(rows, datetime.datetime.fromtimestamp(timestamp))
+
+    num_full = len(full.get_fill_series(PLACES, T0, T0 + 86400).timestamp)
+    num_changes = len(changes.get_fill_series(PLACES, T0, T0 + 86400).timestamp)
+    assert num_changes < num_full == 40 * len(PLACES)
+    # every state of every crawl, and between the crawls, is rebuilt from the changes alone
+    for timestamp in range(T0 - 150, T0 + 40 * 300, 150):
+        for place_uid in PLACES:
+            state = full.get_state_at(place_uid, timestamp)
+            rebuilt = changes.get_state_at(place_uid, timestamp)
+            assert (rebuilt and rebuilt[1:]) == (state and state[1:])
+    for place_uid in PLACES:
+        assert changes.get_state_series(place_uid, T0, T0 + 12000, 600) == \
+            full.get_state_series(place_uid, T0, T0 + 12000, 600)
+
+
+def test_change_filter_continues_after_reopening(open_db):
+    open_db("changes").add_fill_rows([(1, 5, 3)], datetime.datetime.fromtimestamp(T0))
+
+    db = open_db("changes")
+    db.add_fill_rows([(1, 5, 3)], datetime.datetime.fromtimestamp(T0 + 300))
+    db.add_fill_rows([(1, 4, 4)], datetime.datetime.fromtimestamp(T0 + 600))
+    assert db.get_fill_series([1], T0, T0 + 600).timestamp.tolist() == [T0, T0 + 600]
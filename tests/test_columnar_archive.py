@@ -0,0 +1,58 @@
+import datetime
+
+import pytest
+
+from NB_lib import NBStationsDataDB
+
+# 2016-09-15 and 2016-10-15 12:00 UTC, in two monthly shards; everything before November is compacted
+SEPTEMBER, OCTOBER = 1473940800, 1476532800
+NOVEMBER = 1477958400
+
+
+def as_rows(series):
+    return list(zip(*(values.tolist() for values in series)))
+
+
+@pytest.fixture
+def stations_db(tmp_path, master_stub):
+    db = NBStationsDataDB.NBStationsDataDB(str(tmp_path / "stations_transactions.db"), master_db=master_stub,
+                                           log_file=None, archive_dir=str(tmp_path / "archive"),
+                                           shard_dir=str(tmp_path / "shards"))
+    for timestamp in (SEPTEMBER, OCTOBER):
+        db.add_fill_rows([(1, 5, 3), (2, 0, 10)], datetime.datetime.fromtimestamp(timestamp))
+    yield db
+    db.close()
+
+
+def test_compact_leaves_frozen_shards_alone(stations_db):
+    before = as_rows(stations_db.get_fill_series([1, 2], SEPTEMBER, OCTOBER))
+    stations_db.shards.freeze("2016-09")
+
+    assert stations_db.archive.compact(stations_db, NOVEMBER) == ["2016-10"]
+    assert stations_db.archive.partition_names() == ["2016-10"]
+    # every row is read once, from the frozen shard or from the archive
+    assert as_rows(stations_db.get_fill_series([1, 2], SEPTEMBER, OCTOBER)) == before
+
+
+def test_states_are_read_from_the_archive_after_compact(tmp_path, master_stub):
+    def open_db():
+        return NBStationsDataDB.NBStationsDataDB(str(tmp_path / "changes.db"), master_db=master_stub, log_file=None,
+                                                 archive_dir=str(tmp_path / "changes_archive"),
+                                                 storage_mode="changes")
+
+    db = open_db()
+    db.add_fill_rows([(1, 5, 3), (2, 0, 10)], datetime.datetime.fromtimestamp(SEPTEMBER))
+    db.add_fill_rows([(1, 4, 4), (2, 0, 10)], datetime.datetime.fromtimestamp(NOVEMBER + 3600))
+    assert db.archive.compact(db, NOVEMBER) == ["2016-09"]
+    assert db.get_state_at(2, NOVEMBER + 7200) == (SEPTEMBER, 0, 10)
+    assert db.get_state_series(1, NOVEMBER, NOVEMBER + 3600, 3600) == [(NOVEMBER, 5, 3), (NOVEMBER + 3600, 4, 4)]
+    assert db.get_state_series(1, SEPTEMBER - 3600, SEPTEMBER, 3600) == [(SEPTEMBER - 3600, None, None),
+                                                                         (SEPTEMBER, 5, 3)]
+    db.close()
+
+    # the change filter of place 2 is seeded from the archive, so its unchanged state is not written again
+    db = open_db()
+    assert db.last_state == {1: (4, 4), 2: (0, 10)}
+    db.add_fill_rows([(1, 4, 4), (2, 0, 10)], datetime.datetime.fromtimestamp(NOVEMBER + 7200))
+    assert as_rows(db.get_fill_series([2], NOVEMBER, NOVEMBER + 7200)) == []
+    db.close()
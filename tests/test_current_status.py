@@ -0,0 +1,67 @@
+import datetime
+
+import pytest
+
+from NB_lib import NBStationsDataDB, NBStorageBackend
+
+T0 = 1476792000
+
+
+def at(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp)
+
+
+@pytest.fixture
+def open_db(tmp_path, master_stub):
+    opened = list()
+
+    def open_db(**kwargs):
+        if opened:
+            opened.pop().close()
+        opened.append(NBStationsDataDB.NBStationsDataDB(str(tmp_path / "stations_transactions.db"),
+                                                        master_db=master_stub, log_file=None, **kwargs))
+        return opened[-1]
+
+    yield open_db
+    for db in opened:
+        db.close()
+
+
+def current_states(stations_db):
+    return {place_uid: stations_db.get_current(place_uid) for place_uid in (1, 2, 3)}
+
+
+@pytest.mark.parametrize("storage_mode", ["full", "changes"])
+def test_failed_write_keeps_the_current_states(open_db, storage_mode):
+    db = open_db(storage_mode=storage_mode)
+    db.add_fill_rows([(1, 5, 5), (2, 0, 8)], at(T0))
+    before = {1: (T0, 5, 5), 2: (T0, 0, 8), 3: None}
+    assert current_states(db) == before
+
+    # the last row cannot be stored, so the whole state is rolled back
+    with pytest.raises(NBStorageBackend.ERRORS):
+        db.add_fill_rows([(1, 4, 6), (3, 2, 2), (2, None, 8)], at(T0 + 300))
+    assert current_states(db) == before
+    assert current_states(open_db(storage_mode=storage_mode)) == before
+
+
+def test_rolled_back_transaction_restores_the_current_states(open_db):
+    db = open_db()
+    db.add_fill_rows([(1, 5, 5)], at(T0))
+    # states left in the open transaction, like the fill sink of a pipeline whose other sink failed
+    touched = db.add_fill_rows([(1, 4, 6), (2, 1, 1)], at(T0 + 300), commit=False)
+    assert current_states(db) == {1: (T0 + 300, 4, 6), 2: (T0 + 300, 1, 1), 3: None}
+    db.conn.rollback()
+    db._restore_states(touched)
+
+    assert current_states(db) == {1: (T0, 5, 5), 2: None, 3: None}
+    assert current_states(open_db()) == {1: (T0, 5, 5), 2: None, 3: None}
+
+
+def test_older_states_do_not_replace_the_current_ones(open_db):
+    db = open_db()
+    db.add_fill_rows([(1, 5, 5)], at(T0 + 300))
+    # a state replayed from the archive or a late spool file
+    db.add_fill_rows([(1, 1, 9), (2, 3, 3)], at(T0))
+    assert current_states(db) == {1: (T0 + 300, 5, 5), 2: (T0, 3, 3), 3: None}
+    assert current_states(open_db()) == current_states(db)
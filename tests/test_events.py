@@ -0,0 +1,67 @@
+import datetime
+
+import pytest
+
+from NB_lib import NBStationsDataDB, NBTimeSeries
+
+T0 = 1476792000
+
+# (timestamp, place_uid, bikes, free_racks) of four crawls, place 3 never changes and place 2 misses a crawl
+CRAWLS = [
+    [(T0, 1, 5, 5), (T0, 2, 0, 8), (T0, 3, 4, 4)],
+    [(T0 + 300, 1, 5, 5), (T0 + 300, 3, 4, 4)],
+    [(T0 + 600, 1, 3, 7), (T0 + 600, 2, 2, 6), (T0 + 600, 3, 4, 4)],
+    [(T0 + 900, 1, 6, 4), (T0 + 900, 2, 2, 6), (T0 + 900, 3, 4, 4)],
+]
+# (place_uid, timestamp, gap, taken, returned), worked out by hand
+EVENTS = [(1, T0 + 600, 300, 2, 0), (1, T0 + 900, 300, 0, 3), (2, T0 + 600, 600, 0, 2)]
+# only changes are stored, so the first gap of place 1 reaches back to its first crawl
+CHANGE_EVENTS = [(1, T0 + 600, 600, 2, 0)] + EVENTS[1:]
+
+
+def event_rows(events):
+    return list(zip(*(values.tolist() for values in events)))
+
+
+def add_crawls(db, crawls):
+    for crawl in crawls:
+        db.add_fill_rows([row[1:] for row in crawl], datetime.datetime.fromtimestamp(crawl[0][0]))
+
+
+@pytest.fixture
+def open_db(tmp_path, master_stub):
+    opened = list()
+
+    def open_db(**kwargs):
+        opened.append(NBStationsDataDB.NBStationsDataDB(str(tmp_path / "stations_transactions.db"),
+                                                        master_db=master_stub, log_file=None, **kwargs))
+        return opened[-1]
+
+    yield open_db
+    for db in opened:
+        db.close()
+
+
+def test_events_of_a_hand_made_series():
+    rows = sorted((row for crawl in CRAWLS for row in crawl), key=lambda row: (row[1], row[0]))
+    assert event_rows(NBTimeSeries.events(NBTimeSeries.series_from_rows(rows))) == EVENTS
+
+
+@pytest.mark.parametrize("storage_mode, events", [("full", EVENTS), ("changes", CHANGE_EVENTS)])
+def test_events_are_derived_while_adding(open_db, storage_mode, events):
+    db = open_db(events=True, storage_mode=storage_mode)
+    add_crawls(db, CRAWLS[:2])
+    # a crawl added twice gives no events
+    add_crawls(db, CRAWLS[1:])
+    assert event_rows(db.get_events([1, 2, 3], T0, T0 + 900)) == events
+    assert event_rows(db.get_events([1], T0 + 700, T0 + 900)) == events[1:2]
+
+
+def test_backfilled_events_match_the_derived_ones(open_db):
+    add_crawls(open_db(), CRAWLS)
+    db = open_db()
+    # windows of ten minutes, so events are carried over window borders
+    assert db.backfill_events(chunk_places=2, chunk_days=600 / 86400) == len(EVENTS)
+    assert event_rows(db.get_events([1, 2, 3], T0, T0 + 900)) == EVENTS
+    # events already stored are not written again
+    assert db.backfill_events() == 0
@@ -0,0 +1,46 @@
+import json
+
+import feed_generator
+from NB_lib import NBFeedIds, NBFeedParser, NBMasterDataDB
+
+
+def open_master(tmp_path):
+    return NBMasterDataDB.NBMasterDataDB(str(tmp_path / "stations_master.db"), str(tmp_path / "login.db"),
+                                         log_file=None)
+
+
+def uids(body, source, feed_ids):
+    return [record.place.get("uid") for record in NBFeedParser.parse_feed(body, source, feed_ids).records()]
+
+
+def test_station_ids_map_to_stable_uids_per_feed(tmp_path):
+    status = feed_generator.generate_gbfs_feed(1, 2, 3, files=("station_status",))
+    master = open_master(tmp_path)
+    first = uids(status, "a", master.feed_ids)
+    master.conn.close()
+
+    master = open_master(tmp_path)
+    assert uids(status, "a", master.feed_ids) == first
+    # equal ids of another feed are other stations
+    assert not set(uids(status, "b", master.feed_ids)) & set(first)
+    assert min(first) >= NBFeedIds.FIRST_UID
+
+
+def test_uids_do_not_collide_with_the_master_data(tmp_path):
+    master = open_master(tmp_path)
+    master.conn.execute("INSERT INTO places_data (uid) VALUES (?)", (NBFeedIds.FIRST_UID + 5,))
+    master.conn.commit()
+    master.conn.close()
+
+    master = open_master(tmp_path)
+    assert min(uids(feed_generator.generate_gbfs_feed(1, 1, 2), "a", master.feed_ids)) == NBFeedIds.FIRST_UID + 6
+
+
+def test_malformed_stations_are_skipped(metrics):
+    document = json.loads(feed_generator.generate_gbfs_feed(1, 1, 3, files=("station_status",)))
+    stations = document["data"]["stations"]
+    stations += [{"num_bikes_available": 1}, {"station_id": "x", "num_bikes_available": "many"}, "x"]
+
+    records = list(NBFeedParser.parse_feed(json.dumps(document)).records())
+    assert len(records) == 3
+    assert metrics.counters["stations_malformed"] == 3
@@ -0,0 +1,87 @@
+import datetime
+
+import pytest
+
+import feed_generator
+import stub_server
+from NB_lib import NBFeedFetcher, NBStationsDataDB
+
+TIME_A = datetime.datetime(2016, 10, 18, 12, 0)
+TIME_B = datetime.datetime(2016, 10, 18, 12, 5)
+
+
+def small_feed(status_time):
+    return feed_generator.generate_feed(num_domains=1, num_cities=2, num_places=5, status_time=status_time)
+
+
+def fetch_all(feeds, **fetcher_args):
+    fetcher = NBFeedFetcher.NBFeedFetcher(feeds, **fetcher_args)
+    try:
+        return fetcher.fetch_all()
+    finally:
+        fetcher.close()
+
+
+def stored_times(stations_db):
+    c = stations_db.conn.cursor()
+    c.execute("SELECT timestamp, COUNT(*) FROM stations_fill GROUP BY timestamp ORDER BY timestamp")
+    return c.fetchall()
+
+
+@pytest.fixture
+def stations_db(tmp_path, master_stub):
+    db = NBStationsDataDB.NBStationsDataDB(str(tmp_path / "stations_transactions.db"), master_db=master_stub,
+                                           log_file=None)
+    yield db
+    db.close()
+
+
+def test_results_are_tagged_with_their_feed(stations_db):
+    with stub_server.StubServer(small_feed(TIME_A)) as server_a, stub_server.StubServer(small_feed(TIME_B)) as server_b:
+        results = fetch_all([("a", server_a.url), ("b", server_b.url)])
+
+    assert [(result.source, result.url, result.error) for result in results] == [("a", server_a.url, None),
+                                                                                  ("b", server_b.url, None)]
+    assert stations_db.add_feeds(results) == {"a": TIME_A, "b": TIME_B}
+    assert stored_times(stations_db) == [(int(TIME_A.timestamp()), 10), (int(TIME_B.timestamp()), 10)]
+
+
+@pytest.mark.parametrize("per_host", [1, 2])
+def test_requests_to_a_host_are_limited(per_host):
+    with stub_server.StubServer(small_feed(TIME_A), delay=0.2) as server:
+        feeds = [("feed{}".format(index), "{}?feed={}".format(server.url, index)) for index in range(4)]
+        results = fetch_all(feeds, max_workers=4, per_host=per_host)
+
+    assert all(result.body is not None for result in results)
+    assert server.requests == 4
+    assert server.max_active == per_host
+
+
+def test_hosts_are_limited_separately():
+    with stub_server.StubServer(small_feed(TIME_A), delay=0.2) as server_a, \
+            stub_server.StubServer(small_feed(TIME_B), delay=0.2) as server_b:
+        feeds = [("a{}".format(index), server_a.url) for index in range(2)] + \
+                [("b{}".format(index), server_b.url) for index in range(2)]
+        results = fetch_all(feeds, max_workers=4, per_host=1)
+        # both servers were busy at the same time, though each answered one request at a time
+        assert server_a.max_active == server_b.max_active == 1
+
+    assert [result.source for result in results] == ["a0", "a1", "b0", "b1"]
+    assert all(result.error is None for result in results)
+
+
+def test_a_failing_feed_does_not_stop_the_others(stations_db, metrics):
+    with stub_server.StubServer() as refused:
+        refused_url = refused.url
+    unknown_uid = small_feed(TIME_A).replace(b'uid="100001"', b'uid="unknown"')
+    with stub_server.StubServer(unknown_uid) as bad_uid, stub_server.StubServer(b"<markers><country") as corrupt, \
+            stub_server.StubServer(small_feed(TIME_B)) as good:
+        results = fetch_all([("refused", refused_url), ("bad_uid", bad_uid.url), ("corrupt", corrupt.url),
+                             ("good", good.url)], max_tries=1)
+
+    assert results[0].body is None and results[0].error is not None
+    assert all(result.error is None for result in results[1:])
+    assert stations_db.add_feeds(results) == {"good": TIME_B}
+    # the rows of the feed which failed while being written were rolled back
+    assert stored_times(stations_db) == [(int(TIME_B.timestamp()), 10)]
+    assert metrics.counters["feeds_failed"] == 3
@@ -0,0 +1,87 @@
+import time
+
+import pytest
+
+import feed_generator
+import stub_server
+from NB_lib import NBFetcher
+
+FEED = feed_generator.generate_feed(num_domains=1, num_cities=2, num_places=5)
+
+
+@pytest.fixture
+def fetchers():
+    """Creates fetchers which are closed after the test"""
+    created = list()
+
+    def fetcher(url, **kwargs):
+        created.append(NBFetcher.NBFetcher(url, backoff_base=0.01, **kwargs))
+        return created[-1]
+
+    yield fetcher
+    for fetcher in created:
+        fetcher.close()
+
+
+def test_unchanged_feed_is_answered_not_modified(fetchers, metrics):
+    with stub_server.StubServer(FEED) as server:
+        fetcher = fetchers(server.url)
+        assert fetcher.fetch() == FEED
+        assert fetcher.fetch() is None
+        assert fetcher.fetch(conditional=False) == FEED
+        assert server.requests == 3
+    assert metrics.counters["not_modified"] == 1
+
+
+def test_repeated_body_is_reported_unchanged(fetchers, metrics):
+    # the server sends the same ETag, but answers every request with the whole body
+    with stub_server.StubServer(FEED, etags=False) as server:
+        fetcher = fetchers(server.url)
+        assert fetcher.fetch() == FEED
+        assert fetcher.fetch() is None
+        server.feed = FEED + b"\n"
+        assert fetcher.fetch() == FEED + b"\n"
+    assert "not_modified" not in metrics.counters
+
+
+def test_server_errors_are_retried(fetchers, metrics):
+    with stub_server.StubServer(FEED, errors=2) as server:
+        assert fetchers(server.url).fetch() == FEED
+        assert server.requests == 3
+    assert metrics.counters["download_retries"] == 2
+
+
+def test_server_errors_give_up_after_max_tries(fetchers):
+    with stub_server.StubServer(FEED, errors=5) as server:
+        with pytest.raises(IOError, match="503"):
+            fetchers(server.url, max_tries=2).fetch()
+        assert server.requests == 2
+
+
+@pytest.mark.parametrize("status, permanent", [(301, True), (302, False)])
+def test_redirects_to_another_host_are_followed(fetchers, status, permanent):
+    with stub_server.StubServer(FEED) as target, \
+            stub_server.StubServer(redirect=target.url, redirect_status=status) as server:
+        fetcher = fetchers(server.url)
+        assert fetcher.fetch() == FEED
+        assert fetcher.fetch(conditional=False) == FEED
+        # a permanent redirect is remembered, a temporary one is asked again
+        assert server.requests == (1 if permanent else 2)
+        assert target.requests == 2
+        assert fetcher.url.geturl() == (target.url if permanent else server.url)
+
+
+def test_redirects_are_limited(fetchers):
+    with stub_server.StubServer(FEED) as server:
+        server.redirect = server.url
+        with pytest.raises(IOError, match="redirects"):
+            fetchers(server.url, max_redirects=3).fetch()
+        assert server.requests == 4
+
+
+def test_slow_server_is_given_up_at_the_deadline(fetchers):
+    with stub_server.StubServer(FEED, delay=1.0) as server:
+        start = time.monotonic()
+        with pytest.raises(OSError):
+            fetchers(server.url, timeout=30, deadline=0.3).fetch()
+        assert time.monotonic() - start < 0.8
@@ -0,0 +1,39 @@
+import datetime
+import io
+
+import pytest
+
+import feed_generator
+from NB_lib import NBMasterDataDB, NBPipeline, NBStatusStream
+
+TIME_A = datetime.datetime(2016, 10, 18, 12, 0)
+
+
+@pytest.fixture
+def master_db(tmp_path):
+    db = NBMasterDataDB.NBMasterDataDB(str(tmp_path / "stations_master.db"), str(tmp_path / "login.db"),
+                                       log_file=None)
+    records = NBStatusStream.NBStatusStream(io.BytesIO(feed_generator.generate_feed(1, 2, 3, status_time=TIME_A)))
+    NBPipeline.run_sinks(records, [NBPipeline.MasterDataSink(db), NBPipeline.AssignmentSink(db)])
+    yield db
+    db.conn.close()
+
+
+def changes_version(master_db, *statements):
+    version = master_db.get_data_version()
+    for statement in statements:
+        master_db.conn.execute(statement)
+    master_db.conn.commit()
+    return master_db.get_data_version() != version
+
+
+def test_data_version_follows_the_master_data(master_db):
+    assert master_db.get_data_version() == master_db.get_data_version()
+    place_uid, = master_db.conn.execute("SELECT place_uid FROM places_cities_assignment ORDER BY rowid").fetchone()
+    assert changes_version(master_db, "UPDATE places_data SET latitude = latitude + 1 WHERE uid = {}"
+                           .format(place_uid))
+    # the counts stay the same if a record is deleted and another one added
+    assert changes_version(master_db, "DELETE FROM places_cities_assignment WHERE place_uid = {}".format(place_uid),
+                           "INSERT INTO places_cities_assignment VALUES ({}, 1)".format(place_uid))
+    assert changes_version(master_db, "INSERT INTO admin_migrations VALUES (NULL, 'test', current_timestamp)")
+    assert not changes_version(master_db, "UPDATE places_data SET last_seen = '2016-10-19'")
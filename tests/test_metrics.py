@@ -0,0 +1,60 @@
+import json
+import logging
+import threading
+
+from NB_lib import NBMetrics
+
+
+def test_stages_and_counters_are_exported(tmp_path):
+    metrics = NBMetrics.NBMetrics()
+    metrics.configure(prometheus_dir=str(tmp_path / "prom"), jsonl_file=str(tmp_path / "runs.jsonl"))
+    with metrics.stage("parse"):
+        pass
+    metrics.add_time("parse", 1.5)
+    metrics.add_time("insert", 0.25)
+    metrics.count("rows_written", 10)
+    metrics.count("rows_written", 5)
+    metrics.count("parse_retries")
+    parse_time = metrics.stages["parse"]
+    assert parse_time >= 1.5
+
+    metrics.write("crawl")
+    # every run starts empty
+    assert not metrics.stages and not metrics.counters
+    with open(tmp_path / "runs.jsonl") as file:
+        run = json.loads(file.readline())
+    assert (run["job"], run["stages"], run["counters"]) == ("crawl", {"parse": parse_time, "insert": 0.25},
+                                                            {"rows_written": 15, "parse_retries": 1})
+
+    with open(tmp_path / "prom" / "nb_crawl.prom") as file:
+        lines = file.read().splitlines()
+    assert 'nb_stage_seconds{job="crawl",stage="insert"} 0.250000' in lines
+    assert 'nb_rows_written{job="crawl"} 15' in lines
+    assert 'nb_parse_retries{job="crawl"} 1' in lines
+    assert not (tmp_path / "prom" / "nb_crawl.prom.tmp").exists()
+
+
+def test_counters_of_several_threads_add_up():
+    metrics = NBMetrics.NBMetrics()
+
+    def count():
+        for _ in range(1000):
+            metrics.count("requests")
+            metrics.add_time("download", 0.001)
+
+    threads = [threading.Thread(target=count) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert metrics.counters["requests"] == 4000
+    assert abs(metrics.stages["download"] - 4.0) < 1e-6
+
+
+def test_slow_stages_are_logged(caplog):
+    metrics = NBMetrics.NBMetrics()
+    metrics.configure(slow_stage_ms=100)
+    with caplog.at_level(logging.WARNING):
+        metrics.add_time("insert", 0.05)
+        metrics.add_time("prune", 0.5)
+    assert [record.getMessage() for record in caplog.records] == ["Slow stage 'prune': 500 ms (threshold 100 ms)"]
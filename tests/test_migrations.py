@@ -0,0 +1,77 @@
+import datetime
+import sqlite3
+
+import pytest
+
+from NB_lib import NBStationsDataDB
+
+T0 = 1476792000
+MIGRATION = "0002_STATIONS_FILL_CLUSTERED"
+
+
+def create_row_store(path, num_rows):
+    """Creates stations_fill in the layout of old versions, which wrote some values as text"""
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE `stations_fill` ( `timestamp` INTEGER NOT NULL, `place_uid` INTEGER NOT NULL, "
+                 "`bikes` INTEGER NOT NULL, `free_racks` INTEGER NOT NULL,UNIQUE ( `place_uid`, `timestamp`) ) ")
+    rows = [(T0 + number // 5 * 300, number % 5 + 1, number % 7, number % 3) for number in range(num_rows)]
+    conn.executemany("INSERT INTO stations_fill VALUES (?, ?, ?, ?)",
+                     [(str(timestamp), place_uid, str(bikes), free_racks) for timestamp, place_uid, bikes, free_racks
+                      in rows])
+    conn.commit()
+    conn.close()
+    return rows
+
+
+def stored_rows(stations_db):
+    c = stations_db.conn.cursor()
+    c.execute("SELECT timestamp, place_uid, bikes, free_racks FROM stations_fill ORDER BY place_uid, timestamp")
+    return c.fetchall()
+
+
+def progress(stations_db):
+    c = stations_db.conn.cursor()
+    c.execute("SELECT position FROM admin_migration_progress WHERE name = ?", (MIGRATION,))
+    return c.fetchone()
+
+
+@pytest.fixture
+def open_db(tmp_path, master_stub):
+    opened = list()
+
+    def open_db():
+        if opened:
+            opened.pop().close()
+        opened.append(NBStationsDataDB.NBStationsDataDB(str(tmp_path / "stations_transactions.db"),
+                                                        master_db=master_stub, log_file=None))
+        return opened[-1]
+
+    yield open_db
+    for db in opened:
+        db.close()
+
+
+def test_interrupted_migration_is_resumed(tmp_path, open_db):
+    rows = create_row_store(str(tmp_path / "stations_transactions.db"), 100)
+    db = open_db()
+    assert not db.backend.is_clustered(db.conn, "main")
+
+    assert db.migrate(batch_size=30, max_batches=2) == {"main": []}
+    assert progress(db) == (60,)
+    # rows written while the migration is interrupted are mirrored into the new table
+    added = [(6, 1, 1), (1, 9, 9)]
+    db.add_fill_rows(added, datetime.datetime.fromtimestamp(T0 + 6000))
+    rows += [(T0 + 6000,) + row for row in added]
+
+    # the crawler restarts and the next call continues from the recorded position
+    db = open_db()
+    assert db.migrate(batch_size=30) == {"main": [MIGRATION]}
+    assert db.backend.is_clustered(db.conn, "main")
+    assert progress(db) is None
+    assert stored_rows(db) == sorted(rows, key=lambda row: (row[1], row[0]))
+    assert db.migrate() == {"main": []}
+
+    # the rollups are kept up to date by the clustered table as well
+    db.add_fill_rows([(2, 4, 4)], datetime.datetime.fromtimestamp(T0 + 6300))
+    rollup = db.get_rollup_series([2], T0, T0 + 7200)
+    assert int(rollup.count.sum()) == sum(1 for row in rows if row[1] == 2) + 1
@@ -0,0 +1,12 @@
+import datetime
+
+import ParseFilesToDB
+
+
+def test_files_are_sorted_by_the_time_in_their_names():
+    paths = ["data/NB_DATA_2016-10-18-10h00m.xml", "data/notes.txt", "data/NB_DATA_2016-10-18- 9h 5m.xml",
+             "data/nb_2016-10-18-09h01m.xml", "data/NB_DATA_2016-10-17-23h59m.xml"]
+    assert ParseFilesToDB.chronological(paths) == [
+        "data/NB_DATA_2016-10-17-23h59m.xml", "data/nb_2016-10-18-09h01m.xml", "data/NB_DATA_2016-10-18- 9h 5m.xml",
+        "data/NB_DATA_2016-10-18-10h00m.xml", "data/notes.txt"]
+    assert ParseFilesToDB.file_time(paths[2]) == datetime.datetime(2016, 10, 18, 9, 5)
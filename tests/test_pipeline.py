@@ -0,0 +1,95 @@
+import datetime
+import io
+import sqlite3
+
+import pytest
+
+import feed_generator
+from NB_lib import NBPipeline, NBStationsDataDB, NBStatusStream
+
+TIME_A = datetime.datetime(2016, 10, 18, 12, 0)
+TIME_B = datetime.datetime(2016, 10, 18, 12, 5)
+
+
+class FailingSink(NBPipeline.NBSink):
+    """Writes a row into its own connection and fails afterwards"""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def finish(self, status_time):
+        self.conn.execute("INSERT INTO written VALUES (?)", (int(status_time.timestamp()),))
+        raise ValueError("Sink failed")
+
+
+class StreamMaster:
+    """Hands out the streams of a status file and fails to archive them"""
+    conn = None
+    parsed_hash = None
+    feed_ids = None
+
+    def __init__(self, body):
+        self.body = body
+        self.num_streams = 0
+        self.fetcher = self
+
+    def stream_station_status(self, place_filter=None, include_empty=False):
+        self.num_streams += 1
+        return NBStatusStream.NBStatusStream(io.BytesIO(self.body), place_filter=place_filter,
+                                             include_empty=include_empty)
+
+    def archive_stream(self, stream):
+        raise OSError("Archive not writable")
+
+    def backoff(self, attempt):
+        pass
+
+
+def stored_rows(stations_db):
+    c = stations_db.conn.cursor()
+    c.execute("SELECT timestamp, place_uid, bikes, free_racks FROM stations_fill ORDER BY timestamp, place_uid")
+    return c.fetchall()
+
+
+def records(body):
+    return list(NBStatusStream.NBStatusStream(io.BytesIO(body)))
+
+
+@pytest.fixture
+def stations_db(tmp_path, master_stub):
+    db = NBStationsDataDB.NBStationsDataDB(str(tmp_path / "stations_transactions.db"), master_db=master_stub,
+                                           log_file=None)
+    yield db
+    db.close()
+
+
+def test_sinks_are_rolled_back_together(tmp_path, stations_db):
+    first = feed_generator.generate_feed(1, 1, 4, legacy_quirks=False, status_time=TIME_A, seed=1)
+    second = feed_generator.generate_feed(1, 1, 4, legacy_quirks=False, status_time=TIME_B, seed=2)
+    NBPipeline.run_sinks(records(first), [NBPipeline.FillSink(stations_db)], TIME_A)
+    rows = stored_rows(stations_db)
+    states = (dict(stations_db.last_state), dict(stations_db.last_seen), dict(stations_db.current.states))
+
+    other_conn = sqlite3.connect(str(tmp_path / "other.db"))
+    other_conn.execute("CREATE TABLE written (timestamp INTEGER)")
+    other_conn.commit()
+    with pytest.raises(ValueError):
+        NBPipeline.run_sinks(records(second), [NBPipeline.FillSink(stations_db), FailingSink(other_conn)], TIME_B)
+
+    # neither connection kept its rows and the states in memory are those of the first status
+    assert stored_rows(stations_db) == rows
+    assert other_conn.execute("SELECT COUNT(*) FROM written").fetchone() == (0,)
+    assert (stations_db.last_state, stations_db.last_seen, stations_db.current.states) == states
+    other_conn.close()
+
+
+def test_failed_archiving_is_not_retried(stations_db):
+    body = feed_generator.generate_feed(1, 1, 4, legacy_quirks=False, status_time=TIME_A)
+    master = StreamMaster(body)
+    pipeline = NBPipeline.NBPipeline(master, stations_db, sinks=("fill",), streaming=True)
+    with pytest.raises(OSError):
+        pipeline.run()
+
+    # the status was committed once and not downloaded again
+    assert master.num_streams == 1
+    assert len(stored_rows(stations_db)) == 4
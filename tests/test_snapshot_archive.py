@@ -0,0 +1,91 @@
+import datetime
+import io
+import os
+
+import pytest
+
+import feed_generator
+from NB_lib import NBFeedIds, NBFeedParser, NBMasterDataDB, NBSnapshotArchive, NBStationsDataDB, NBStatusStream
+
+TIME_A = datetime.datetime(2016, 10, 18, 12, 0)
+TIME_B = datetime.datetime(2016, 10, 18, 12, 5)
+
+
+def stored_rows(stations_db):
+    c = stations_db.conn.cursor()
+    c.execute("SELECT timestamp, place_uid, bikes, free_racks FROM stations_fill ORDER BY timestamp, place_uid")
+    return c.fetchall()
+
+
+def expected_rows(body, status_time, feed_ids=None):
+    status = NBFeedParser.parse_feed(body, NBMasterDataDB.NBMasterDataDB.STATUS_SOURCE, feed_ids)
+    return sorted((int(status_time.timestamp()),) + NBStationsDataDB.fill_values(record.place)
+                  for record in status.records())
+
+
+@pytest.fixture
+def archive(tmp_path):
+    archive = NBSnapshotArchive.NBSnapshotArchive(str(tmp_path / "snapshots"))
+    yield archive
+    archive.close()
+
+
+@pytest.fixture
+def stations_db(tmp_path, master_stub):
+    master_stub.feed_ids = NBFeedIds.NBFeedIds()
+    db = NBStationsDataDB.NBStationsDataDB(str(tmp_path / "stations_transactions.db"), master_db=master_stub,
+                                           log_file=None)
+    yield db
+    db.close()
+
+
+def test_xml_and_gbfs_snapshots_are_replayed(archive, stations_db):
+    xml = feed_generator.generate_feed(1, 1, 3, legacy_quirks=False, status_time=TIME_A)
+    gbfs = feed_generator.generate_gbfs_feed(1, 1, 3, seed=1, status_time=TIME_B)
+    # the GBFS snapshot is archived first, the snapshots are replayed by their time of query
+    archive.add(gbfs, TIME_B)
+    archive.add(xml, TIME_A)
+
+    assert stations_db.replay_snapshots(archive) == 2
+    gbfs_rows = expected_rows(gbfs, TIME_B, stations_db.master_db.feed_ids)
+    assert all(uid >= NBFeedIds.FIRST_UID for _, uid, _, _ in gbfs_rows)
+    assert stored_rows(stations_db) == expected_rows(xml, TIME_A) + gbfs_rows
+
+
+def archived_objects(archive):
+    return sorted(name for _, _, names in os.walk(archive.objects_dir) for name in names)
+
+
+def test_identical_payloads_are_stored_once(archive):
+    xml = feed_generator.generate_feed(1, 2, 5, status_time=TIME_A)
+    first = archive.add(xml, TIME_A)
+    assert archive.add(xml, TIME_B) == first
+    assert archived_objects(archive) == [first + ".xz"]
+    assert archive.snapshots() == [(TIME_A, first), (TIME_B, first)]
+    with archive.open(first) as payload:
+        assert payload.read() == xml
+
+
+def test_streams_are_archived_once_read_completely(archive):
+    xml = feed_generator.generate_feed(1, 2, 5, status_time=TIME_A)
+    abandoned = archive.tee(io.BytesIO(xml))
+    abandoned.read(100)
+    abandoned.close()
+    assert archived_objects(archive) == []
+
+    with NBStatusStream.NBStatusStream(archive.tee(io.BytesIO(xml)), chunk_size=1000) as stream:
+        assert len(list(stream)) == 10
+        content_hash = archive.commit(stream.source, stream.status_time)
+    assert archived_objects(archive) == [content_hash + ".xz"]
+    assert archive.snapshots() == [(TIME_A, content_hash)]
+
+
+def test_replay_adds_a_snapshot_at_every_time_of_query(archive, stations_db):
+    xml = feed_generator.generate_feed(1, 1, 3, legacy_quirks=False, status_time=TIME_A)
+    archive.add(xml, TIME_A)
+    archive.add(xml, TIME_B)
+
+    assert stations_db.replay_snapshots(archive, start=TIME_B) == 1
+    assert stored_rows(stations_db) == expected_rows(xml, TIME_B)
+    assert stations_db.replay_snapshots(archive) == 2
+    assert stored_rows(stations_db) == expected_rows(xml, TIME_A) + expected_rows(xml, TIME_B)
@@ -0,0 +1,96 @@
+import math
+import random
+
+import pytest
+
+from NB_lib import NBCLI, NBSpatialIndex
+
+
+def brute_haversine(lat, lng, place_lat, place_lng):
+    lat, lng, place_lat, place_lng = (math.radians(value) for value in (lat, lng, place_lat, place_lng))
+    a = math.sin((place_lat - lat) / 2) ** 2 + \
+        math.cos(lat) * math.cos(place_lat) * math.sin((place_lng - lng) / 2) ** 2
+    return 2 * NBSpatialIndex.EARTH_RADIUS * math.asin(math.sqrt(min(a, 1.0)))
+
+
+def random_places(seed=0):
+    """Places clustered around a city, spread over the world and close to the antimeridian and the poles"""
+    rnd = random.Random(seed)
+    places = [(uid, 51.34 + rnd.uniform(-0.1, 0.1), 12.37 + rnd.uniform(-0.1, 0.1)) for uid in range(300)]
+    places += [(uid, rnd.uniform(-90, 90), rnd.uniform(-180, 180)) for uid in range(300, 600)]
+    places += [(uid, rnd.uniform(-1, 1), rnd.choice((-1, 1)) * rnd.uniform(179.5, 180)) for uid in range(600, 700)]
+    places += [(uid, rnd.uniform(89, 90), rnd.uniform(-180, 180)) for uid in range(700, 750)]
+    return places
+
+
+@pytest.fixture(scope="module")
+def places():
+    return random_places()
+
+
+@pytest.fixture(scope="module")
+def index(places):
+    return NBSpatialIndex.NBSpatialIndex.from_rows(places + [(999, None, None)])
+
+
+QUERIES = [(51.34, 12.37, 3000), (51.34, 12.37, 25000), (0.0, 180.0, 60000), (0.5, -179.9, 100000),
+           (89.9, 0.0, 150000), (-30.0, 40.0, 2000000)]
+
+
+@pytest.mark.parametrize("lat, lng, radius", QUERIES)
+def test_within_matches_brute_force(index, places, lat, lng, radius):
+    uids, distances = index.within(lat, lng, radius)
+    expected = sorted((brute_haversine(lat, lng, place_lat, place_lng), uid) for uid, place_lat, place_lng in places
+                      if brute_haversine(lat, lng, place_lat, place_lng) <= radius)
+    assert sorted(uids.tolist()) == sorted(uid for _, uid in expected)
+    assert [round(value, 3) for value in distances.tolist()] == [round(value, 3) for value, _ in expected]
+
+
+@pytest.mark.parametrize("lat, lng", [(51.34, 12.37), (0.0, 180.0), (89.9, 0.0), (-60.0, -100.0)])
+def test_nearest_matches_brute_force(index, places, lat, lng):
+    uids, distances = index.nearest(lat, lng, 10)
+    expected = sorted(brute_haversine(lat, lng, place_lat, place_lng) for _, place_lat, place_lng in places)[:10]
+    assert len(uids) == 10
+    assert [round(value, 3) for value in distances.tolist()] == [round(value, 3) for value in expected]
+
+
+@pytest.mark.parametrize("south, west, north, east", [(51.3, 12.3, 51.4, 12.4), (-1.0, 179.7, 1.0, -179.7),
+                                                      (-45.0, -90.0, 45.0, 90.0), (88.0, -180.0, 90.0, 180.0)])
+def test_bbox_matches_brute_force(index, places, south, west, north, east):
+    def inside(place_lat, place_lng):
+        in_lng = west <= place_lng <= east if west <= east else place_lng >= west or place_lng <= east
+        return in_lng and south <= place_lat <= north
+
+    expected = sorted(uid for uid, place_lat, place_lng in places if inside(place_lat, place_lng))
+    assert index.in_bbox(south, west, north, east).tolist() == expected
+
+
+class MasterAreas:
+    """Answers the area queries of the place configuration from a spatial index"""
+
+    def __init__(self, index):
+        self.index = index
+
+    def get_places_within(self, lat, lng, radius):
+        return self.index.within(lat, lng, radius)[0].tolist()
+
+    def get_places_in_bbox(self, south, west, north, east):
+        return self.index.in_bbox(south, west, north, east).tolist()
+
+
+def area_places(index, values):
+    cli = NBCLI.NBCLI.__new__(NBCLI.NBCLI)
+    cli.master_data = MasterAreas(index)
+    return cli._area_places(values)
+
+
+def test_areas_of_the_place_configuration(index):
+    assert area_places(index, ["51.34, 12.37, 3km"]) == set(index.within(51.34, 12.37, 3000)[0].tolist())
+    assert area_places(index, ["51.34, 12.37, 500m", "51.3, 12.3, 51.4, 12.4"]) == \
+        set(index.in_bbox(51.3, 12.3, 51.4, 12.4).tolist())
+
+
+@pytest.mark.parametrize("value", ["51.34, 12.37", "51.34, 12.37, 3 miles", "north, 12.3, 51.4, 12.4"])
+def test_malformed_areas_fail_the_place_configuration(index, value):
+    with pytest.raises(AssertionError, match="Malformed area"):
+        area_places(index, [value])
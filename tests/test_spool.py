@@ -0,0 +1,69 @@
+import datetime
+import os
+
+import pytest
+
+from NB_lib import NBSpool, NBStationsDataDB
+
+T0 = 1476792000
+
+
+def stored_rows(stations_db):
+    c = stations_db.conn.cursor()
+    c.execute("SELECT timestamp, place_uid, bikes, free_racks FROM stations_fill ORDER BY timestamp, place_uid")
+    return c.fetchall()
+
+
+def spooled_timestamps(spool):
+    return [int(os.path.basename(path).split("_")[0]) for path in spool.files()]
+
+
+@pytest.fixture
+def stations_db(tmp_path, master_stub):
+    db = NBStationsDataDB.NBStationsDataDB(str(tmp_path / "stations_transactions.db"), master_db=master_stub,
+                                           log_file=None)
+    yield db
+    db.close()
+
+
+def test_states_left_by_a_crash_are_written_on_the_next_start(tmp_path, stations_db):
+    spool_dir = str(tmp_path / "spool")
+    # a crawler spooled three states and crashed before its writer got to them, one of them half written
+    spool = NBSpool.NBSpool(spool_dir)
+    spool.put(T0 + 300, [(1, 4, 6), (2, 0, 10)])
+    spool.put(T0, [(1, 5, 5)])
+    with open(os.path.join(spool_dir, "{:012d}_1_000001.spool".format(T0 + 600)), "w") as file:
+        file.write('{"timestamp": 1476')
+    with open(os.path.join(spool_dir, "{:012d}_1_000002.spool.tmp".format(T0 + 900)), "w") as file:
+        file.write('{"timestamp": 1476')
+
+    stations_db.start_writer(spool_dir, retry_delay=0.01)
+    assert stations_db.stop_writer(timeout=10) == 0
+    assert stored_rows(stations_db) == [(T0, 1, 5, 5), (T0 + 300, 1, 4, 6), (T0 + 300, 2, 0, 10)]
+    # the unreadable state is kept aside, the one which was never renamed into place is no state
+    assert os.listdir(os.path.join(spool_dir, "failed")) == ["{:012d}_1_000001.spool".format(T0 + 600)]
+    assert stations_db.get_current(1) == (T0 + 300, 4, 6)
+
+
+def test_spool_drops_the_oldest_states_beyond_max_files(tmp_path, metrics):
+    spool = NBSpool.NBSpool(str(tmp_path / "spool"), queue_size=2, max_files=3)
+    for number in range(5):
+        spool.put(T0 + number * 300, [(1, number, 0)])
+    assert spooled_timestamps(spool) == [T0 + 600, T0 + 900, T0 + 1200]
+    assert metrics.counters["states_dropped"] == 2
+
+    # the state being written is never dropped, the oldest waiting one goes instead
+    path, timestamp, rows = spool.get(timeout=0)
+    assert (timestamp, rows) == (T0 + 600, [[1, 2, 0]])
+    spool.put(T0 + 1500, [(1, 5, 0)])
+    assert spooled_timestamps(spool) == [T0 + 600, T0 + 1200, T0 + 1500]
+    spool.remove(path)
+    assert spool.get(timeout=0)[1:] == (T0 + 1200, [[1, 4, 0]])
+
+
+def test_spooled_states_are_written_in_order(tmp_path, stations_db):
+    stations_db.start_writer(str(tmp_path / "spool"), max_files=100)
+    for number in range(3):
+        stations_db.add_fill_rows([(1, number, 5 - number)], datetime.datetime.fromtimestamp(T0 + number * 300))
+    assert stations_db.stop_writer(timeout=10) == 0
+    assert stored_rows(stations_db) == [(T0 + number * 300, 1, number, 5 - number) for number in range(3)]
@@ -0,0 +1,46 @@
+import math
+
+from NB_lib import NBTimeSeries
+
+T0 = 1476792000
+
+
+def fill_series(rows):
+    return NBTimeSeries.series_from_rows(rows)
+
+
+def test_resample_hand_computed_buckets():
+    series = fill_series([(T0, 1, 2, 8), (T0 + 1200, 1, 6, 4), (T0 + 3599, 1, 4, 4), (T0 + 3600, 1, 0, 0),
+                          (T0 + 600, 2, 3, 1)])
+    resampled = NBTimeSeries.resample(series, 3600)
+
+    assert resampled.bucket.tolist() == [T0, T0 + 3600, T0]
+    assert resampled.place_uid.tolist() == [1, 1, 2]
+    assert resampled.count.tolist() == [3, 1, 1]
+    assert resampled.bikes_mean.tolist() == [4.0, 0.0, 3.0]
+    assert resampled.bikes_min.tolist() == [2, 0, 3]
+    assert resampled.bikes_max.tolist() == [6, 0, 3]
+    assert resampled.free_racks_mean.tolist() == [16 / 3, 0.0, 1.0]
+    assert resampled.free_racks_min.tolist() == [4, 0, 1]
+    assert resampled.free_racks_max.tolist() == [8, 0, 1]
+    # the mean of 0.2, 0.6 and 0.5; a place without racks has no occupancy
+    assert math.isclose(resampled.occupancy[0], 1.3 / 3)
+    assert math.isnan(resampled.occupancy[1])
+    assert resampled.occupancy[2] == 0.75
+
+
+def test_resample_over_all_places_with_origin():
+    series = fill_series([(T0, 1, 2, 8), (T0 + 1200, 1, 6, 4), (T0 + 600, 2, 3, 1)])
+    # buckets of 30 minutes starting at a quarter past
+    resampled = NBTimeSeries.resample(series, 1800, by_place=False, origin=T0 + 900)
+
+    assert resampled.bucket.tolist() == [T0 - 900, T0 + 900]
+    assert resampled.place_uid.tolist() == [-1, -1]
+    assert resampled.count.tolist() == [2, 1]
+    assert resampled.bikes_mean.tolist() == [2.5, 6.0]
+    assert resampled.occupancy.tolist() == [(0.2 + 0.75) / 2, 0.6]
+
+
+def test_resample_empty_series():
+    resampled = NBTimeSeries.resample(fill_series([]), 3600)
+    assert all(len(values) == 0 for values in resampled)